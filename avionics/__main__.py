@@ -1,9 +1,13 @@
+import time
+
+# Startup is measured from here, before anything heavy is imported
+_STARTUP = time.monotonic()
+
 import logging
 import os
 import serial
 import signal
 import sys
-import time
 import threading
 import queue
 
@@ -12,31 +16,67 @@ from functools import partial
 from services import DataStationHandler
 from services import Heartbeat
 from services import SerialHandler
+from services import start_logging, stop_logging
+from services.export import ExportServer
+from services.data_station_handler.download_process import start_worker_server
+from services.data_station_handler.sftp import load_paramiko
+from services.metrics import registry
+from services.profiler import install as install_profiler, profiler
+from services.recorder import Recorder
+
+_IMPORTED = time.monotonic()
+
+def startup_step(step):
+    """Log and record the time since startup"""
+    elapsed = time.monotonic() - _STARTUP
+    registry.observe('startup_seconds', elapsed, step=step)
+    logging.info("Startup: %s after %.3f s", step, elapsed)
 
 def setup_logging():
     """Set up logging [Logging levels in order of seriousness:
 
     DEBUG < INFO < WARNING < ERROR < CRITICAL
+
+    Records are written by a background thread (see `services.logger`) so
+    log I/O never blocks the serial, heartbeat or download threads.
     """
 
-    # Only log when needed
-    if os.getenv("DEVELOPMENT") == 'True' or os.getenv("TESTING") == 'True':
+    # Only log when needed, and only log to STDOUT in debug mode
+    debug = os.getenv("DEVELOPMENT") == 'True' or os.getenv("TESTING") == 'True'
+
+    if debug:
         logging_level = logging.DEBUG
     else:
         logging_level = logging.INFO
 
-    logging.basicConfig(filename='/var/log/mission-mule-flight.log',
-                        level=logging_level,
-                        format='%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s',
-                        datefmt="%d %b %Y %H:%M:%S")
+    # Log next to the test database in test mode
+    if os.getenv("TESTING") == 'True':
+        filename = 'mission-mule-flight.log'
+    else:
+        filename = '/var/log/mission-mule-flight.log'
+
+    start_logging(filename, logging_level, stdout=debug)
 
-    # Log to STDOUT
-    # TODO: only log to stdout in debug mode to speed things up
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging_level)
-    formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(message)s')
-    ch.setFormatter(formatter)
-    logging.getLogger().addHandler(ch)
+def setup_profiler():
+    """SIGUSR1 toggles the sampling profiler, profiles go next to the log"""
+
+    if os.getenv("TESTING") == 'True':
+        profiler.directory = 'mission-mule-profiles'
+
+    install_profiler(signal.SIGUSR1)
+
+def setup_recorder():
+    """With RECORD_TRAFFIC=True, serial and XBee traffic is recorded for replay (see `services.recorder`)"""
+
+    if os.getenv("RECORD_TRAFFIC") != 'True':
+        return None
+
+    if os.getenv("TESTING") == 'True':
+        directory = 'mission-mule-recordings'
+    else:
+        directory = '/var/log/mission-mule-recordings/'
+
+    return Recorder(os.path.join(directory, time.strftime('%Y%m%d-%H%M%S.mmrec')))
 
 def signal_handler(services, signum, frame):
     logging.info("Received signal: %s" % signal.Signals(signum).name)
@@ -49,11 +89,21 @@ def signal_handler(services, signum, frame):
     time.sleep(3) # Wait for cleanup
 
     logging.info("Bye.")
+    stop_logging()
 
     exit()
 
+def preload():
+    """Import paramiko and start the worker fork server in the background so the first download doesn't pay for them"""
+    load_paramiko()
+    startup_step('paramiko loaded')
+    start_worker_server()
+    startup_step('worker server started')
+
 def main():
     logging.info('\n\n--- mission start ---')
+    registry.observe('startup_seconds', _IMPORTED - _STARTUP, step='imports')
+    logging.info("Startup: imports took %.3f s", _IMPORTED - _STARTUP)
 
     # Maintains list of active services (serial, data station, heartbeat)
     services = []
@@ -61,31 +111,26 @@ def main():
     # System status flag set by data station handler, monitored by heartbeat
     is_downloading = threading.Event()
 
+    # Gracefully handle SIGINT
+    signal.signal(signal.SIGINT, partial(signal_handler, services))
+
+    setup_profiler()
+
+    recorder = setup_recorder()
+
+    # The serial link and heartbeat come up first so the autopilot sees the
+    # payload as soon as possible. Everything else is started afterwards.
+
     # Serial handler with public rx and tx queues
     ser = SerialHandler('/dev/ttyAMA0', 57600, 1)
+    ser.recorder = recorder
     services.append(ser)
 
-    # Data station communication handling
-    # 2 min. connection timeout
-    # 2 min. read/write timeout
-    # 10 min. download timeout
-    dl = DataStationHandler(120000, 120000, 900000, ser.rx_queue)
-    services.append(dl)
-
     # Heartbeat pushed to serial tx_queue every 500ms
     hb = Heartbeat(ser.tx_queue, 500)
     services.append(hb)
 
-    # Gracefully handle SIGINT
-    signal.signal(signal.SIGINT, partial(signal_handler, services))
-
     ser.connect()
-    dl.connect()
-
-    thread_data_station_handler = threading.Thread(target=dl.run, args=(ser.rx_lock, is_downloading))
-    thread_data_station_handler.daemon = True
-    thread_data_station_handler.name = 'Data Station Communication Handler'
-    thread_data_station_handler.start()
 
     thread_heartbeat = threading.Thread(target=hb.run, args=(ser.tx_lock, is_downloading))
     thread_heartbeat.daemon = True
@@ -102,6 +147,65 @@ def main():
     thread_serial_reader.name = 'Serial Communication Reader'
     thread_serial_reader.start()
 
+    if hb.first_beat.wait(10):
+        startup_step('first heartbeat')
+
+    thread_preload = threading.Thread(target=preload)
+    thread_preload.daemon = True
+    thread_preload.name = 'Preload'
+    thread_preload.start()
+
+    # Data station communication handling
+    # 2 min. connection timeout
+    # 2 min. read/write timeout
+    # 10 min. download timeout
+    dl = DataStationHandler(120000, 120000, 900000, ser.rx_queue, _tx_queue=ser.tx_queue)
+    dl.xbee.recorder = recorder
+    services.append(dl)
+
+    dl.connect()
+
+    thread_data_station_handler = threading.Thread(target=dl.run, args=(ser.rx_lock, is_downloading))
+    thread_data_station_handler.daemon = True
+    thread_data_station_handler.name = 'Data Station Communication Handler'
+    thread_data_station_handler.start()
+
+    # Evicts exported flights when the disk runs low, never during a download
+    services.append(dl.retention)
+
+    thread_retention = threading.Thread(target=dl.retention.run, args=(is_downloading,))
+    thread_retention.daemon = True
+    thread_retention.name = 'Retention'
+    thread_retention.start()
+
+    # EXIF index and thumbnails of downloaded files, between downloads
+    services.append(dl.ingest)
+
+    thread_ingest = threading.Thread(target=dl.ingest.run, args=(is_downloading,))
+    thread_ingest.daemon = True
+    thread_ingest.name = 'Ingest'
+    thread_ingest.start()
+
+    startup_step('data station handler ready')
+
+    # Closed after the services that write to it
+    if recorder is not None:
+        services.append(recorder)
+
+    # Post-flight export of downloaded field data to the ground station
+    try:
+        export = ExportServer(int(os.getenv('EXPORT_PORT', '8080')), os.getenv('EXPORT_ADDRESS', ''),
+                              _db=dl.db, _local_root=dl.local_root, _token=os.getenv('EXPORT_TOKEN'))
+    except OSError as e:
+        logging.error("Export server unavailable: %s", e)
+    else:
+        services.append(export)
+
+        thread_export = threading.Thread(target=export.run, args=(is_downloading,))
+        thread_export.daemon = True
+        thread_export.name = 'Export Server'
+        thread_export.start()
+
     # Wait for daemon threads to return on their own
     thread_data_station_handler.join()
     thread_heartbeat.join()
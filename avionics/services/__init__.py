@@ -1,3 +1,4 @@
 from .data_station_handler import *
 from .heartbeat import *
 from .serial_handler import *
+from .logger import *
@@ -0,0 +1 @@
+from .clock import ScaledClock, SimulatedClock, SystemClock
@@ -0,0 +1,76 @@
+"""
+Time source for the services
+
+Services take an optional `_clock` and use it for wall time, monotonic time
+and sleeping instead of calling the `time` module directly. In flight that
+is the `SystemClock`. Tests and mission scenarios use a `SimulatedClock`,
+which skips ahead instead of waiting, so a mission that takes an hour in the
+air runs in seconds with the same timings recorded. Replays of recorded
+serial traffic run on a `ScaledClock`, real time sped up by a constant factor.
+"""
+
+import threading
+import time
+
+class SystemClock(object):
+    """Real time"""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class ScaledClock(object):
+    """Real time running `speed` times faster, sleeps are shortened to match"""
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._monotonic = time.monotonic()
+        self._time = time.time()
+
+    def time(self):
+        return self._time + (time.monotonic() - self._monotonic) * self.speed
+
+    def monotonic(self):
+        return self._monotonic + (time.monotonic() - self._monotonic) * self.speed
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+
+class SimulatedClock(object):
+    """Virtual time that jumps forward instead of sleeping
+
+    `sleep()` advances the clock and returns straight away, so code driven
+    from one thread runs as fast as it can compute and sees exactly the
+    timings it would in flight. Threads sleeping at the same time each move
+    the clock forward, so runs are only deterministic with a single thread
+    doing the sleeping.
+    """
+
+    def __init__(self, start=0.0, epoch=None):
+        self._lock = threading.Lock()
+        self._now = start
+        self._epoch = time.time() if epoch is None else epoch  # Wall time at `start`
+        self._start = start
+
+    def time(self):
+        with self._lock:
+            return self._epoch + self._now - self._start
+
+    def monotonic(self):
+        with self._lock:
+            return self._now
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += max(0, seconds)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+        time.sleep(0)   # Still let other threads run
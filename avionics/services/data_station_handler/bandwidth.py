@@ -0,0 +1,97 @@
+"""
+Transfer rate shared between concurrent station sessions.
+
+With several stations downloaded at once (see `DataStationHandler.max_sessions`)
+the sessions compete for what the payload can take in: SD card writes, CPU
+for SSH and, when the links share a radio, airtime. `BandwidthShare` caps
+their total rate and splits it evenly between the sessions running at that
+moment, so a session that starts late isn't starved by one already going at
+full speed. Each session paces itself with a token bucket refilled at its
+current share, and counts what it transferred and how long it was held back.
+"""
+
+import threading
+
+from ..clock import SystemClock
+
+class SessionBudget(object):
+    """One session's part of a `BandwidthShare`, use as a context manager"""
+
+    def __init__(self, share, name):
+        self.name = name
+        self.bytes = 0          # Transferred so far
+        self.wait_s = 0.0       # Time spent held back
+
+        self._share = share
+        self._clock = share.clock
+        self._allowance = 0.0   # Bytes that may go without waiting
+        self._last = self._clock.monotonic()
+
+    def consume(self, size):
+        """Counts `size` transferred bytes, sleeps until they fit in the session's share"""
+
+        self.bytes += size
+
+        rate = self._share.rate_bps()
+        if rate is None:
+            return
+
+        now = self._clock.monotonic()
+        self._allowance = min(self._allowance + (now - self._last) * rate, rate * self._share.BURST_S)
+        self._allowance -= size
+        self._last = now
+
+        if self._allowance < 0:
+            wait_s = -self._allowance / rate
+            self.wait_s += wait_s
+            self._clock.sleep(wait_s)
+            self._allowance = 0.0
+            self._last = self._clock.monotonic()
+
+    def close(self):
+        self._share._remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BandwidthShare(object):
+    """Splits a total transfer rate evenly between the sessions using it"""
+
+    BURST_S = 0.25      # Longest a session can save up its share for
+
+    def __init__(self, total_mbps=None, clock=None):
+        self.total_mbps = total_mbps    # None leaves sessions unthrottled, they are still counted
+        self.clock = clock or SystemClock()
+        self._lock = threading.Lock()
+        self._sessions = []
+
+    def session(self, name):
+        """Returns a new `SessionBudget`, its share is taken from the others until it is closed"""
+
+        budget = SessionBudget(self, name)
+        with self._lock:
+            self._sessions.append(budget)
+        return budget
+
+    def _remove(self, budget):
+        with self._lock:
+            if budget in self._sessions:
+                self._sessions.remove(budget)
+
+    @property
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def rate_bps(self):
+        """Each session's current share in bytes per second, None when unlimited"""
+
+        if self.total_mbps is None:
+            return None
+        with self._lock:
+            active = max(1, len(self._sessions))
+        return self.total_mbps * 1e6 / 8 / active
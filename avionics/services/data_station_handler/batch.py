@@ -0,0 +1,233 @@
+"""
+Batch data station downloads for ground and bench use
+
+Visits a list of data stations through the same wakeup, session, download
+and shutdown path as in flight, and prints one JSON line per visit with its
+phase timings and throughput:
+
+    python3 -m avionics.services.data_station_handler.batch 101 102 103 --sessions 2 --mode progressive
+
+`--sessions` stations are downloaded at once (see `DataStationHandler.max_sessions`)
+and `--mode` is `full` or `progressive` (thumbnails of every file first).
+`--repeat` visits the whole list again, waiting for every session in between.
+The last line is a summary of the run.
+
+`--save-baseline bench.json` keeps each station's median throughput and visit
+time, and a later run with `--baseline bench.json` lists the stations that
+got slower by more than `--tolerance` in its summary and exits with 1, so a
+payload build can be compared with the last one before it flies. A visit
+that doesn't download every file exits with 1 as well.
+
+`--simulate` visits simulated stations on this machine (`avionics.simulator`)
+instead of real ones over the XBee.
+"""
+
+import argparse
+import json
+import logging
+import queue
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from .data_station_handler import DataStationHandler
+
+PHASES = ['wakeup', 'boot_wait', 'connect', 'transfer', 'logs', 'shutdown', 'visit']
+
+MODES = ['full', 'progressive']
+
+class BatchRun(object):
+    """Visits stations with a `DataStationHandler` and records a line per visit"""
+
+    def __init__(self, handler, out=None, is_downloading=None):
+        self.handler = handler
+        self.out = out
+        self.is_downloading = is_downloading or threading.Event()
+
+        self.records = []
+        self.wall_s = 0.0
+        self._lock = threading.Lock()
+        self._round = 0
+
+    def run(self, stations, repeat=1):
+        """Visits every station `repeat` times, returns the visit records"""
+
+        handler = self.handler
+        handler.on_visit = self._visited
+
+        start = time.monotonic()
+        try:
+            for self._round in range(repeat):
+                handler.visit_all(stations, self.is_downloading)
+        finally:
+            handler.on_visit = None
+            self.wall_s = time.monotonic() - start
+
+        return self.records
+
+    def _visited(self, trace):
+        """Turns a finished visit's trace and statistics into a record, called from its session"""
+
+        station_id = trace.attributes['station_id']
+        flight_id = trace.attributes['flight_id']
+        stats = self.handler.db.get_flight_station_stats(station_id, flight_id) or {}
+
+        files = stats.get('successful_downloads') or 0
+        total_files = stats.get('total_files') or 0
+
+        record = {
+            'record': 'visit',
+            'station_id': station_id,
+            'flight_id': flight_id,
+            'round': self._round,
+            'mode': 'progressive' if self.handler.progressive else 'full',
+            'sessions': self.handler.max_sessions,
+            'phases': dict((name, round(trace.duration(name), 3)) for name in PHASES
+                           if any(s.name == name for s in trace.spans)),
+            'files': files,
+            'total_files': total_files,
+            'bytes': trace.get('bytes_downloaded'),
+            'throughput_mbps': round(stats.get('download_speed_mbps') or 0, 3),
+            'visit_s': round(trace.duration('visit'), 3),
+            'ok': bool(stats.get('did_connect')) and files == total_files,
+        }
+
+        with self._lock:
+            self.records.append(record)
+            if self.out is not None:
+                self.out.write(json.dumps(record, sort_keys=True) + '\n')
+                self.out.flush()
+
+
+def summarize(records, wall_s):
+    """Returns per-station medians and the aggregate rate of a run, the format baselines are stored in"""
+
+    by_station = {}
+    for r in records:
+        by_station.setdefault(r['station_id'], []).append(r)
+
+    stations = {}
+    for station_id, visits in by_station.items():
+        stations[station_id] = {
+            'throughput_mbps': statistics.median(v['throughput_mbps'] for v in visits),
+            'visit_s': statistics.median(v['visit_s'] for v in visits),
+            'files': max(v['files'] for v in visits),
+        }
+
+    total_bytes = sum(r['bytes'] for r in records)
+    return {
+        'stations': stations,
+        'aggregate_mbps': round(total_bytes * 8 / 1e6 / wall_s, 3) if wall_s else 0,
+    }
+
+def compare(baseline, summary, tolerance=0.2):
+    """Returns the regressions of `summary` against `baseline`, stations missing from either are skipped"""
+
+    regressions = []
+
+    def check(station_id, metric, before, after, worse):
+        if worse:
+            regressions.append({'station_id': station_id, 'metric': metric, 'baseline': before, 'value': after})
+
+    for station_id, after in sorted(summary['stations'].items()):
+        before = baseline['stations'].get(station_id)
+        if before is None:
+            continue
+
+        check(station_id, 'throughput_mbps', before['throughput_mbps'], after['throughput_mbps'],
+              after['throughput_mbps'] < before['throughput_mbps'] * (1 - tolerance))
+        check(station_id, 'visit_s', before['visit_s'], after['visit_s'],
+              after['visit_s'] > before['visit_s'] * (1 + tolerance))
+        check(station_id, 'files', before['files'], after['files'], after['files'] < before['files'])
+
+    # The aggregate rate only compares between runs of the same stations
+    if set(summary['stations']) == set(baseline['stations']):
+        check(None, 'aggregate_mbps', baseline['aggregate_mbps'], summary['aggregate_mbps'],
+              summary['aggregate_mbps'] < baseline['aggregate_mbps'] * (1 - tolerance))
+
+    return regressions
+
+
+def _stations(values):
+    """Station IDs from arguments like '101 102' or '101,102'"""
+    return [s for value in values for s in value.split(',') if s]
+
+def main(argv=None, out=None):
+    parser = argparse.ArgumentParser(description='Download a list of data stations and report timings as JSON lines')
+    parser.add_argument('stations', nargs='+', help='data station IDs, e.g. 101 102 or 101,102')
+    parser.add_argument('--sessions', type=int, default=1, help='stations downloaded at once')
+    parser.add_argument('--mode', choices=MODES, default='full', help='transfer mode')
+    parser.add_argument('--worker', choices=['thread', 'process'], default='thread', help='download worker type')
+    parser.add_argument('--repeat', type=int, default=1, help='times the list is visited')
+    parser.add_argument('--baseline', help='baseline to compare with, exits with 1 on a regression')
+    parser.add_argument('--save-baseline', help='write this run as a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown allowed against the baseline')
+    parser.add_argument('--simulate', action='store_true', help='visit simulated stations on this machine')
+    parser.add_argument('--files', type=int, default=20, help='files per simulated station')
+    parser.add_argument('--size-kb', type=int, default=256, help='file size on simulated stations')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    out = out or sys.stdout
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s',
+                        datefmt="%d %b %Y %H:%M:%S")
+
+    stations = _stations(args.stations)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    mission = None
+    work_dir = None
+    if args.simulate:
+        from avionics.simulator.benchmark import Mission
+
+        work_dir = tempfile.mkdtemp(prefix='mission-mule-batch-')
+        mission = Mission(work_dir, stations, files_per_folder=args.files,
+            size_distribution=('fixed', args.size_kb * 1024), ack_delay_s=0.1)
+        handler = mission.handler
+    else:
+        handler = DataStationHandler(120000, 120000, 900000, queue.Queue())
+        handler.connect()
+
+    handler.max_sessions = args.sessions
+    handler.progressive = (args.mode == 'progressive')
+    handler.download_worker = args.worker
+
+    batch = BatchRun(handler, out)
+    try:
+        records = batch.run(stations, args.repeat)
+    finally:
+        if mission is not None:
+            mission.stop()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarize(records, batch.wall_s)
+    regressions = compare(baseline, summary, args.tolerance) if baseline is not None else []
+    failed = sum(1 for r in records if not r['ok'])
+
+    out.write(json.dumps({
+        'record': 'summary',
+        'visits': len(records),
+        'failed': failed,
+        'bytes': sum(r['bytes'] for r in records),
+        'wall_s': round(batch.wall_s, 3),
+        'aggregate_mbps': summary['aggregate_mbps'],
+        'regressions': regressions,
+    }, sort_keys=True) + '\n')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+    return 1 if regressions or failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
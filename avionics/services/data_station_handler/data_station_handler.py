@@ -1,13 +1,22 @@
+import collections
 import logging
 import os
 import random
-import time
 import threading
 
-from .timer import Timer
+from .bandwidth import BandwidthShare
 from .download import Download
+from .download_process import DownloadProcess
 from .xbee import XBee
 from .database import Database
+from .ingest import IngestPipeline
+from .retention import RetentionManager
+from .scheduler import StationScheduler
+from .sftp import SFTPClient
+from .tuner import TransferTuner
+from ..clock import SystemClock
+from ..metrics import Trace, registry
+from ..profiler import profiler
 
 class DataStationHandler(object):
     """Communication handler for data stations (XBee station wakeup and SFTP download)
@@ -23,20 +32,108 @@ class DataStationHandler(object):
         When the UAV arrives at a data station, the station is woken up with
         an XBee RF signal including its data station ID ('123', '200', etc.)
 
+    Sessions:
+        Up to `max_sessions` stations are downloaded at once, each in a
+        session thread of its own, optionally bound to a source address or
+        interface (`station_sources`) so stations in range of different
+        radios use both links. Sessions split `bandwidth` evenly.
+
+    Control Messages:
+        Messages from the autopilot that start with a keyword (e.g.
+        'PLAN 101,102') are requests rather than arrivals. They are
+        dispatched through `control_handlers` and answered on the TX queue.
+
     """
 
     def __init__(self, _connection_timeout_millis, _read_write_timeout_millis,
-        _overall_timeout_millis, _rx_queue):
+        _overall_timeout_millis, _rx_queue, _xbee=None, _db=None, _tx_queue=None, _clock=None):
 
         self.connection_timeout_millis = _connection_timeout_millis
         self.read_write_timeout_millis = _read_write_timeout_millis
         self.overall_timeout_millis = _overall_timeout_millis
         self.rx_queue = _rx_queue
-        self.xbee = XBee()
-        self.db = Database()
+        self.tx_queue = _tx_queue
+        self.clock = _clock or SystemClock()
+        self.xbee = _xbee or XBee(clock=self.clock)
+        self.db = _db or Database(_clock=self.clock)
         self._alive = True
         self.flight_id = None # Will be created before the flight's first download
 
+        # In test mode the XBee handshake and SFTP download are simulated. The
+        # data station simulator (`avionics.simulator`) turns this off to
+        # exercise the real path against local stations.
+        self.simulate = (os.getenv('TESTING') == 'True')
+
+        self.boot_delay_s = 40          # Time for a data station to boot after wakeup
+        self.station_addresses = {}     # Station ID -> (address, port) overrides, otherwise '<id>.local':22
+        self._local_root = None         # Local root data directory override, see `local_root`
+        self.log_share = 0.2            # Share of the download timeout station logs may use, 0 disables them
+
+        # Stations downloaded at once, each arrival beyond one gets a session thread of its own
+        self.max_sessions = int(os.getenv('STATION_SESSIONS', '1'))
+        self.station_sources = {}       # Station ID -> source address or interface its session is bound to
+        bandwidth_mbps = os.getenv('SESSION_BANDWIDTH_MBPS')
+        self.bandwidth = BandwidthShare(float(bandwidth_mbps) if bandwidth_mbps else None, self.clock)
+        self.sessions = {}              # Station ID -> session thread visiting it
+        self._arrivals = collections.deque()    # (station ID, done callback) waiting for a free session
+        self._session_threads = 0
+        self._sessions_changed = threading.Condition()
+        self._active_visits = 0
+        self._flight_lock = threading.Lock()
+        self._is_downloading = threading.Event()    # For visits started without a heartbeat's flag
+
+        # 'thread' or 'process', a process keeps SSH crypto off the GIL shared with serial and heartbeat
+        self.download_worker = os.getenv('DOWNLOAD_WORKER', 'thread')
+
+        # Keep each file once under its digest and hardlink it into flight directories (see `store.py`)
+        self.content_store = (os.getenv('CONTENT_STORE') == 'True')
+
+        # Fetch a thumbnail of every capture before any full file (see `SFTPClient.downloadPreviews`)
+        self.progressive = (os.getenv('PROGRESSIVE') == 'True')
+
+        # Choose SSH window, reads in flight and boot delay per station from its history (see `tuner.py`)
+        self.autotune = (os.getenv('AUTOTUNE') == 'True')
+
+        # Per-visit traces and the metrics registry are written here after each visit
+        if self.simulate:
+            self.trace_directory = None
+        else:
+            self.trace_directory = '/var/log/mission-mule-traces/'
+        self.last_trace = None
+        self.on_visit = None            # Called with each finished visit's trace, e.g. by the batch CLI (see `batch.py`)
+
+        self.scheduler = StationScheduler(self.db)
+        self.retention = RetentionManager(self.db, self.scheduler, self._local_root, self.clock)
+        self.ingest = IngestPipeline(self.db, self._local_root, _clock=self.clock)
+        self.tuner = TransferTuner(self.db)
+
+        # Stations woken ahead of arrival by a WAKE control message
+        self.woken = {}                 # Station ID -> monotonic time its POWER_ON was acknowledged
+        self.group_wake_timeout_s = 10  # Stations that don't answer are woken on arrival instead
+        self.woken_expiry_s = 600       # After this long a station is woken again on arrival
+
+        self.profiler = profiler
+
+        # Control message keyword -> handler taking the rest of the message
+        self.control_handlers = {
+            'PLAN': self._send_plan,
+            'WAKE': self._wake_group,
+            'PROFILE': self._profile,
+            'SPACE': self._send_space,
+        }
+
+    @property
+    def local_root(self):
+        """Local root data directory override, otherwise SFTPClient default"""
+        return self._local_root
+
+    @local_root.setter
+    def local_root(self, local_root):
+        # Retention and ingest work on the same tree as the downloads
+        self._local_root = local_root
+        self.retention.local_root = local_root or SFTPClient.LOCAL_ROOT_DATA_DIRECTORY
+        self.ingest.local_root = local_root or SFTPClient.LOCAL_ROOT_DATA_DIRECTORY
+
     def connect(self):
         self.xbee.connect()
 
@@ -47,7 +144,7 @@ class DataStationHandler(object):
             if not self.rx_queue.empty():    # You've got mail!
                 self._wake_download_and_sleep(rx_lock, is_downloading)
             else:
-                time.sleep(1)   # Check RX queue again in 1 second
+                self.clock.sleep(1)   # Check RX queue again in 1 second
 
         logging.error("Data station handler terminated")
 
@@ -55,52 +152,325 @@ class DataStationHandler(object):
         logging.info("Stopping data station handler...")
         self._alive = False
 
-    def _wake_download_and_sleep(self, rx_lock, is_downloading):
+    def send(self, message):
+        """Queue a text message to the autopilot (priority 1, below heartbeat)"""
 
-        # Update system status (used by heartbeat)
-        is_downloading.set()
+        if self.tx_queue is None:
+            logging.warning("No TX queue, dropping message: %s", message)
+            return
+
+        self.tx_queue.put((1, (message + '\n').encode('utf-8')))
+
+    def _command(self, data_station_id, command, timeout_s, trace):
+        """Send an XBee command until it's acknowledged and learn the station's ACK latency"""
+
+        result = self.xbee.command(data_station_id, command, timeout_s,
+                                   self.db.get_ack_latency(data_station_id), trace)
+        self._learn_ack_latency(data_station_id, result)
+        return result.acknowledged
+
+    def _learn_ack_latency(self, data_station_id, result):
+        """Folds a command's ACK latency into the station's average, only when the first send was answered
+
+        After a resend there is no telling which send the ACK answers, so its
+        latency would be either inflated or, worse, too short and bring
+        resends forward.
+        """
+
+        if result.acknowledged and result.attempts == 1:
+            self.db.update_ack_latency(data_station_id, result.latency_s)
+
+    def _handle_control_message(self, message):
+        """Dispatches a control message, returns False if it isn't one"""
+
+        keyword, _, arguments = message.partition(' ')
+        handler = self.control_handlers.get(keyword.upper())
+
+        if handler is None:
+            return False
+
+        logging.info("Control message: %s", message)
+        try:
+            handler(arguments.strip())
+        except Exception as e:
+            logging.error("Control message %s failed: %s", keyword, e)
+
+        return True
+
+    def _wake_group(self, arguments):
+        """Answers 'WAKE 101,102,...' with 'WAKE <acknowledged station IDs>'
+
+        Sends POWER_ON to all stations in one burst so a cluster of nearby
+        stations boots in parallel while the aircraft works through them.
+        Stations that acknowledge skip the wakeup on arrival.
+        """
+
+        data_station_ids = [i.strip() for i in arguments.split(',') if i.strip()]
+
+        if self.simulate:
+            self.xbee.send_group(data_station_ids, 'POWER_ON')
+            woken = data_station_ids
+        else:
+            latencies = [self.db.get_ack_latency(i) for i in data_station_ids]
+            latencies = [l for l in latencies if l is not None]
+
+            results = self.xbee.command_group(data_station_ids, 'POWER_ON', self.group_wake_timeout_s,
+                                              max(latencies) if latencies else None)
+
+            woken = [i for i in data_station_ids if results[i].acknowledged]
+            for i in woken:
+                self._learn_ack_latency(i, results[i])
+
+        now = self.clock.monotonic()
+        with self._sessions_changed:    # Sessions take stations out as they arrive
+            for i in woken:
+                self.woken[i] = now
+
+        logging.info("Group wake: %d of %d stations acknowledged", len(woken), len(data_station_ids))
+        self.send('WAKE %s' % ','.join(woken))
+
+    def _profile(self, arguments):
+        """'PROFILE [seconds]' starts the sampling profiler, 'PROFILE STOP' stops it
+
+        Answers 'PROFILE STARTED', 'PROFILE RUNNING' (already started) or
+        'PROFILE STOPPED'.
+        """
+
+        if arguments.upper() == 'STOP':
+            self.profiler.stop()
+            self.send('PROFILE STOPPED')
+        elif self.profiler.start(float(arguments) if arguments else None):
+            self.send('PROFILE STARTED')
+        else:
+            self.send('PROFILE RUNNING')
+
+    def _send_space(self, arguments):
+        """Answers 'SPACE [101,102,...]' with 'SPACE free=<MB> evictable=<MB> expected=<MB> margin=<MB>'
+
+        Expected data is for the listed stations, or every known station. A
+        negative margin means the mission will run out of disk even after
+        evicting every exported flight.
+        """
+
+        data_station_ids = [i.strip() for i in arguments.split(',') if i.strip()] or None
+        forecast = self.retention.forecast(data_station_ids)
+
+        if forecast.margin_mb < 0:
+            logging.warning("Space forecast: %.0f MB short for the next mission", -forecast.margin_mb)
+
+        self.send('SPACE free=%d evictable=%d expected=%d margin=%d' % forecast)
+
+    def _send_plan(self, arguments):
+        """Answers 'PLAN 101,102,...' with 'PLAN 102:240,101:180,...'
+
+        Station IDs are reordered by expected data per hover second, each
+        with its recommended hover duration in seconds.
+        """
+
+        data_station_ids = [i.strip() for i in arguments.split(',') if i.strip()]
+        plan = self.scheduler.plan(data_station_ids)
+
+        self.send('PLAN ' + ','.join('%s:%d' % (station_id, hover_s) for station_id, hover_s in plan))
+
+    def _wake_download_and_sleep(self, rx_lock, is_downloading):
 
         # Get data station ID as message from rx_queue
         rx_lock.acquire()
-        data_station_id = self.rx_queue.get().strip() # Removes invisible characters
+        message = self.rx_queue.get().strip() # Removes invisible characters
         rx_lock.release()
 
-        # Only add a flight when a data station is actually downloaded
-        if self.flight_id == None:
-            self.flight_id = self.db.insert_new_flight()
+        # Mark task as complete once handled, even if it fails
+        self.handle_message(message, is_downloading, self.rx_queue.task_done)
+
+    def handle_message(self, message, is_downloading=None, done=None):
+        """Handles a message from the autopilot: a control message, or the arrival at a data station"""
+
+        if self._handle_control_message(message):
+            if done is not None:
+                done()
+            return
+
+        self.visit(message, is_downloading, done)
+
+    def visit(self, data_station_id, is_downloading=None, done=None):
+        """Wakes, downloads and shuts down a data station, as on arrival in flight
+
+        With `max_sessions` above one the visit is queued for a session and
+        this returns straight away (see `wait_for_sessions`). `done` is called
+        once the visit is over or turned away. `is_downloading` is set while
+        any visit is in progress.
+        """
+
+        is_downloading = is_downloading or self._is_downloading
+
+        if self.max_sessions > 1:
+            self._start_session(data_station_id, is_downloading, done)
+            return
+
+        try:
+            self._visit(data_station_id, is_downloading)
+        finally:
+            if done is not None:
+                done()
+
+    def visit_all(self, data_station_ids, is_downloading=None, timeout_s=None):
+        """Visits data stations in order, `max_sessions` at once, and waits for every visit to finish
+
+        Returns False if `timeout_s` passed first.
+        """
+
+        for data_station_id in data_station_ids:
+            self.visit(data_station_id, is_downloading)
+        return self.wait_for_sessions(timeout_s)
+
+    def _start_session(self, data_station_id, is_downloading, done):
+        """Queues an arrival for a session thread, starting one if fewer than `max_sessions` run
+
+        Returns straight away, so the RX loop keeps answering control messages
+        and queueing arrivals while every session is busy. A session thread
+        takes queued arrivals in order until there are none left.
+        """
+
+        with self._sessions_changed:
+            if not self._alive:
+                logging.warning('Handler stopped, ignoring arrival at data station %s', data_station_id)
+                if done is not None:
+                    done()
+                return
+
+            if data_station_id in self.sessions or any(i == data_station_id for i, _ in self._arrivals):
+                logging.warning('Data station %s is already being downloaded, ignoring arrival', data_station_id)
+                if done is not None:
+                    done()
+                return
+
+            self._arrivals.append((data_station_id, done))
+
+            if self._session_threads >= self.max_sessions:
+                logging.info('Data station %s waits for a free session (%d running)', data_station_id, self._session_threads)
+                return
+
+            self._session_threads += 1
+            thread = threading.Thread(target=self._run_sessions, args=(is_downloading,),
+                                      name='Station Session %d' % self._session_threads)
+            thread.daemon = True
+
+        thread.start()
+
+    def _run_sessions(self, is_downloading):
+        """Session thread: visits queued arrivals until there are none left, or the handler stops"""
+
+        while True:
+            with self._sessions_changed:
+                if not self._alive:
+                    # Arrivals that will never be visited still count as handled
+                    for _, done in self._arrivals:
+                        if done is not None:
+                            done()
+                    self._arrivals.clear()
+
+                if not self._arrivals:
+                    self._session_threads -= 1
+                    self._sessions_changed.notify_all()
+                    return
+
+                data_station_id, done = self._arrivals.popleft()
+                self.sessions[data_station_id] = threading.current_thread()
+
+            logging.info('Session started for data station %s (%d running)', data_station_id, len(self.sessions))
+            try:
+                self._visit(data_station_id, is_downloading)
+            except Exception as e:
+                logging.error('Session for data station %s failed: %s', data_station_id, e)
+            finally:
+                with self._sessions_changed:
+                    del self.sessions[data_station_id]
+                    self._sessions_changed.notify_all()
+                if done is not None:
+                    done()
+
+    def wait_for_sessions(self, timeout_s=None):
+        """Waits for every queued arrival to be visited, returns False if `timeout_s` passed first"""
+
+        with self._sessions_changed:
+            return self._sessions_changed.wait_for(lambda: not self._session_threads, timeout_s)
+
+    def _set_downloading(self, is_downloading, delta):
+        """Counts visits in progress, the heartbeat shows downloading while there is any"""
+
+        with self._sessions_changed:
+            self._active_visits += delta
+            if self._active_visits:
+                is_downloading.set()
+            else:
+                is_downloading.clear() # Analagous to is_downloading = False
+
+    def _visit(self, data_station_id, is_downloading):
+
+        # Update system status (used by heartbeat)
+        self._set_downloading(is_downloading, 1)
+        try:
+            self._visit_station(data_station_id)
+        finally:
+            self._set_downloading(is_downloading, -1)
+
+    def _visit_station(self, data_station_id):
+        """Wakes, downloads and shuts down a data station and records the visit"""
+
+        # Only add a flight when a data station is actually downloaded. Data
+        # downloaded after the ground station took a flight belongs to a new one.
+        with self._flight_lock:
+            if self.flight_id == None or self.db.is_flight_exported(self.flight_id):
+                self.flight_id = self.db.insert_new_flight()
+            flight_id = self.flight_id
 
         self.db.insert_data_station(data_station_id)
 
-        self.db.add_station_to_flight(data_station_id, self.flight_id)
+        self.db.add_station_to_flight(data_station_id, flight_id)
 
         # Add the station to flights_stations table to pair with flight with percent 0.
         self._redownload_request = False # [ get redownload status from database for this ID ]
 
         logging.info('Data station arrival: %s', data_station_id)
 
-        # Wake up data station
-        logging.info('Waking up over XBee...')
-        self.xbee.send_command(data_station_id, 'POWER_ON')
-
-        xbee_wake_command_timer = Timer()
-        wakeup_successful = True
+        source = self.station_sources.get(data_station_id)
+        trace = Trace('flight_%s_station_%s_%d' % (flight_id, data_station_id, self.clock.time()), self.clock,
+                      flight_id=flight_id, station_id=data_station_id, source=source, sessions=len(self.sessions))
+        visit_span = trace.span('visit')
 
         wakeup_timeout_s = self.db.get_timeout('wakeup')*60
         logging.debug("Wakeup timeout: %s s", wakeup_timeout_s)
 
-        if not (os.getenv('TESTING') == 'True'):
-            while not self.xbee.acknowledge(data_station_id, 'POWER_ON'):
-                wakeup_time_s = xbee_wake_command_timer.time_elapsed()
-                logging.debug("POWER_ON data station %s", data_station_id)
-                self.xbee.send_command(data_station_id, 'POWER_ON')
-                time.sleep(1) # Try again in 1.5s --> this gives 2-3 attempts in 5s listening window
+        # Wake up data station
+        wakeup_span = trace.span('wakeup')
 
-                # Will try shutting down data station over XBee for 2 min before moving on
-                if xbee_wake_command_timer.time_elapsed() > wakeup_timeout_s:
-                    wakeup_successful = False
-                    logging.error("POWER_ON command ACK failure. Moving on...")
-                    break
+        wakeup_successful = True
 
+        transfer_settings = None
+        if self.autotune and not self.simulate:
+            transfer_settings = self.tuner.choose(data_station_id)
+            logging.info('Transfer settings: %s', transfer_settings)
+
+        full_boot_delay_s = self.boot_delay_s * (transfer_settings.boot_delay_share if transfer_settings else 1)
+        boot_delay_s = full_boot_delay_s
+
+        with self._sessions_changed:
+            woken_at = self.woken.pop(data_station_id, None)
+        if woken_at is not None and self.clock.monotonic() - woken_at < self.woken_expiry_s:
+            # Already booting (or booted) since a group wake, only wait out the rest of the boot
+            boot_delay_s = max(0, full_boot_delay_s - (self.clock.monotonic() - woken_at))
+            logging.info('Data station %s woken %.0f s ago, skipping wakeup', data_station_id, self.clock.monotonic() - woken_at)
+        elif self.simulate:
+            logging.info('Waking up over XBee...')
+            self.xbee.send_command(data_station_id, 'POWER_ON', trace)
+        else:
+            logging.info('Waking up over XBee...')
+            # Resends are timed from the station's usual ACK latency, with backoff
+            wakeup_successful = self._command(data_station_id, 'POWER_ON', wakeup_timeout_s, trace)
+            if not wakeup_successful:
+                logging.error("POWER_ON command ACK failure. Moving on...")
+
+        wakeup_time_s = wakeup_span.finish()
         logging.debug("Total wakeup time: %s", wakeup_time_s)
 
         did_connect = False
@@ -113,11 +483,12 @@ class DataStationHandler(object):
         download_time_s = 0
 
         # Don't actually download
-        if (os.getenv('TESTING') == 'True'):
+        if self.simulate:
             r = random.randint(10,20)
 
             logging.debug('Simulating download for %i seconds', r)
-            time.sleep(r) # "Download" for random time between 10 and 100 seconds
+            with trace.span('transfer'):
+                self.clock.sleep(r) # "Download" for random time between 10 and 100 seconds
 
         # Only try download if wakeup was successful
         elif (wakeup_successful): # This is the real world (ahhh!)
@@ -130,13 +501,39 @@ class DataStationHandler(object):
             download_over = threading.Event()
 
             connection_timeout_s = self.db.get_timeout('connection')*60
+            transfer_order, byte_quota_mb = self.db.get_transfer_policy(data_station_id)
+            logging.debug("Transfer order: %s, byte quota: %s MB", transfer_order, byte_quota_mb)
 
-            download_worker = Download(data_station_id.strip()+'.local',
-                                       redownload_request,
-                                       self.flight_id,
-                                       connection_timeout_s,
-                                       timeout_event,
-                                       download_over)
+            address, port = self.station_addresses.get(data_station_id, (None, None))
+
+            if self.download_worker == 'process':
+                worker_class = DownloadProcess
+            else:
+                worker_class = Download
+
+            # This session's part of the bandwidth, counts what it transfers
+            budget = self.bandwidth.session(data_station_id)
+
+            download_worker = worker_class(data_station_id.strip()+'.local',
+                                           redownload_request,
+                                           flight_id,
+                                           connection_timeout_s,
+                                           timeout_event,
+                                           download_over,
+                                           transfer_order,
+                                           byte_quota_mb,
+                                           boot_delay_s,
+                                           address,
+                                           port,
+                                           self.local_root,
+                                           trace,
+                                           _clock=self.clock,
+                                           _log_budget_s=self.log_share * self.db.get_timeout('download') * 60,
+                                           _content_store=self.content_store,
+                                           _progressive=self.progressive,
+                                           _transfer_settings=transfer_settings,
+                                           _source=source,
+                                           _throttle=budget.consume)
 
             try:
                 # This throws an error if the connection times out
@@ -149,7 +546,7 @@ class DataStationHandler(object):
 
                 download_worker.join(download_timeout_s)
 
-                timeout_event.set()
+                download_worker.cancel()
 
                 # Waits (at most 10s) for download_worker to unset this Event
                 # signalling that the download has gracefully shut down
@@ -165,6 +562,19 @@ class DataStationHandler(object):
                 connection_time_s = download_worker.connection_time_s
                 download_time_s = download_worker.download_time_s
 
+                if download_worker.downloaded_files:
+                    self.db.insert_files(data_station_id, flight_id, list(download_worker.downloaded_files))
+
+                if download_worker.previewed_files:
+                    self.db.insert_previews(data_station_id, flight_id, list(download_worker.previewed_files))
+
+                # Visits without field data say nothing about the settings
+                transfer_time_s = connection_time_s + download_time_s
+                if transfer_settings is not None and total_data_downloaded_mb > 0 and transfer_time_s > 0:
+                    throughput_mbps = total_data_downloaded_mb * 8 / transfer_time_s
+                    self.tuner.record(data_station_id, flight_id, transfer_settings, throughput_mbps)
+                    logging.info('Tuned visit throughput: %.2f Mbps', throughput_mbps)
+
                 if download_worker.is_alive():
                     logging.info("Download timeout: Download cancelled")
                 else:
@@ -174,12 +584,17 @@ class DataStationHandler(object):
 
             except Exception as e:
                 logging.error(e)
+            finally:
+                budget.close()
+
+            if budget.wait_s:
+                trace.count('session_throttle_seconds', budget.wait_s)
+                logging.info('Session held back %.1f s to share bandwidth', budget.wait_s)
 
         # Wake up data station
         logging.info('Shutting down data station %s...', data_station_id)
-        self.xbee.send_command(data_station_id, 'POWER_OFF')
+        shutdown_span = trace.span('shutdown')
 
-        xbee_sleep_command_timer = Timer()
         shutdown_successful = True
 
         # Edge case where no wakeup happened, we don't want shutdown to be shown as successful
@@ -189,23 +604,17 @@ class DataStationHandler(object):
         logging.debug("Shutdown timeout: %s s", shutdown_timeout_s)
 
         # If the data station actually turned on and we're not in test mode, shut it down
-        if not (os.getenv('TESTING') == 'True') and (wakeup_successful == True):
-            while not self.xbee.acknowledge(data_station_id, 'POWER_OFF'):
-                logging.debug("POWER_OFF data station %s", data_station_id)
-                self.xbee.send_command(data_station_id, 'POWER_OFF')
-                time.sleep(1) # Try again in 0.5s
-
-                # Will try shutting down data station over XBee for 60 seconds before moving on
-                if xbee_sleep_command_timer.time_elapsed() > shutdown_timeout_s:
-                    logging.error("POWER_OFF command ACK failure. Moving on...")
-                    shutdown_successful = False
-                    break
-
-        shutdown_time_s = xbee_sleep_command_timer.time_elapsed()
+        if self.simulate or (wakeup_successful == False):
+            self.xbee.send_command(data_station_id, 'POWER_OFF', trace)
+        elif not self._command(data_station_id, 'POWER_OFF', shutdown_timeout_s, trace):
+            logging.error("POWER_OFF command ACK failure. Moving on...")
+            shutdown_successful = False
+
+        shutdown_time_s = shutdown_span.finish()
         logging.debug("Total shutdown time: %s", shutdown_time_s)
 
         self.db.update_flight_station_stats(data_station_id,
-            self.flight_id,
+            flight_id,
             successful_downloads,
             total_files,
             wakeup_successful,
@@ -218,8 +627,25 @@ class DataStationHandler(object):
             connection_time_s,
             download_time_s,
             shutdown_time_s)
-        # Mark task as complete, even if it fails
-        self.rx_queue.task_done()
 
-        # Update system status (for heartbeat)
-        is_downloading.clear() # Analagous to is_downloading = False
+        visit_span.finish()
+        self._record_trace(trace)
+
+    def _record_trace(self, trace):
+        """Fold a finished visit trace into the metrics registry and write it out"""
+
+        registry.record(trace)
+        self.last_trace = trace
+
+        for span in trace.spans:
+            logging.debug("Phase %s: %.3f s", span.name, span.duration or 0)
+
+        if self.trace_directory is not None:
+            trace.write(self.trace_directory)
+            try:
+                registry.write(os.path.join(self.trace_directory, 'metrics.prom'))
+            except (IOError, OSError) as e:
+                logging.error("Failed to write metrics: %s", e)
+
+        if self.on_visit is not None:
+            self.on_visit(trace)
@@ -1,25 +1,68 @@
+import json
 import logging
 import os
 import time
 import sqlite3
 
+from ..clock import SystemClock
+
 class Database(object):
 
-    def __init__(self):
+    def __init__(self, _db_path=None, _clock=None):
         # Instead of instantiating a global connection here, we create and destroy
         # a database connection with each call because SQLite is just reading/editing
         # a local file so we don't need a persistent connection.
         # ...It also simplifies things. :)
 
-        if not (os.getenv('TESTING') == 'True'):
+        if _db_path is not None:
+            self.db_path = _db_path
+        elif not (os.getenv('TESTING') == 'True'):
             self.db_path = '/var/lib/avionics.db';
         else:
             self.db_path = 'avionics.db';
 
-        # Ensure that the database exists and the full schema is there
-        conn = sqlite3.connect(self.db_path);
+        # Timestamps come from the clock rather than SQLite's 'now' so simulated missions can span days
+        self.clock = _clock or SystemClock()
+
+        # Ensure that the database exists and upgrade it in place to the current schema
+        self._migrate()
+
+    # Each schema change is a `_migration_<version>` method, applied once in
+    # order and recorded in `PRAGMA user_version`. Add new changes as a new
+    # migration, never edit one that has shipped.
+    SCHEMA_VERSION = 6
+
+    def _migrate(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.isolation_level = None  # Transactions are managed here so each migration is all or nothing
         c = conn.cursor()
 
+        try:
+            version = c.execute('PRAGMA user_version').fetchone()[0]
+
+            for target in range(version + 1, self.SCHEMA_VERSION + 1):
+                logging.info("Migrating database %s to schema version %d", self.db_path, target)
+
+                c.execute('BEGIN IMMEDIATE')
+                try:
+                    # Another process may have migrated while we waited for the lock
+                    if c.execute('PRAGMA user_version').fetchone()[0] >= target:
+                        c.execute('ROLLBACK')
+                        continue
+
+                    getattr(self, '_migration_%d' % target)(c)
+                    c.execute('PRAGMA user_version = %d' % target)
+                    c.execute('COMMIT')
+                except Exception:
+                    c.execute('ROLLBACK')
+                    raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _migration_1(c):
+        """Schema before versioning, columns were added on the fly so older files may lack some"""
+
         c.execute('''CREATE TABLE IF NOT EXISTS
                      flights(flight_id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME)''')
 
@@ -29,11 +72,134 @@ class Database(object):
         c.execute('''CREATE TABLE IF NOT EXISTS
                      flights_stations(flight_id INTEGER, station_id INTEGER, successful_downloads INTEGER, total_files INTEGER, total_data_downloaded_mb FLOAT, download_speed_mbps FLOAT, did_wake_up_ack INTEGER, did_connect INTEGER, did_find_device INTEGER, did_shutdown_ack INTEGER, wakeup_time_s INTEGER, connection_time_s INTEGER, download_time_s INTEGER, shutdown_time_s INTEGER)''')
 
+        # Per-station transfer policy (see `ordering.py`)
+        Database._add_column(c, 'stations', 'transfer_order', "TEXT DEFAULT 'listing'")
+        Database._add_column(c, 'stations', 'byte_quota_mb', 'FLOAT')
+
+        # Smoothed XBee send-to-ACK latency, used to time command retries
+        Database._add_column(c, 'stations', 'ack_latency_s', 'FLOAT')
+
+        # Retention: a flight's local data may only be evicted once the ground station confirmed the export
+        Database._add_column(c, 'flights', 'exported_at', 'DATETIME')
+        Database._add_column(c, 'flights', 'evicted_at', 'DATETIME')
+
         c.execute('''CREATE TABLE IF NOT EXISTS timeouts(timeout_id TEXT PRIMARY KEY, time_in_min INTEGER)''')
         c.execute('''INSERT OR IGNORE INTO timeouts (timeout_id, time_in_min) VALUES ('wakeup', 4), ('connection', 4), ('download', 10), ('shutdown', 2)''')
 
-        conn.commit()
-        conn.close()
+    @staticmethod
+    def _migration_2(c):
+        """Key `flights_stations` on (flight_id, station_id), store times as REAL and index lookups
+
+        Without a key every statistics update and history query scanned all
+        visits ever made. Repeat visits to a station on one flight used to add
+        duplicate rows that were updated together, only the latest is kept.
+        """
+
+        c.execute('''CREATE TABLE flights_stations_v2(
+                         flight_id INTEGER NOT NULL,
+                         station_id INTEGER NOT NULL,
+                         successful_downloads INTEGER,
+                         total_files INTEGER,
+                         total_data_downloaded_mb REAL,
+                         download_speed_mbps REAL,
+                         did_wake_up_ack INTEGER,
+                         did_connect INTEGER,
+                         did_find_device INTEGER,
+                         did_shutdown_ack INTEGER,
+                         wakeup_time_s REAL,
+                         connection_time_s REAL,
+                         download_time_s REAL,
+                         shutdown_time_s REAL,
+                         PRIMARY KEY (flight_id, station_id))''')
+
+        c.execute('''INSERT INTO flights_stations_v2
+                     SELECT flight_id, station_id, successful_downloads, total_files, total_data_downloaded_mb, download_speed_mbps, did_wake_up_ack, did_connect, did_find_device, did_shutdown_ack, wakeup_time_s, connection_time_s, download_time_s, shutdown_time_s
+                     FROM flights_stations
+                     WHERE rowid IN (SELECT max(rowid) FROM flights_stations GROUP BY flight_id, station_id)''')
+
+        c.execute('DROP TABLE flights_stations')
+        c.execute('ALTER TABLE flights_stations_v2 RENAME TO flights_stations')
+
+        # Per-station history (scheduler) and days since last visit
+        c.execute('CREATE INDEX IF NOT EXISTS flights_stations_station ON flights_stations(station_id, flight_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS stations_last_visited ON stations(last_visited)')
+
+    @staticmethod
+    def _migration_3(c):
+        """Index of files kept in the content store (see `store.py`)"""
+
+        c.execute('''CREATE TABLE files(
+                         flight_id INTEGER NOT NULL,
+                         station_id INTEGER NOT NULL,
+                         remote_path TEXT NOT NULL,
+                         digest TEXT NOT NULL,
+                         size INTEGER,
+                         PRIMARY KEY (flight_id, station_id, remote_path))''')
+
+        c.execute('CREATE INDEX files_digest ON files(digest)')
+
+    @staticmethod
+    def _migration_4(c):
+        """Record every downloaded file with its local path, flight directories now mirror the station
+
+        Files used to be stored flat under their name, which is what
+        existing rows get as their local path.
+        """
+
+        c.execute('''CREATE TABLE files_v4(
+                         flight_id INTEGER NOT NULL,
+                         station_id INTEGER NOT NULL,
+                         remote_path TEXT NOT NULL,
+                         local_path TEXT NOT NULL,
+                         digest TEXT,
+                         size INTEGER,
+                         PRIMARY KEY (flight_id, station_id, remote_path),
+                         UNIQUE (flight_id, station_id, local_path))''')
+
+        c.connection.create_function('basename', 1, os.path.basename)
+        c.execute('''INSERT OR REPLACE INTO files_v4 (flight_id, station_id, remote_path, local_path, digest, size)
+                     SELECT flight_id, station_id, remote_path, basename(remote_path), digest, size
+                     FROM files''')
+
+        c.execute('DROP TABLE files')
+        c.execute('ALTER TABLE files_v4 RENAME TO files')
+        c.execute('CREATE INDEX files_digest ON files(digest)')
+
+    @staticmethod
+    def _migration_5(c):
+        """EXIF metadata and thumbnails of downloaded files (see `ingest.py`)"""
+
+        c.execute('ALTER TABLE files ADD COLUMN captured_at TEXT')
+        c.execute('ALTER TABLE files ADD COLUMN camera_id TEXT')
+        c.execute('ALTER TABLE files ADD COLUMN thumbnail_size INTEGER')
+        c.execute('ALTER TABLE files ADD COLUMN ingested_at DATETIME')
+
+        # Only the few files waiting for ingest are indexed
+        c.execute('CREATE INDEX files_pending ON files(flight_id, station_id) WHERE ingested_at IS NULL')
+
+    @staticmethod
+    def _migration_6(c):
+        """Settings and throughput of every tuned visit (see `tuner.py`)
+
+        Settings are a JSON object so candidates can be added without a migration.
+        """
+
+        c.execute('''CREATE TABLE transfer_tuning(
+                         flight_id INTEGER NOT NULL,
+                         station_id INTEGER NOT NULL,
+                         settings TEXT NOT NULL,
+                         throughput_mbps REAL NOT NULL,
+                         PRIMARY KEY (flight_id, station_id))''')
+
+        c.execute('CREATE INDEX transfer_tuning_station ON transfer_tuning(station_id, flight_id)')
+
+    @staticmethod
+    def _add_column(c, table, column, definition):
+        """Adds a column to an existing table if it isn't there yet"""
+
+        c.execute('PRAGMA table_info(%s)' % table)
+        if column not in [row[1] for row in c.fetchall()]:
+            c.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
 
     def insert_data_station(self, data_station_id):
         """Inserts a data station into the database
@@ -46,15 +212,16 @@ class Database(object):
         c = conn.cursor()
 
         id = (int(data_station_id),)
+        now = self.clock.time()
         c.execute('SELECT 1 FROM stations WHERE station_id=? LIMIT 1', id)
 
         if c.fetchone() is not None: # If the station already exists, just update timestamp
             c.execute('''UPDATE stations
-                         SET last_visited=datetime('now')
-                         WHERE station_id=?''', id)
+                         SET last_visited=datetime(?, 'unixepoch')
+                         WHERE station_id=?''', (now,) + id)
         else: # Otherwise, add the station
             c.execute('''INSERT INTO stations (station_id, last_visited, redownload)
-                         VALUES (?, datetime('now'), 0)''', id)
+                         VALUES (?, datetime(?, 'unixepoch'), 0)''', id + (now,))
 
         conn.commit()
         conn.close()
@@ -66,7 +233,7 @@ class Database(object):
         c = conn.cursor()
 
         c.execute('''INSERT INTO flights (timestamp)
-                     VALUES (datetime('now'))''')
+                     VALUES (datetime(?, 'unixepoch'))''', (self.clock.time(),))
 
         flight_id = c.lastrowid
 
@@ -87,7 +254,8 @@ class Database(object):
 
         item = (int(flight_id), int(data_station_id),)
 
-        c.execute('''INSERT INTO flights_stations (flight_id, station_id, successful_downloads, total_files, did_wake_up_ack, did_connect, did_find_device, did_shutdown_ack, total_data_downloaded_mb, download_speed_mbps, wakeup_time_s, connection_time_s, download_time_s, shutdown_time_s)
+        # A repeat visit on the same flight starts its statistics over
+        c.execute('''INSERT OR REPLACE INTO flights_stations (flight_id, station_id, successful_downloads, total_files, did_wake_up_ack, did_connect, did_find_device, did_shutdown_ack, total_data_downloaded_mb, download_speed_mbps, wakeup_time_s, connection_time_s, download_time_s, shutdown_time_s)
                      VALUES (?, ?, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)''', item)
 
         conn.commit()
@@ -129,6 +297,61 @@ class Database(object):
 
         return redownload
 
+    def get_transfer_policy(self, data_station_id):
+        """Returns (transfer order, byte quota in MB) for specific data station
+
+        A byte quota of None means the transfer is only bounded by the download
+        timeout.
+        """
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        item = (data_station_id,)
+
+        c.execute('''SELECT transfer_order, byte_quota_mb
+                     FROM stations
+                     WHERE station_id=?
+                     LIMIT 1''', item)
+
+        row = c.fetchone()
+
+        conn.close()
+
+        if row is None:
+            return 'listing', None
+
+        transfer_order, byte_quota_mb = row
+
+        return (transfer_order or 'listing'), byte_quota_mb
+
+    def get_ack_latency(self, data_station_id):
+        """Returns the smoothed XBee ACK latency in seconds, or None if never measured"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('SELECT ack_latency_s FROM stations WHERE station_id=? LIMIT 1', (data_station_id,))
+        row = c.fetchone()
+
+        conn.close()
+
+        return row[0] if row is not None else None
+
+    def update_ack_latency(self, data_station_id, latency_s, weight=0.3):
+        """Folds a measured XBee ACK latency into the station's moving average"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''UPDATE stations
+                     SET ack_latency_s = CASE WHEN ack_latency_s IS NULL THEN ?
+                                              ELSE ack_latency_s * (1 - ?) + ? * ? END
+                     WHERE station_id=?''', (latency_s, weight, weight, latency_s, data_station_id))
+
+        conn.commit()
+        conn.close()
+
     def get_timeout(self, timeout_id):
         """Returns wakeup timeout"""
         conn = sqlite3.connect(self.db_path)
@@ -142,3 +365,355 @@ class Database(object):
         time_in_min = int(c.fetchone()[0])
 
         return time_in_min
+
+    def get_flight_station_stats(self, data_station_id, flight_id):
+        """Returns the visit statistics for a data station on a flight as a dictionary"""
+
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        item = (int(data_station_id), int(flight_id),)
+
+        c.execute('''SELECT *
+                     FROM flights_stations
+                     WHERE (station_id=? AND flight_id=?)
+                     LIMIT 1''', item)
+
+        row = c.fetchone()
+
+        conn.close()
+
+        if row is None:
+            return None
+
+        return dict(row)
+
+    def get_station_history(self, data_station_id, limit=10):
+        """Returns the most recent visits to a data station, newest first
+
+        Each visit is a dictionary of its `flights_stations` statistics plus
+        `visited_day`, the flight time as a Julian day number.
+        """
+
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        item = (int(data_station_id), limit,)
+
+        c.execute('''SELECT fs.*, julianday(f.timestamp) AS visited_day
+                     FROM flights_stations fs
+                     JOIN flights f ON f.flight_id = fs.flight_id
+                     WHERE fs.station_id=? AND fs.did_wake_up_ack=1
+                     ORDER BY f.timestamp DESC, fs.flight_id DESC
+                     LIMIT ?''', item)
+
+        rows = [dict(row) for row in c.fetchall()]
+
+        conn.close()
+
+        return rows
+
+    def get_days_since_visit(self, data_station_id):
+        """Returns days since the data station was last visited, or None if never visited"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        item = (self.clock.time(), int(data_station_id))
+
+        c.execute('''SELECT julianday(?, 'unixepoch') - julianday(last_visited)
+                     FROM stations
+                     WHERE station_id=?
+                     LIMIT 1''', item)
+
+        row = c.fetchone()
+
+        conn.close()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def get_flights(self):
+        """Returns every flight as a dictionary, newest first"""
+
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        c.execute('''SELECT flight_id, timestamp, exported_at, evicted_at
+                     FROM flights
+                     ORDER BY flight_id DESC''')
+
+        rows = [dict(row) for row in c.fetchall()]
+
+        conn.close()
+
+        return rows
+
+    def get_flight_stations(self, flight_id):
+        """Returns the `flights_stations` statistics of every station visited on a flight"""
+
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        c.execute('''SELECT *
+                     FROM flights_stations
+                     WHERE flight_id=?
+                     ORDER BY station_id''', (int(flight_id),))
+
+        rows = [dict(row) for row in c.fetchall()]
+
+        conn.close()
+
+        return rows
+
+    def get_station_ids(self):
+        """Returns the IDs of every data station ever visited"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('SELECT station_id FROM stations ORDER BY station_id')
+
+        ids = [str(row[0]) for row in c.fetchall()]
+
+        conn.close()
+
+        return ids
+
+    def mark_flight_exported(self, flight_id):
+        """Records that the ground station has verified a complete copy of the flight"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''UPDATE flights
+                     SET exported_at=datetime(?, 'unixepoch')
+                     WHERE flight_id=?''', (self.clock.time(), int(flight_id)))
+
+        conn.commit()
+        conn.close()
+
+    def is_flight_exported(self, flight_id):
+        """Returns True once the ground station has confirmed the flight's export"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT exported_at IS NOT NULL
+                     FROM flights
+                     WHERE flight_id=?
+                     LIMIT 1''', (int(flight_id),))
+
+        row = c.fetchone()
+
+        conn.close()
+
+        return bool(row and row[0])
+
+    def mark_flight_evicted(self, flight_id):
+        """Records that a flight's local data has been deleted"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''UPDATE flights
+                     SET evicted_at=datetime(?, 'unixepoch')
+                     WHERE flight_id=?''', (self.clock.time(), int(flight_id)))
+
+        conn.commit()
+        conn.close()
+
+    def get_evictable_flights(self):
+        """Returns the IDs of exported flights whose data is still on disk, oldest first"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT flight_id
+                     FROM flights
+                     WHERE exported_at IS NOT NULL AND evicted_at IS NULL
+                     ORDER BY flight_id''')
+
+        ids = [row[0] for row in c.fetchall()]
+
+        conn.close()
+
+        return ids
+
+    def insert_files(self, data_station_id, flight_id, files):
+        """Records the files downloaded on a visit, `files` is [(remote path, local path, digest, size)]
+
+        Local paths are relative to the station's flight directory, digests
+        are None unless the content store is used.
+        """
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        # A file redownloaded from .tmp replaces the row of its first download
+        c.executemany('''INSERT OR REPLACE INTO files (flight_id, station_id, remote_path, local_path, digest, size)
+                         VALUES (?, ?, ?, ?, ?, ?)''',
+                      [(int(flight_id), int(data_station_id), remote_path, local_path, digest, size)
+                       for remote_path, local_path, digest, size in files])
+
+        conn.commit()
+        conn.close()
+
+    def insert_previews(self, data_station_id, flight_id, files):
+        """Records files previewed in progressive mode, `files` is [(remote path, local path, captured at, camera ID, thumbnail size)]
+
+        Previews carry what ingest would find, so they are recorded as
+        ingested. Files also downloaded in full keep their download's row.
+        """
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        now = self.clock.time()
+        c.executemany('''INSERT OR IGNORE INTO files (flight_id, station_id, remote_path, local_path, captured_at, camera_id, thumbnail_size, ingested_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, datetime(?, 'unixepoch'))''',
+                      [(int(flight_id), int(data_station_id), remote_path, local_path, captured_at, camera_id, thumbnail_size, now)
+                       for remote_path, local_path, captured_at, camera_id, thumbnail_size in files])
+
+        conn.commit()
+        conn.close()
+
+    def get_local_paths(self, data_station_id, flight_id):
+        """Returns {remote path: local path} for the files downloaded from a station on a flight"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT remote_path, local_path
+                     FROM files
+                     WHERE flight_id=? AND station_id=?''', (int(flight_id), int(data_station_id)))
+
+        paths = dict(c.fetchall())
+
+        conn.close()
+
+        return paths
+
+    def get_file_digests(self, data_station_id, flight_id):
+        """Returns {local path: digest} for the files stored from a station on a flight"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT local_path, digest
+                     FROM files
+                     WHERE flight_id=? AND station_id=? AND digest IS NOT NULL''', (int(flight_id), int(data_station_id)))
+
+        digests = dict(c.fetchall())
+
+        conn.close()
+
+        return digests
+
+    def get_file_index(self, data_station_id, flight_id):
+        """Returns {local path: {digest, captured_at, camera_id, thumbnail_size}} for the files from a station on a flight"""
+
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        c.execute('''SELECT local_path, digest, captured_at, camera_id, thumbnail_size
+                     FROM files
+                     WHERE flight_id=? AND station_id=?''', (int(flight_id), int(data_station_id)))
+
+        index = dict((row['local_path'], dict(row)) for row in c.fetchall())
+        for entry in index.values():
+            del entry['local_path']
+
+        conn.close()
+
+        return index
+
+    def get_pending_ingest(self, limit):
+        """Returns up to `limit` (flight ID, station ID, local path) of files not ingested yet, oldest flights first"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT flight_id, station_id, local_path
+                     FROM files
+                     WHERE ingested_at IS NULL
+                     ORDER BY flight_id, station_id
+                     LIMIT ?''', (limit,))
+
+        rows = c.fetchall()
+
+        conn.close()
+
+        return rows
+
+    def update_file_metadata(self, files):
+        """Records ingested files, `files` is [(flight ID, station ID, local path, captured at, camera ID, thumbnail size)]"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        now = self.clock.time()
+        c.executemany('''UPDATE files
+                         SET captured_at=?, camera_id=?, thumbnail_size=?, ingested_at=datetime(?, 'unixepoch')
+                         WHERE flight_id=? AND station_id=? AND local_path=?''',
+                      [(captured_at, camera_id, thumbnail_size, now, int(flight_id), int(data_station_id), local_path)
+                       for flight_id, data_station_id, local_path, captured_at, camera_id, thumbnail_size in files])
+
+        conn.commit()
+        conn.close()
+
+    def get_file_locations(self, digest):
+        """Returns every (flight ID, station ID, remote path) a content digest was downloaded from"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT flight_id, station_id, remote_path
+                     FROM files
+                     WHERE digest=?
+                     ORDER BY flight_id, station_id''', (digest,))
+
+        rows = c.fetchall()
+
+        conn.close()
+
+        return rows
+
+    def insert_transfer_result(self, data_station_id, flight_id, settings, throughput_mbps):
+        """Records the transfer settings (a dictionary) a visit used and the throughput it achieved"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        # A second visit on the same flight replaces the first
+        c.execute('''INSERT OR REPLACE INTO transfer_tuning (flight_id, station_id, settings, throughput_mbps)
+                     VALUES (?, ?, ?, ?)''',
+                  (int(flight_id), int(data_station_id), json.dumps(settings, sort_keys=True), throughput_mbps))
+
+        conn.commit()
+        conn.close()
+
+    def get_transfer_results(self, data_station_id, limit=30):
+        """Returns [(settings dictionary, throughput in Mbps)] of a station's most recent tuned visits, newest first"""
+
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT settings, throughput_mbps
+                     FROM transfer_tuning
+                     WHERE station_id=?
+                     ORDER BY flight_id DESC
+                     LIMIT ?''', (int(data_station_id), limit))
+
+        rows = [(json.loads(settings), throughput_mbps) for settings, throughput_mbps in c.fetchall()]
+
+        conn.close()
+
+        return rows
@@ -1,10 +1,11 @@
 import logging
 import threading
-import time
 
 from .sftp import SFTPClient
-from .timer import Timer
 from .database import Database
+from .store import ContentStore
+from ..clock import SystemClock
+from ..metrics import Trace
 
 class Download(threading.Thread):
 
@@ -14,7 +15,10 @@ class Download(threading.Thread):
     and then exits when the download is complete.
     """
 
-    def __init__(self, _data_station_id, _redownload_request, _flight_id, _connection_timeout_s, _timeout_event, _download_over):
+    def __init__(self, _data_station_id, _redownload_request, _flight_id, _connection_timeout_s, _timeout_event, _download_over,
+        _transfer_order='listing', _byte_quota_mb=None, _boot_delay_s=40, _address=None, _port=None, _local_root=None,
+        _trace=None, _progress=None, _clock=None, _log_budget_s=0, _content_store=False, _progressive=False,
+        _transfer_settings=None, _source=None, _throttle=None):
 
         super(Download, self).__init__()
 
@@ -33,34 +37,52 @@ class Download(threading.Thread):
         self._redownload_request = _redownload_request
         self._flight_id = _flight_id
         self._connection_timeout_s = _connection_timeout_s
+        self._transfer_order = _transfer_order
+        self._byte_quota_mb = _byte_quota_mb
+        self._boot_delay_s = _boot_delay_s
+        self._log_budget_s = _log_budget_s     # Longest time spent collecting station logs after field data
+        self._progressive = _progressive       # Thumbnails of every file before any full file
+        self._clock = _clock or SystemClock()
+        self._trace = _trace or Trace('download', self._clock)
+
+        store = None
+        if _content_store:
+            store = ContentStore(_local_root or SFTPClient.LOCAL_ROOT_DATA_DIRECTORY)
 
         # TODO: pull from private file
-        self._sftp = SFTPClient('pi', 'raspberry', self._data_station_id, self._flight_id, self._timeout_event)
+        self._sftp = SFTPClient('pi', 'raspberry', self._data_station_id, self._flight_id, self._timeout_event,
+                                _address, _port, _local_root, self._trace, _progress, store, _transfer_settings,
+                                _source, _throttle, self._clock)
+        self.downloaded_files = self._sftp.downloaded_files     # Local path, and digest with the content store, per file
+        self.previewed_files = self._sftp.previewed_files       # Metadata and thumbnail size per file previewed
 
     def _connect(self):
         # Try to connect until SFTP client is connected or timeout event happens
-        data_station_connection_timer = Timer()
+        # Connection time includes the boot delay and the successful attempt
+        connect_span = self._trace.span('connect')
 
-        delay = 40 # Delay before connecing to data station
+        delay = self._boot_delay_s # Delay before connecing to data station
         logging.info("Waiting %s s for station to boot", delay)
-        time.sleep(delay) # Wait for data station to boot
+        with self._trace.span('boot_wait'):
+            self._clock.sleep(delay) # Wait for data station to boot
 
         logging.debug("Connection timeout: %s s", self._connection_timeout_s)
         while not self._sftp.is_connected:
 
-            self.connection_time_s = data_station_connection_timer.time_elapsed()
-
-            if data_station_connection_timer.time_elapsed() > (self._connection_timeout_s-delay):
+            if connect_span.elapsed() > (self._connection_timeout_s-delay):
                 logging.error("Connection to data station %s failed permanently" % (self._data_station_id))
                 break
 
             # Sets low level SSH socket read/write timeout for all operations (listdir, get, etc)
+            self._trace.count('connect_attempts')
             self._sftp.connect()
 
             # Without this, the service spins when the data station is booted,
             # but not yet accepting SSH connections
-            time.sleep(1)
+            if not self._sftp.is_connected:
+                self._clock.sleep(1)
 
+        self.connection_time_s = connect_span.finish()
         logging.debug("Total connection time: %s", self.connection_time_s)
 
         # Throw an error to tell navigation to continue on
@@ -88,7 +110,7 @@ class Download(threading.Thread):
         new_files_to_download = 0
         old_files_to_download = 0
 
-        data_station_download_timer = Timer()
+        transfer_span = self._trace.span('transfer')
 
         if self._redownload_request == True:
             # Flight operator has ordered redownload of previously downloaded data
@@ -99,15 +121,18 @@ class Download(threading.Thread):
             self._sftp.deleteTmpFieldData()
 
         # Prioritizes field data transfer over log data
-        new_files_downloaded, new_files_to_download, self.did_find_device, new_data_downloaded_mb = self._sftp.downloadNewFieldData()
+        new_files_downloaded, new_files_to_download, self.did_find_device, new_data_downloaded_mb = self._sftp.downloadNewFieldData(
+            self._transfer_order, self._byte_quota_mb, self._progressive)
 
-        self.download_time_s = data_station_download_timer.time_elapsed()
+        self.download_time_s = transfer_span.finish()
 
         # Get total mb downloaded
         self.total_data_downloaded_mb = old_data_downloaded_mb + new_data_downloaded_mb
 
         # Calculate bitrate in Mbps (mb*s*8 bits/byte)
-        self.download_speed_mbps = self.total_data_downloaded_mb/self.download_time_s * 8
+        # A simulated clock may not move during the transfer
+        if self.download_time_s > 0:
+            self.download_speed_mbps = self.total_data_downloaded_mb/self.download_time_s * 8
 
         # Calculate percent of files downloaded and round down to the nearest integer
         successful_downloads = new_files_downloaded + old_files_downloaded
@@ -124,6 +149,12 @@ class Download(threading.Thread):
         self.successful_downloads = successful_downloads
         self.total_files = total_files
 
+        # Station logs are lowest priority, they only get what's left of the visit once field data is done
+        if self._log_budget_s > 0 and not self._timeout_event.is_set():
+            with self._trace.span('logs'):
+                log_files, log_bytes = self._sftp.downloadLogs(self._log_budget_s)
+            logging.info("Station logs: %d files, %d bytes", log_files, log_bytes)
+
         # Signals to DS handler that the download has gracefully shut down
         self._timeout_event.clear()
         self._download_over.set()
@@ -137,6 +168,10 @@ class Download(threading.Thread):
         logging.debug("Closing SFTP connection...")
         self._sftp.close()
 
+    def cancel(self):
+        """Ask the download to stop after the file in flight"""
+        self._timeout_event.set()
+
     def run(self):
         self._connect()
         self._start()
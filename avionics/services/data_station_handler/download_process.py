@@ -0,0 +1,202 @@
+"""
+Download worker that runs in its own process
+
+`Download` is a thread, so paramiko's packet decryption and MAC checks share
+the GIL with the serial reader, serial writer, heartbeat and XBee polling.
+`DownloadProcess` runs the same `Download` in a child process and mirrors its
+attributes in the parent, so `DataStationHandler` can use either one.
+
+The child talks to the parent over a single queue:
+
+    ('log', record)          handed to the parent's logging handlers
+    ('progress', bytes)      one per downloaded file
+    ('result', stats, trace) final `Download` attributes and the child's trace
+
+Cancellation is cooperative: `cancel()` sets an event shared with the child
+that the SFTP client checks between files, as `_timeout_event` does for the
+thread. A child that is still running `TERMINATE_GRACE_S` later is
+terminated. The child never opens the database, results are written by the
+parent.
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.forkserver
+import queue
+import threading
+
+from .download import Download
+from ..metrics import Trace
+
+# `Download` attributes reported back to the parent
+RESULT_FIELDS = ['did_connect', 'did_find_device', 'successful_downloads', 'total_files',
+    'total_data_downloaded_mb', 'download_speed_mbps', 'connection_time_s', 'download_time_s', 'downloaded_files',
+    'previewed_files']
+
+def _context():
+    # Not 'fork': the payload process runs serial, heartbeat, logging, session
+    # and export threads, and a lock one of them holds at fork time would stay
+    # locked for good in the child. Children are forked from a fork server
+    # instead, a clean single-threaded process that imports paramiko once, so
+    # downloads still don't pay the seconds it takes to import on a Pi. Only
+    # picklable arguments are passed to the child.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['paramiko', __name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+def start_worker_server():
+    """Starts the fork server ahead of the first download or ingest worker"""
+    if _context().get_start_method() == 'forkserver':
+        multiprocessing.forkserver.ensure_running()
+
+
+class _ChildLogHandler(logging.Handler):
+    """Forwards the child's log records to the parent"""
+
+    def __init__(self, channel):
+        super(_ChildLogHandler, self).__init__()
+        self._channel = channel
+
+    def emit(self, record):
+        try:
+            # Arguments and tracebacks may not pickle, render them here
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self._channel.put(('log', record))
+        except Exception:
+            self.handleError(record)
+
+
+def _run_child(kwargs, cancel_event, channel):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_ChildLogHandler(channel))
+
+    trace = Trace('download')
+    worker = Download(_timeout_event=cancel_event, _download_over=threading.Event(), _trace=trace,
+        _progress=lambda file_size: channel.put(('progress', file_size)), **kwargs)
+
+    try:
+        worker.run()
+    except Exception as e:
+        # The thread dies the same way on a connection timeout
+        logging.error(e)
+    finally:
+        channel.put(('result', dict((f, getattr(worker, f)) for f in RESULT_FIELDS), trace.to_dict()))
+
+
+class DownloadProcess(object):
+
+    """
+    Drop-in replacement for `Download` that runs the transfer in a child
+    process. Takes the same arguments, `_timeout_event` is replaced by
+    `cancel()`.
+    """
+
+    TERMINATE_GRACE_S = 15  # Time a cancelled child gets to exit by itself
+
+    def __init__(self, _data_station_id, _redownload_request, _flight_id, _connection_timeout_s, _timeout_event, _download_over,
+        _transfer_order='listing', _byte_quota_mb=None, _boot_delay_s=40, _address=None, _port=None, _local_root=None,
+        _trace=None, _clock=None, _log_budget_s=0, _content_store=False, _progressive=False,
+        _transfer_settings=None, _source=None, _throttle=None):
+
+        self.successful_downloads = 0
+        self.total_files = 0
+        self.did_connect = False
+        self.did_find_device = False
+        self.total_data_downloaded_mb = 0
+        self.download_speed_mbps = 0
+        self.connection_time_s = 0
+        self.download_time_s = 0
+        self.downloaded_files = []
+        self.previewed_files = []
+
+        self._download_over = _download_over
+        self._trace = _trace or Trace('download')
+
+        # The child always runs on the system clock, `_clock` is accepted to match `Download`. A
+        # `_throttle` can't be called across processes, so sessions in child processes aren't paced
+        kwargs = {
+            '_data_station_id': _data_station_id,
+            '_redownload_request': _redownload_request,
+            '_flight_id': _flight_id,
+            '_connection_timeout_s': _connection_timeout_s,
+            '_transfer_order': _transfer_order,
+            '_byte_quota_mb': _byte_quota_mb,
+            '_boot_delay_s': _boot_delay_s,
+            '_address': _address,
+            '_port': _port,
+            '_local_root': _local_root,
+            '_log_budget_s': _log_budget_s,
+            '_content_store': _content_store,
+            '_progressive': _progressive,
+            '_transfer_settings': _transfer_settings,
+            '_source': _source,
+        }
+
+        context = _context()
+        self._cancel_event = context.Event()
+        self._channel = context.Queue()
+        self._process = context.Process(target=_run_child, args=(kwargs, self._cancel_event, self._channel),
+            name='download-%s' % _data_station_id)
+        self._process.daemon = True
+
+        self._receiver = threading.Thread(target=self._receive, name='download-receiver')
+        self._receiver.daemon = True
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._channel.get(timeout=0.5)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    logging.error("Download process exited without a result")
+                    break
+                continue
+
+            if message[0] == 'log':
+                record = message[1]
+                logging.getLogger(record.name).handle(record)
+
+            elif message[0] == 'progress':
+                # Files only arrive over a working connection
+                self.did_connect = True
+                self.successful_downloads += 1
+                self.total_data_downloaded_mb += message[1] / 1024 / 1024
+
+            elif message[0] == 'result':
+                for field, value in message[1].items():
+                    setattr(self, field, value)
+                self._trace.merge(message[2])
+                break
+
+        self._download_over.set()
+
+    def _terminate(self):
+        if self._process.is_alive():
+            logging.warning("Download process did not stop after cancel, terminating")
+            self._process.terminate()
+
+    def start(self):
+        self._process.start()
+        self._receiver.start()
+
+    def join(self, timeout=None):
+        self._process.join(timeout)
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def cancel(self):
+        """Ask the download to stop after the file in flight"""
+        self._cancel_event.set()
+
+        timer = threading.Timer(self.TERMINATE_GRACE_S, self._terminate)
+        timer.daemon = True
+        timer.start()
@@ -0,0 +1,158 @@
+"""
+Minimal EXIF reader for camera trap JPEGs.
+
+Only what ground triage needs is read: the capture time, the camera's
+identity and the thumbnail the camera already embedded. Nothing is decoded,
+so reading a file costs one read of its first segments whatever its
+resolution, and no imaging library is needed on the payload.
+"""
+
+import collections
+import struct
+
+ExifInfo = collections.namedtuple('ExifInfo', [
+    'captured_at',      # 'YYYY-MM-DD HH:MM:SS' camera local time, or None
+    'camera_id',        # Body serial number, otherwise make and model, or None
+    'thumbnail',        # Embedded JPEG thumbnail bytes, or None
+])
+
+HEADER_BYTES = 128 * 1024   # APP1 segments are at most 64 KB and come first
+
+# TIFF tags
+MAKE = 0x010F
+MODEL = 0x0110
+DATE_TIME = 0x0132
+EXIF_IFD = 0x8769
+DATE_TIME_ORIGINAL = 0x9003
+BODY_SERIAL_NUMBER = 0xA431
+THUMBNAIL_OFFSET = 0x0201
+THUMBNAIL_LENGTH = 0x0202
+
+# TIFF field type -> size in bytes of one value
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+def _exif_segment(data):
+    """Returns the TIFF block of the JPEG's Exif APP1 segment, or None"""
+
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("Not a JPEG")
+
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            raise ValueError("Bad JPEG marker at %d" % offset)
+
+        marker = data[offset + 1]
+        if marker == 0xDA or marker == 0xD9:  # Image data or end, no more metadata
+            return None
+
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        segment = data[offset + 4:offset + 2 + length]
+
+        if marker == 0xE1 and segment[:6] == b'Exif\x00\x00':
+            return segment[6:]
+
+        offset += 2 + length
+
+    return None
+
+
+class _Tiff(object):
+
+    def __init__(self, data):
+        if data[:2] == b'II':
+            self.order = '<'
+        elif data[:2] == b'MM':
+            self.order = '>'
+        else:
+            raise ValueError("Bad TIFF byte order")
+
+        if self._unpack('H', data, 2) != 42:
+            raise ValueError("Bad TIFF magic")
+
+        self.data = data
+
+    def _unpack(self, fmt, data, offset):
+        size = struct.calcsize(self.order + fmt)
+        if offset < 0 or offset + size > len(data):
+            raise ValueError("TIFF offset out of range")
+        return struct.unpack(self.order + fmt, data[offset:offset + size])[0]
+
+    @property
+    def first_ifd(self):
+        return self._unpack('I', self.data, 4)
+
+    def ifd(self, offset):
+        """Returns ({tag: value}, next IFD offset), only ASCII and integer values are kept"""
+
+        entries = {}
+        count = self._unpack('H', self.data, offset)
+
+        for index in range(count):
+            entry = offset + 2 + index * 12
+            tag = self._unpack('H', self.data, entry)
+            kind = self._unpack('H', self.data, entry + 2)
+            n = self._unpack('I', self.data, entry + 4)
+
+            size = _TYPE_SIZES.get(kind, 1) * n
+            value_offset = entry + 8 if size <= 4 else self._unpack('I', self.data, entry + 8)
+            if value_offset + size > len(self.data):
+                continue
+
+            if kind == 2:
+                entries[tag] = self.data[value_offset:value_offset + size].split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+            elif kind == 3 and n == 1:
+                entries[tag] = self._unpack('H', self.data, value_offset)
+            elif kind == 4 and n == 1:
+                entries[tag] = self._unpack('I', self.data, value_offset)
+
+        return entries, self._unpack('I', self.data, offset + 2 + count * 12)
+
+
+def _timestamp(value):
+    # EXIF writes 'YYYY:MM:DD HH:MM:SS', blank or zeroed when the clock wasn't set
+    if not value or len(value) < 19 or value.startswith('0000'):
+        return None
+    return value[:10].replace(':', '-') + value[10:19]
+
+
+def parse_exif(data):
+    """Returns an `ExifInfo` for the first bytes of a JPEG
+
+    Raises ValueError if the data isn't a JPEG or its EXIF is malformed.
+    """
+
+    segment = _exif_segment(data)
+    if segment is None:
+        return ExifInfo(None, None, None)
+
+    tiff = _Tiff(segment)
+    ifd0, ifd1_offset = tiff.ifd(tiff.first_ifd)
+
+    exif = {}
+    if EXIF_IFD in ifd0:
+        exif, _ = tiff.ifd(ifd0[EXIF_IFD])
+
+    captured_at = _timestamp(exif.get(DATE_TIME_ORIGINAL)) or _timestamp(ifd0.get(DATE_TIME))
+
+    camera_id = exif.get(BODY_SERIAL_NUMBER)
+    if not camera_id:
+        camera_id = ' '.join(v for v in [ifd0.get(MAKE), ifd0.get(MODEL)] if v) or None
+
+    thumbnail = None
+    if ifd1_offset:
+        ifd1, _ = tiff.ifd(ifd1_offset)
+        start, length = ifd1.get(THUMBNAIL_OFFSET), ifd1.get(THUMBNAIL_LENGTH)
+        if start and length and start + length <= len(segment):
+            thumbnail = segment[start:start + length]
+            if thumbnail[:2] != b'\xff\xd8':
+                thumbnail = None
+
+    return ExifInfo(captured_at, camera_id, thumbnail)
+
+
+def read_exif(path):
+    """Returns an `ExifInfo` for a JPEG file"""
+
+    with open(path, 'rb') as f:
+        return parse_exif(f.read(HEADER_BYTES))
@@ -0,0 +1,187 @@
+"""
+Post-download ingest of field data.
+
+Once a visit's files are in the database nothing is known about them beyond
+their size, and ground triage meant opening every full-resolution JPEG. The
+ingest pipeline works through files that have not been ingested yet, reads
+each one's EXIF capture time and camera ID into the `files` table and writes
+a small thumbnail next to the flight directories:
+
+    <local root>/.thumbnails/<flight_id>/<station_id>/<local path>
+
+The thumbnail is the one the camera embedded in the EXIF header, so only the
+first `exif.HEADER_BYTES` of a file are read. Files without one get a
+thumbnail from Pillow if it is installed, otherwise none.
+
+Files are read in a small pool of low priority processes during transit legs.
+Nothing is submitted while a station download is running, and a batch in
+progress stops handing out work as soon as one starts, so ingest never
+competes with a download for the SD card or the CPU.
+"""
+
+import concurrent.futures
+import logging
+import os
+
+from . import exif
+from .database import Database
+from .download_process import _context
+from .sftp import SFTPClient
+from ..clock import SystemClock
+from ..metrics import registry
+
+THUMBNAIL_DIRECTORY = SFTPClient.THUMBNAIL_DIRECTORY
+THUMBNAIL_SIZE = (160, 120)         # EXIF thumbnail size
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+def thumbnail_path(local_root, flight_id, data_station_id, local_path):
+    return os.path.join(local_root, THUMBNAIL_DIRECTORY, str(flight_id), str(data_station_id), local_path)
+
+
+def _render_thumbnail(path, thumbnail):
+    """Writes a thumbnail of the image at `path` with Pillow, returns False if it isn't installed"""
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+
+    with Image.open(path) as image:
+        image.draft('RGB', THUMBNAIL_SIZE)   # Decodes JPEGs at a fraction of their size
+        image.thumbnail(THUMBNAIL_SIZE)
+        image.convert('RGB').save(thumbnail, 'JPEG', quality=75)
+
+    return True
+
+
+def ingest_file(path, thumbnail):
+    """Reads a file's metadata and writes its thumbnail, returns (captured at, camera ID, thumbnail size)
+
+    Runs in a pool process. The thumbnail size is None if none was written.
+    """
+
+    info = exif.read_exif(path)
+
+    directory = os.path.dirname(thumbnail)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    if info.thumbnail is not None:
+        with open(thumbnail + '.part', 'wb') as f:
+            f.write(info.thumbnail)
+        os.replace(thumbnail + '.part', thumbnail)
+    elif not _render_thumbnail(path, thumbnail):
+        return info.captured_at, info.camera_id, None
+
+    return info.captured_at, info.camera_id, os.path.getsize(thumbnail)
+
+
+def _lower_priority():
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+class IngestPipeline(object):
+    """Indexes downloaded files in a process pool between station visits"""
+
+    def __init__(self, _db=None, _local_root=None, _workers=None, _clock=None):
+        self.db = _db or Database()
+        self.local_root = _local_root or SFTPClient.LOCAL_ROOT_DATA_DIRECTORY
+        self.clock = _clock or SystemClock()
+        self._alive = True
+        self._executor = None
+
+        # One core stays free for serial, heartbeat and the next download
+        self.workers = _workers or max(1, (os.cpu_count() or 2) - 1)
+        self.batch_files = 8            # Files queued per worker before checking for a download again
+        self.check_interval_s = 5
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=_context(), initializer=_lower_priority)
+        return self._executor
+
+    def run(self, is_downloading):
+        """Ingest pending files every `check_interval_s` outside of downloads"""
+
+        logging.info("Ingest pipeline started (%d workers)", self.workers)
+
+        while self._alive:
+            try:
+                while self._alive and not is_downloading.is_set() and self.ingest_pending(is_downloading):
+                    pass
+            except (OSError, concurrent.futures.process.BrokenProcessPool) as e:
+                logging.error("Ingest failed: %s", e)
+                self._shutdown()
+            self.clock.sleep(self.check_interval_s)
+
+        self._shutdown()
+        logging.error("Ingest pipeline terminated")
+
+    def stop(self):
+        logging.info("Stopping ingest pipeline...")
+        self._alive = False
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def ingest_pending(self, is_downloading=None):
+        """Ingests one batch of files not ingested yet, returns the number ingested
+
+        Stops handing out work when a download starts, the rest is picked up
+        on the next call.
+        """
+
+        if is_downloading is not None and is_downloading.is_set():
+            return 0
+
+        pending = self.db.get_pending_ingest(self.workers * self.batch_files)
+        if not pending:
+            return 0
+
+        results = []
+        futures = {}
+        pool = self._pool()
+
+        for flight_id, data_station_id, local_path in pending:
+            path = os.path.join(self.local_root, str(flight_id), str(data_station_id), local_path)
+
+            # Deleted (evicted) files and files that aren't images are done without a look
+            if not os.path.isfile(path) or not local_path.lower().endswith(JPEG_EXTENSIONS):
+                results.append((flight_id, data_station_id, local_path, None, None, None))
+                continue
+
+            thumbnail = thumbnail_path(self.local_root, flight_id, data_station_id, local_path)
+            future = pool.submit(ingest_file, path, thumbnail)
+            futures[future] = (flight_id, data_station_id, local_path)
+
+        for future in concurrent.futures.as_completed(futures):
+            if is_downloading is not None and is_downloading.is_set():
+                for other in futures:
+                    other.cancel()
+
+            if future.cancelled():
+                continue
+
+            key = futures[future]
+            try:
+                captured_at, camera_id, thumbnail_size = future.result()
+            except (ValueError, OSError) as e:
+                # Truncated or corrupt files are recorded as having no metadata
+                logging.warning("Could not ingest %s: %s", os.path.join(*map(str, key)), e)
+                captured_at, camera_id, thumbnail_size = None, None, None
+
+            results.append(key + (captured_at, camera_id, thumbnail_size))
+            if thumbnail_size:
+                registry.inc('ingest_thumbnail_bytes', thumbnail_size)
+
+        self.db.update_file_metadata(results)
+        registry.inc('ingest_files', len(results))
+        logging.debug("Ingested %d of %d pending files", len(results), len(pending))
+
+        return len(results)
@@ -0,0 +1,255 @@
+"""
+Compact manifests of the files on a data station.
+
+A station with a few large cards holds 100k+ files. As Python objects (an
+`SFTPAttributes` or `RemoteFile` per file, a list per cached listing entry)
+their manifest alone took tens of MB on a 512 MB Pi Zero. Here files are kept
+in columns instead:
+
+    names       one bytearray of UTF-8 names back to back, and their end offsets
+    sizes       array of int64, `MISSING` where unknown
+    mtimes      array of int64, `MISSING` where unknown
+    directory   array of indices into the manifest's directory paths, each path stored once
+
+which costs about 40 bytes per file whatever the card size. `RemoteFile`s
+are only made while iterating, one at a time, and filtering (`select`) and
+ordering (`ManifestView.sorted_by`) work on arrays of file indices.
+"""
+
+import array
+import collections
+import itertools
+import sys
+
+from .ordering import RemoteFile
+
+MISSING = -1    # Size or mtime the listing didn't have
+
+def is_tmp_directory(path):
+    """True for the `.tmp` directories downloaded files wait in for deletion"""
+    return path.rstrip('/').endswith('.tmp')
+
+
+class FileColumns(object):
+    """Names, sizes and mtimes of a list of files, one column each"""
+
+    __slots__ = ('_names', '_ends', 'sizes', 'mtimes')
+
+    def __init__(self):
+        self._names = bytearray()           # UTF-8 names back to back
+        self._ends = array.array('I')       # End of each name in `_names`
+        self.sizes = array.array('q')
+        self.mtimes = array.array('q')
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Columns of [(name, size, mtime)]"""
+        columns = cls()
+        for name, size, mtime in rows:
+            columns.append(name, size, mtime)
+        return columns
+
+    def append(self, name, size, mtime):
+        self._names += name.encode('utf-8', 'surrogateescape')
+        self._ends.append(len(self._names))
+        self.sizes.append(MISSING if size is None else int(size))
+        self.mtimes.append(MISSING if mtime is None else int(mtime))
+
+    def extend(self, other):
+        offset = len(self._names)
+        self._names += other._names
+        self._ends.extend(end + offset for end in other._ends)
+        self.sizes.extend(other.sizes)
+        self.mtimes.extend(other.mtimes)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def _span(self, index):
+        return (self._ends[index - 1] if index else 0), self._ends[index]
+
+    def name(self, index):
+        start, end = self._span(index)
+        return self._names[start:end].decode('utf-8', 'surrogateescape')
+
+    def size(self, index):
+        size = self.sizes[index]
+        return None if size == MISSING else size
+
+    def mtime(self, index):
+        mtime = self.mtimes[index]
+        return None if mtime == MISSING else mtime
+
+    def name_endswith(self, index, suffixes):
+        """`str.endswith` on a name without decoding it, `suffixes` is a tuple of bytes"""
+        start, end = self._span(index)
+        return self._names.endswith(suffixes, start, end)
+
+    def name_startswith(self, index, prefix):
+        start, end = self._span(index)
+        return self._names.startswith(prefix, start, end)
+
+    def names(self):
+        for index in range(len(self)):
+            yield self.name(index)
+
+    def rows(self):
+        """Yields (name, size, mtime) of every file"""
+        for index in range(len(self)):
+            yield self.name(index), self.size(index), self.mtime(index)
+
+
+class Listing(object):
+    """One remote directory's listing: its mtime, files and subdirectories"""
+
+    __slots__ = ('mtime', 'files', 'folders')
+
+    def __init__(self, mtime, files=None, folders=None):
+        self.mtime = mtime
+        self.files = files if files is not None else FileColumns()
+        self.folders = folders if folders is not None else []   # [(name, mtime)]
+
+    @classmethod
+    def from_json(cls, entry):
+        return cls(entry['mtime'], FileColumns.from_rows(entry['files']),
+                   [(name, mtime) for name, mtime in entry['folders']])
+
+    def to_json(self):
+        return {
+            'mtime': self.mtime,
+            'files': [list(row) for row in self.files.rows()],
+            'folders': [list(folder) for folder in self.folders],
+        }
+
+
+class Manifest(object):
+    """Every file found on a station, in listing order"""
+
+    __slots__ = ('directories', '_directory_ids', '_directory', '_files')
+
+    def __init__(self):
+        self.directories = []                   # Remote directory paths, each stored once
+        self._directory_ids = {}
+        self._directory = array.array('I')      # Index into `directories` of each file
+        self._files = FileColumns()
+
+    def _directory_id(self, path):
+        directory = self._directory_ids.get(path)
+        if directory is None:
+            directory = self._directory_ids[path] = len(self.directories)
+            self.directories.append(sys.intern(path))
+        return directory
+
+    def add(self, path, files):
+        """Adds the `FileColumns` of a directory"""
+        self._directory.extend(itertools.repeat(self._directory_id(path), len(files)))
+        self._files.extend(files)
+
+    def append(self, path, name, size=None, mtime=None):
+        self._directory.append(self._directory_id(path))
+        self._files.append(name, size, mtime)
+
+    def __len__(self):
+        return len(self._directory)
+
+    def file(self, index):
+        files = self._files
+        return RemoteFile(self.directories[self._directory[index]], files.name(index),
+                          files.size(index), files.mtime(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.file(index)
+
+    def view(self):
+        return ManifestView(self, array.array('I', range(len(self))))
+
+    def select(self, suffixes=None, directory=None, tmp=None, hidden=True):
+        """Returns a `ManifestView` of the files that pass every filter given
+
+        `suffixes`: names end with one of these (case sensitive)
+        `directory`: a predicate on the directory path, called once per directory
+        `tmp`: True for files in `.tmp` directories only, False for files outside them
+        `hidden`: False leaves out names starting with '.'
+        """
+
+        allowed = []
+        for path in self.directories:
+            allowed.append((directory is None or directory(path))
+                           and (tmp is None or is_tmp_directory(path) == tmp))
+
+        if suffixes is not None:
+            suffixes = tuple(s.encode('utf-8') for s in suffixes)
+
+        files = self._files
+        indices = array.array('I')
+        for index, d in enumerate(self._directory):
+            if not allowed[d]:
+                continue
+            if suffixes is not None and not files.name_endswith(index, suffixes):
+                continue
+            if not hidden and files.name_startswith(index, b'.'):
+                continue
+            indices.append(index)
+
+        return ManifestView(self, indices)
+
+
+class ManifestView(object):
+    """A subset of a manifest's files in a given order, read-only like a list of `RemoteFile`"""
+
+    __slots__ = ('manifest', 'indices')
+
+    def __init__(self, manifest, indices):
+        self.manifest = manifest
+        self.indices = indices      # array of file indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        return self.manifest.file(self.indices[position])
+
+    def __iter__(self):
+        for index in self.indices:
+            yield self.manifest.file(index)
+
+    def total_size(self):
+        sizes = self.manifest._files.sizes
+        return sum(max(0, sizes[index]) for index in self.indices)
+
+    def sorted_by(self, column, reverse=False):
+        """Returns a view ordered by 'size' or 'mtime', unknown values count as 0, ties keep their order"""
+
+        values = getattr(self.manifest._files, column + 's')
+        key = lambda index: max(0, values[index])
+        return ManifestView(self.manifest, array.array('I', sorted(self.indices, key=key, reverse=reverse)))
+
+    def groups(self, key):
+        """Returns an OrderedDict of `key(directory path)` -> view, in order of first appearance"""
+
+        manifest = self.manifest
+        keys = {}
+        groups = collections.OrderedDict()
+        for index in self.indices:
+            directory = manifest._directory[index]
+            if directory not in keys:
+                keys[directory] = key(manifest.directories[directory])
+            groups.setdefault(keys[directory], array.array('I')).append(index)
+
+        return collections.OrderedDict((k, ManifestView(manifest, indices)) for k, indices in groups.items())
+
+    def interleave(self, views):
+        """Returns a view taking one file from each of `views` in turn until all are used up"""
+
+        indices = array.array('I')
+        queues = [iter(view.indices) for view in views]
+        while queues:
+            for queue in list(queues):
+                index = next(queue, None)
+                if index is None:
+                    queues.remove(queue)
+                else:
+                    indices.append(index)
+
+        return ManifestView(self.manifest, indices)
@@ -0,0 +1,103 @@
+"""
+Transfer ordering policies for data station field data.
+
+A policy takes the manifest of files found on the data station and returns
+them in the order they should be transferred. When the hover window runs
+out, whatever is left at the end of the ordering is what we miss, so the
+policy decides which captures make it back to the ground.
+
+Policies are looked up by name from the `stations` table (`transfer_order`
+column) and additional policies can be added with `register_policy()`.
+
+Downloads pass a `manifest.ManifestView` rather than a list, the built-in
+policies order its index arrays so no `RemoteFile` is made until the file is
+about to be transferred.
+"""
+
+import collections
+
+# A single remote file as seen in the remote listing
+RemoteFile = collections.namedtuple('RemoteFile', ['path', 'filename', 'size', 'mtime'])
+
+ORDER_LISTING = 'listing'           # Whatever order `listdir_attr` returns (original behaviour)
+ORDER_NEWEST = 'newest'             # Most recent captures first
+ORDER_SMALLEST = 'smallest'         # Smallest files first to maximize file count
+ORDER_ROUND_ROBIN = 'round_robin'   # Alternate between /media/usbN devices, newest first on each
+
+DEFAULT_ORDER = ORDER_LISTING
+
+
+def _order_listing(files):
+    # Views are already in listing order and stay compact
+    return files
+
+def _order_newest(files):
+    if hasattr(files, 'sorted_by'):
+        return files.sorted_by('mtime', reverse=True)
+    return sorted(files, key=lambda f: f.mtime or 0, reverse=True)
+
+def _order_smallest(files):
+    if hasattr(files, 'sorted_by'):
+        return files.sorted_by('size')
+    return sorted(files, key=lambda f: f.size or 0)
+
+def device_of(path):
+    """Return the storage device (`usb0`, `usb1`, ...) a remote path lives on"""
+    parts = [p for p in path.split('/') if p]
+    if len(parts) >= 2 and parts[0] == 'media':
+        return parts[1]
+    return ''
+
+def _order_round_robin(files):
+    if hasattr(files, 'groups'):
+        return files.interleave([_order_newest(device_files) for device_files in files.groups(device_of).values()])
+
+    devices = collections.OrderedDict()
+    for f in files:
+        devices.setdefault(device_of(f.path), []).append(f)
+
+    queues = [collections.deque(_order_newest(device_files)) for device_files in devices.values()]
+
+    ordered = []
+    while queues:
+        for q in list(queues):
+            ordered.append(q.popleft())
+            if not q:
+                queues.remove(q)
+    return ordered
+
+_POLICIES = {
+    ORDER_LISTING: _order_listing,
+    ORDER_NEWEST: _order_newest,
+    ORDER_SMALLEST: _order_smallest,
+    ORDER_ROUND_ROBIN: _order_round_robin,
+}
+
+def register_policy(name, policy):
+    """Register a new ordering policy
+
+    `policy` is a callable taking a sequence of `RemoteFile` and returning
+    them in transfer order.
+    """
+    _POLICIES[name] = policy
+
+def policy_names():
+    return sorted(_POLICIES.keys())
+
+def order_files(files, order=DEFAULT_ORDER, byte_quota=None):
+    """Yield files in transfer order, stopping once the byte quota is reached
+
+    Unknown policy names fall back to listing order so that a typo in the
+    stations table never prevents a download.
+    """
+
+    policy = _POLICIES.get(order)
+    if policy is None:
+        policy = _POLICIES[DEFAULT_ORDER]
+
+    transferred = 0
+    for f in policy(files):
+        if byte_quota is not None and transferred + (f.size or 0) > byte_quota:
+            return
+        transferred += f.size or 0
+        yield f
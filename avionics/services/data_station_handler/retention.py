@@ -0,0 +1,181 @@
+"""
+Local storage retention for downloaded field data.
+
+Every flight adds a directory under the local root and nothing ever removed
+them, so the disk slowly filled until a download failed part way through a
+mission. Once the ground station has pulled a flight and confirmed the copy
+(see `export`), the flight is marked exported in the database and its data
+may be evicted. Eviction only happens when free space drops below
+`min_free_mb`, removes the oldest exported flights first until
+`target_free_mb` is free again, and works in small batches that stop as soon
+as a station download starts.
+
+Flights that have not been exported are never touched. With the content
+store, flight files are hardlinks to store objects; an object is deleted once
+no flight links to it.
+"""
+
+import collections
+import logging
+import os
+import shutil
+
+from .database import Database
+from .ingest import THUMBNAIL_DIRECTORY
+from .scheduler import StationScheduler
+from .sftp import SFTPClient
+from .store import ContentStore
+from ..clock import SystemClock
+from ..metrics import registry
+
+MB = 1024 * 1024
+
+# Space outlook for the next mission
+SpaceForecast = collections.namedtuple('SpaceForecast', [
+    'free_mb',          # Free now
+    'evictable_mb',     # Held by exported flights, can be freed
+    'expected_mb',      # Expected downloads for the stations
+    'margin_mb',        # Free + evictable - expected - min_free, negative means data will be lost
+])
+
+class RetentionManager(object):
+    """Evicts exported flights from the local root when space runs low"""
+
+    def __init__(self, _db=None, _scheduler=None, _local_root=None, _clock=None):
+        self.db = _db or Database()
+        self.scheduler = _scheduler or StationScheduler(self.db)
+        self.local_root = _local_root or SFTPClient.LOCAL_ROOT_DATA_DIRECTORY
+        self.clock = _clock or SystemClock()
+        self._alive = True
+
+        self.min_free_mb = 2048         # Start evicting below this
+        self.target_free_mb = 4096      # Stop evicting above this
+        self.check_interval_s = 60
+        self.batch_files = 200          # Files deleted between checks for a starting download
+
+    def free_mb(self):
+        # The local root only appears with the first download
+        path = os.path.abspath(self.local_root)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return shutil.disk_usage(path).free / MB
+
+    def flight_directory(self, flight_id):
+        return os.path.join(self.local_root, str(flight_id))
+
+    @staticmethod
+    def _freed_by_removing(stat):
+        # A store object shared with another flight stays, the link count is the store's plus every flight's
+        return stat.st_size if stat.st_nlink <= 2 else 0
+
+    def _directory_mb(self, directory):
+        total = 0
+        for root, _, files in os.walk(directory):
+            for name in files:
+                try:
+                    total += self._freed_by_removing(os.lstat(os.path.join(root, name)))
+                except OSError:
+                    pass
+        return total / MB
+
+    def _collect_garbage(self):
+        """Deletes store objects no flight links to any more, returns bytes freed"""
+
+        if not os.path.exists(os.path.join(self.local_root, ContentStore.DIRECTORY)):
+            return 0
+        return ContentStore(self.local_root).collect_garbage()
+
+    def run(self, is_downloading):
+        """Check free space every `check_interval_s` outside of downloads"""
+
+        logging.info("Retention manager started (evict below %d MB free)", self.min_free_mb)
+
+        while self._alive:
+            if not is_downloading.is_set():
+                try:
+                    self.enforce(is_downloading)
+                except OSError as e:
+                    logging.error("Retention check failed: %s", e)
+            self.clock.sleep(self.check_interval_s)
+
+        logging.error("Retention manager terminated")
+
+    def stop(self):
+        logging.info("Stopping retention manager...")
+        self._alive = False
+
+    def enforce(self, is_downloading=None):
+        """Evict exported flights, oldest first, if free space is below `min_free_mb`
+
+        Returns the number of MB freed. Stops early when a download starts.
+        """
+
+        free_mb = self.free_mb()
+        if free_mb >= self.min_free_mb:
+            return 0
+
+        logging.warning("%.0f MB free, evicting exported flights until %d MB are free", free_mb, self.target_free_mb)
+
+        freed_mb = 0
+        for flight_id in self.db.get_evictable_flights():
+            more, flight_freed_mb = self._evict(flight_id, is_downloading)
+            freed_mb += flight_freed_mb
+
+            if not more:
+                break
+
+        if self.free_mb() < self.min_free_mb:
+            logging.error("Only %.0f MB free after eviction, export flights to free more", self.free_mb())
+
+        return freed_mb
+
+    def _evict(self, flight_id, is_downloading):
+        """Deletes a flight's files in batches, returns (keep evicting, MB freed)"""
+
+        directory = self.flight_directory(flight_id)
+        freed = 0
+        deleted = 0
+
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.lstat(path)
+                    os.remove(path)
+                except OSError as e:
+                    logging.warning("Could not evict %s: %s", path, e)
+                    continue
+
+                # Store objects are collected below, only count files that are gone for good here
+                if stat.st_nlink == 1:
+                    freed += stat.st_size
+                deleted += 1
+
+                if deleted % self.batch_files == 0:
+                    if (is_downloading is not None and is_downloading.is_set()) or self.free_mb() >= self.target_free_mb:
+                        freed += self._collect_garbage()
+                        registry.inc('retention_evicted_bytes', freed)
+                        logging.info("Evicted %d files (%.1f MB) of flight %s", deleted, freed / MB, flight_id)
+                        return False, freed / MB
+
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(os.path.join(self.local_root, THUMBNAIL_DIRECTORY, str(flight_id)), ignore_errors=True)
+        freed += self._collect_garbage()
+        self.db.mark_flight_evicted(flight_id)
+
+        registry.inc('retention_evicted_bytes', freed)
+        logging.info("Evicted flight %s (%d files, %.1f MB)", flight_id, deleted, freed / MB)
+
+        return self.free_mb() < self.target_free_mb, freed / MB
+
+    def forecast(self, data_station_ids=None):
+        """Returns a `SpaceForecast` for visiting the stations (all known stations by default)"""
+
+        if data_station_ids is None:
+            data_station_ids = self.db.get_station_ids()
+
+        expected_mb = sum(self.scheduler.estimate(i).expected_data_mb for i in data_station_ids)
+        evictable_mb = sum(self._directory_mb(self.flight_directory(f)) for f in self.db.get_evictable_flights())
+        free_mb = self.free_mb()
+
+        return SpaceForecast(free_mb, evictable_mb, expected_mb, free_mb + evictable_mb - expected_mb - self.min_free_mb)
@@ -0,0 +1,116 @@
+"""
+Station visit scheduling from visit history.
+
+Every visit leaves a row in `flights_stations`. From the recent rows for a
+station we estimate how fast it accumulates field data, how big its files
+are, how fast its link is and how long it takes to boot and shut down. That
+gives an expected data volume and hover time for the next visit, which the
+autopilot can use to order a flight's visits by expected yield.
+"""
+
+import collections
+import logging
+
+from .database import Database
+
+# Estimates for a single data station
+StationEstimate = collections.namedtuple('StationEstimate', [
+    'station_id',
+    'files_per_day',        # New field data files per day
+    'file_size_mb',         # Average file size
+    'link_speed_mbps',      # Average transfer rate
+    'boot_time_s',          # Wakeup + connection time
+    'shutdown_time_s',
+    'expected_files',       # Files waiting on the station now
+    'expected_data_mb',
+    'hover_s',              # Recommended hover duration
+    'visits',               # Number of visits the estimate is based on
+])
+
+class StationScheduler(object):
+    """Recommends a visit order and hover duration per data station"""
+
+    # Used until a station has enough history of its own
+    DEFAULT_FILES_PER_DAY = 50
+    DEFAULT_FILE_SIZE_MB = 2.0
+    DEFAULT_LINK_SPEED_MBPS = 10.0
+    DEFAULT_BOOT_TIME_S = 60.0
+    DEFAULT_SHUTDOWN_TIME_S = 5.0
+
+    MIN_TRANSFER_S = 30     # Always leave some time to transfer
+    HISTORY = 10            # Number of recent visits used for estimates
+
+    def __init__(self, _db=None):
+        self.db = _db or Database()
+
+    @staticmethod
+    def _mean(values, default):
+        values = [v for v in values if v is not None and v > 0]
+        if not values:
+            return default
+        return sum(values) / len(values)
+
+    def estimate(self, data_station_id):
+        """Returns a `StationEstimate` for the data station"""
+
+        history = self.db.get_station_history(data_station_id, self.HISTORY)
+        connected = [v for v in history if v['did_connect']]
+
+        # Files added between consecutive visits, minus what was left behind last time
+        rates = []
+        for visit, previous in zip(history, history[1:]):
+            days = (visit['visited_day'] or 0) - (previous['visited_day'] or 0)
+            if days <= 0.01 or not visit['did_connect'] or not previous['did_connect']:
+                continue
+            backlog = max(0, previous['total_files'] - previous['successful_downloads'])
+            rates.append(max(0, visit['total_files'] - backlog) / days)
+
+        files_per_day = self._mean(rates, self.DEFAULT_FILES_PER_DAY)
+
+        downloaded_files = sum(v['successful_downloads'] or 0 for v in connected)
+        downloaded_mb = sum(v['total_data_downloaded_mb'] or 0 for v in connected)
+        if downloaded_files:
+            file_size_mb = downloaded_mb / downloaded_files
+        else:
+            file_size_mb = self.DEFAULT_FILE_SIZE_MB
+
+        link_speed_mbps = self._mean([v['download_speed_mbps'] for v in connected], self.DEFAULT_LINK_SPEED_MBPS)
+        boot_time_s = self._mean([(v['wakeup_time_s'] or 0) + (v['connection_time_s'] or 0) for v in connected],
+                                 self.DEFAULT_BOOT_TIME_S)
+        shutdown_time_s = self._mean([v['shutdown_time_s'] for v in history], self.DEFAULT_SHUTDOWN_TIME_S)
+
+        # Data waiting on the station: what accrued since the last visit plus what was left behind
+        days_since_visit = self.db.get_days_since_visit(data_station_id)
+        if history:
+            last = history[0]
+            backlog = max(0, (last['total_files'] or 0) - (last['successful_downloads'] or 0))
+            expected_files = files_per_day * max(0, days_since_visit or 0) + backlog
+        else:
+            # Never downloaded, assume a week's worth of data
+            expected_files = files_per_day * 7
+
+        expected_data_mb = expected_files * file_size_mb
+        transfer_s = max(self.MIN_TRANSFER_S, expected_data_mb * 8 / link_speed_mbps)
+
+        # Never recommend hovering longer than the download timeout allows
+        transfer_s = min(transfer_s, self.db.get_timeout('download') * 60)
+
+        hover_s = boot_time_s + transfer_s + shutdown_time_s
+
+        return StationEstimate(str(data_station_id), files_per_day, file_size_mb, link_speed_mbps,
+                               boot_time_s, shutdown_time_s, expected_files, expected_data_mb,
+                               hover_s, len(history))
+
+    def plan(self, data_station_ids):
+        """Returns [(station ID, hover seconds)] ordered by expected data per hover second"""
+
+        estimates = [self.estimate(i) for i in data_station_ids]
+
+        # Ties keep the order the autopilot gave us
+        estimates.sort(key=lambda e: e.expected_data_mb / e.hover_s, reverse=True)
+
+        for e in estimates:
+            logging.debug("Station %s: %.0f files, %.1f MB expected, hover %.0f s (%d visits)",
+                          e.station_id, e.expected_files, e.expected_data_mb, e.hover_s, e.visits)
+
+        return [(e.station_id, int(round(e.hover_s))) for e in estimates]
@@ -3,11 +3,38 @@ import socket
 import traceback
 import logging
 
-import paramiko
 import os
 import binascii
+import inspect
+import ipaddress
+import json
+import struct
+import tarfile
 import threading
 
+from .exif import parse_exif
+from .manifest import Listing, Manifest
+from .ordering import order_files, DEFAULT_ORDER
+from ..clock import SystemClock
+from ..metrics import count
+
+paramiko = None # Imported on first use, see `load_paramiko()`
+prefetch_limit = False # Whether this paramiko can limit reads in flight per file (3.3 and later)
+
+def load_paramiko():
+    """Import paramiko on first use
+
+    Importing paramiko pulls in the whole cryptography stack, which takes
+    seconds on a Pi Zero, so it is kept off the startup path and loaded in
+    the background once the serial link and heartbeat are up.
+    """
+    global paramiko, prefetch_limit
+    if paramiko is None:
+        import paramiko as _paramiko
+        prefetch_limit = 'max_concurrent_prefetch_requests' in inspect.signature(_paramiko.SFTPClient.getfo).parameters
+        paramiko = _paramiko
+    return paramiko
+
 class SFTPClient(object):
 
     # Ensure pi users on payload and data station computers have r/w access to these directories
@@ -17,8 +44,22 @@ class SFTPClient(object):
     REMOTE_FIELD_DATA_SOURCE = REMOTE_ROOT_DATA_DIRECTORY + ''               # Location relative to SFTP root directory where the field data files are located; current SFTP root from pi@cameratrap.local /home/pi/
     LOCAL_FIELD_DATA_DESTINATION = LOCAL_ROOT_DATA_DIRECTORY + 'field/'      # Where downloaded data station field data will be kept
 
-    # REMOTE_LOG_SOURCE = REMOTE_ROOT_DATA_DIRECTORY+'logs/'                   # Location relative to SFTP root directory where the data station log files are located
-    # LOCAL_LOG_DESTINATION = LOCAL_ROOT_DATA_DIRECTORY + 'logs/'              # Where downloaded data station logs will be kept
+    REMOTE_LOG_SOURCE = REMOTE_ROOT_DATA_DIRECTORY+'logs/'                     # Location relative to SFTP root directory where the data station log files are located
+    LOCAL_LOG_DESTINATION = LOCAL_ROOT_DATA_DIRECTORY + 'logs/'                # Where downloaded data station logs will be kept
+
+    FIELD_DATA_SUFFIXES = ('.JPG', '.JPEG', '.jpg', '.jpeg')
+
+    # Names that only show an empty device or the logs directory, not field data
+    PLACEHOLDER_SUFFIXES = ('/', 'usb0', 'usb1', 'usb2', 'usb3', 'usb4', 'usb5', 'usb6', 'usb7', 'logs')
+
+    # Cached directory listings per station, relative to the local root (see `_walk_attr`)
+    MANIFEST_DIRECTORY = '.manifests'
+    MANIFEST_MAX_AGE_S = 7 * 24 * 3600   # Older caches are ignored and every directory re-listed
+
+    # Thumbnails, locally per flight and station below the local root (see `ingest.py`), and on
+    # data stations that make their own next to the images (`DCIM/100MEDIA/.thumbnails/IMG_0001.JPG`)
+    THUMBNAIL_DIRECTORY = '.thumbnails'
+    PREVIEW_HEADER_BYTES = 64 * 1024    # Largest EXIF segment read from a remote file for its thumbnail
 
     # Paramiko client configuration
     PORT = 22
@@ -37,12 +78,29 @@ class SFTPClient(object):
 
     is_connected = False
 
-    def __init__(self, _username, _password, _hostname, _flight_id, _timeout_event):
+    def __init__(self, _username, _password, _hostname, _flight_id, _timeout_event,
+        _address=None, _port=None, _local_root=None, _trace=None, _progress=None, _store=None, _settings=None,
+        _source=None, _throttle=None, _clock=None):
+
+        load_paramiko()
+
+        # Address and port default to the station's hostname on port 22, but can
+        # be overridden to reach a data station simulator (see `avionics.simulator`)
+        self.__address = _address or _hostname
+        self.__port = _port or self.PORT
+
+        if _local_root is not None:
+            self.LOCAL_ROOT_DATA_DIRECTORY = _local_root
 
         # Update destination directories to include hostname for data differentiation
         self.__hostname, self.__network_suffix = _hostname.split('.')
         self.LOCAL_FIELD_DATA_DESTINATION = os.path.join(self.LOCAL_ROOT_DATA_DIRECTORY, str(_flight_id), self.__hostname)
-        # self.LOCAL_LOG_DESTINATION = '%s/%s/%s/' % (self.LOCAL_ROOT_DATA_DIRECTORY, _flight_id, self.__hostname)
+
+        # Logs are mirrored per station rather than per flight so only new or changed logs are fetched
+        self.LOCAL_LOG_DESTINATION = os.path.join(self.LOCAL_ROOT_DATA_DIRECTORY, 'logs', self.__hostname)
+        self.LOCAL_THUMBNAIL_DESTINATION = os.path.join(self.LOCAL_ROOT_DATA_DIRECTORY, self.THUMBNAIL_DIRECTORY,
+                                                        str(_flight_id), self.__hostname)
+        self.__flight_id = _flight_id
 
         # TODO: change from password to public key cryptography
         # Login credentials
@@ -51,27 +109,92 @@ class SFTPClient(object):
         self.__hostname = _hostname
 
         self.__timeout_event = _timeout_event
+        self.__trace = _trace   # Visit trace for SFTP operation and transfer counters
+        self.__progress = _progress # Called with the size in bytes of every downloaded file
+
+        # Optional `ContentStore`, files are then kept once per content and linked into the flight directory
+        self.__store = _store
+
+        # Optional `tuner.TransferSettings` for the SSH window and field data reads, otherwise paramiko's defaults
+        self.__settings = _settings
+
+        # Source address or network interface the connection is bound to, otherwise the OS picks the route
+        self.__source = _source
+
+        # Called with the size of every chunk of field data received, may sleep to pace the session
+        self.__throttle = _throttle
+
+        # Time for the manifest cache's age and the log budget, simulated in tests
+        self.__clock = _clock or SystemClock()
+
+        # (remote path, local path relative to the station directory, digest or None, size) of every downloaded file
+        self.downloaded_files = []
+
+        # (remote path, local path, captured at, camera ID, thumbnail size) of every file previewed in progressive mode
+        self.previewed_files = []
+
+        self.__manifest_path = os.path.join(self.LOCAL_ROOT_DATA_DIRECTORY, self.MANIFEST_DIRECTORY,
+                                            '%s.json' % _hostname.split('.')[0])
+        self.__manifest = self._load_manifest()    # Remote directory -> `Listing` from the last visit
+        self.__listing = {}                         # Remote directory -> `Listing` from this visit
 
-        host_keys = paramiko.util.load_host_keys(os.path.expanduser('/home/pi/.ssh/known_hosts'))
+        try:
+            host_keys = paramiko.util.load_host_keys(os.path.expanduser('/home/pi/.ssh/known_hosts'))
+        except IOError:
+            logging.debug("No known_hosts file, not verifying data station host key")
+            host_keys = {}
         logging.getLogger("paramiko").setLevel(logging.INFO)
 
         if self.__hostname in host_keys:
             self.__hostkeytype = host_keys[self.__hostname].keys()[0]
             self.__hostkey = host_keys[self.__hostname][self.__hostkeytype]
 
+    def _socket(self):
+        """Returns what paramiko should connect over, a socket bound to the source if one is given
+
+        A source that is an IP address is bound as the local address, anything
+        else is taken as an interface name (Linux only, needs CAP_NET_RAW).
+        """
+
+        if self.__source is None:
+            return (self.__address, self.__port)
+
+        try:
+            ipaddress.ip_address(self.__source)
+        except ValueError:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.__source.encode('utf-8') + b'\0')
+                sock.connect((self.__address, self.__port))
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        return socket.create_connection((self.__address, self.__port), source_address=(self.__source, 0))
+
     def connect(self, timeout=60000):
         # now, connect and use paramiko Transport to negotiate SSH2 across the connection
         logging.info("Connecting to data station... [hostname: %s]" % (self.__hostname))
 
         # Timeout is handled by Navigation.
         try:
-            self.__transport = paramiko.Transport((self.__hostname, self.PORT)) # Speeds up download speed
+            if self.__settings is not None:
+                window_size = int(self.__settings.window_mb * 1024 * 1024)
+            else:
+                window_size = paramiko.common.DEFAULT_WINDOW_SIZE
+            self.__transport = paramiko.Transport(self._socket(), default_window_size=window_size)
 
             # Compress files on data station before sending over Wi-Fi to drone
-            self.__transport.connect(self.__host_key, self.__username, self.__password,
-                                     gss_host=socket.getfqdn(self.__hostname),
-                                     gss_auth = self.USE_GSS_API,
-                                     gss_kex = self.DO_GSS_API_KEY_EXCHANGE)
+            # GSS-API arguments are only passed when enabled, newer paramiko
+            # releases no longer accept them
+            if self.USE_GSS_API or self.DO_GSS_API_KEY_EXCHANGE:
+                self.__transport.connect(self.__host_key, self.__username, self.__password,
+                                         gss_host=socket.getfqdn(self.__hostname),
+                                         gss_auth = self.USE_GSS_API,
+                                         gss_kex = self.DO_GSS_API_KEY_EXCHANGE)
+            else:
+                self.__transport.connect(self.__host_key, self.__username, self.__password)
 
             self.__sftp = paramiko.SFTPClient.from_transport(self.__transport)
 
@@ -80,6 +203,7 @@ class SFTPClient(object):
 
             # Ensure remote root data directory exists
             try:
+                count(self.__trace, 'sftp_ops', op='mkdir')
                 self.__sftp.mkdir(self.REMOTE_ROOT_DATA_DIRECTORY)
             except IOError:
                 logging.debug(
@@ -87,17 +211,12 @@ class SFTPClient(object):
 
             # Ensure remote field data directory exists
             try:
+                count(self.__trace, 'sftp_ops', op='mkdir')
                 self.__sftp.mkdir(self.REMOTE_FIELD_DATA_SOURCE)
             except IOError:
                 logging.debug(
                     '{0} remote field data directory already exists'.format(self.REMOTE_FIELD_DATA_SOURCE))
 
-            # # Ensure remote log directory exists
-            # try:
-            #     self.__sftp.mkdir(self.REMOTE_LOG_SOURCE)
-            # except IOError:
-            #     logging.debug('{0} remote log directory already exists'.format(self.REMOTE_LOG_SOURCE))
-
             # `os.makedirs()` recursively creates entire file path so ./data/ is created in the process of creating
             # local destination directory (./data/field/)
 
@@ -105,9 +224,9 @@ class SFTPClient(object):
             if not os.path.exists(self.LOCAL_FIELD_DATA_DESTINATION):
                 os.makedirs(self.LOCAL_FIELD_DATA_DESTINATION)
 
-            # # Ensure local log data directory exists
-            # if not os.path.exists(self.LOCAL_LOG_DESTINATION):
-            #     os.makedirs(self.LOCAL_LOG_DESTINATION)
+            # Ensure local log data directory exists
+            if not os.path.exists(self.LOCAL_LOG_DESTINATION):
+                os.makedirs(self.LOCAL_LOG_DESTINATION)
 
             self.is_connected = True
 
@@ -124,6 +243,7 @@ class SFTPClient(object):
 
         # Ensure there's something to fetch
         try:
+            count(self.__trace, 'sftp_ops', op='mkdir')
             self.__sftp.mkdir(remote_path)
         except IOError:
             logging.debug('{0} remote field data directory already exists'.format(remote_path))
@@ -132,6 +252,7 @@ class SFTPClient(object):
 
         directory_contents = []
         try:
+            count(self.__trace, 'sftp_ops', op='listdir')
             directory_contents = self.__sftp.listdir(remote_path)
         except IOError as e:
             logging.error(e)
@@ -143,15 +264,88 @@ class SFTPClient(object):
     def downloadFile(self, remote_path, local_destination, file_name):
         """
         Download remote file to given local destination
+
+        The file only appears under its name once it is complete, a
+        transfer cut short leaves nothing behind.
         """
         logging.info("Downloading file: %s" % (file_name))
+        remote_file = os.path.join(remote_path, file_name)
+        local_file = os.path.join(local_destination, file_name)
         try:
-            self.__sftp.get(os.path.join(remote_path,file_name), os.path.join(local_destination,file_name))
+            if not os.path.exists(local_destination):
+                os.makedirs(local_destination, exist_ok=True)
+
+            count(self.__trace, 'sftp_ops', op='get')
+            if self.__store is None:
+                try:
+                    self.__sftp.get(remote_file, local_file + '.part',
+                                    callback=self._transferCallback(), **self._prefetchArgs())
+                except BaseException:
+                    if os.path.exists(local_file + '.part'):
+                        os.remove(local_file + '.part')
+                    raise
+                os.replace(local_file + '.part', local_file)
+                digest, size = None, os.path.getsize(local_file)
+            else:
+                digest, size = self._storeFile(remote_file, local_file)
+
+            self.downloaded_files.append((remote_file, os.path.relpath(local_file, self.LOCAL_FIELD_DATA_DESTINATION),
+                                          digest, size))
         except IOError as e:
             logging.error(e)
         except socket.timeout:
             logging.error("Listing remote directories timeout")
 
+    def _transferCallback(self):
+        """paramiko progress callback handing each received chunk's size to the throttle"""
+
+        if self.__throttle is None:
+            return None
+
+        received = [0]
+        def callback(transferred, total):
+            self.__throttle(transferred - received[0])
+            received[0] = transferred
+        return callback
+
+    def _prefetchArgs(self):
+        """
+        Keyword arguments limiting the read requests kept in flight per field
+        data file. paramiko before 3.3 can't limit them and always keeps all
+        of them in flight.
+        """
+        if self.__settings is None or self.__settings.prefetch_requests is None or not prefetch_limit:
+            return {}
+        return {'max_concurrent_prefetch_requests': self.__settings.prefetch_requests}
+
+    def _storeFile(self, remote_file, local_file):
+        """Streams a remote file into the content store, hashing it on the way, returns (digest, size)"""
+
+        spool = self.__store.open()
+        try:
+            self.__sftp.getfo(remote_file, spool, callback=self._transferCallback(), **self._prefetchArgs())
+        except BaseException:
+            spool.discard()
+            raise
+
+        digest, size, duplicate = self.__store.add(spool, local_file)
+        if duplicate:
+            logging.debug("Already stored: %s (%s)", remote_file, digest)
+            count(self.__trace, 'store_duplicate_bytes', size)
+
+        return digest, size
+
+    def _localDirectory(self, remote_path):
+        """Local directory mirroring a remote field data directory
+
+        Same-named files from different cards and DCIM folders stay apart, and
+        the camera's own folder limit keeps every local directory small.
+        Files redownloaded from `.tmp` go back where they were first stored.
+        """
+        relative = os.path.relpath(remote_path, self.REMOTE_FIELD_DATA_SOURCE)
+        parts = [part for part in relative.split(os.sep) if part not in ('', '.', '.tmp')]
+        return os.path.join(self.LOCAL_FIELD_DATA_DESTINATION, *parts)
+
     def moveFileToTmp(self, remote_path, file_name):
         """
         Move file to /.tmp/ directory on sensor to await second pass deletion
@@ -161,13 +355,17 @@ class SFTPClient(object):
         # TODO: Eliminate the need for a .tmp directory creation with each move
         # Make sure '.tmp' exists in current directory
         try:
+            count(self.__trace, 'sftp_ops', op='mkdir')
             self.__sftp.mkdir(os.path.join(remote_path, '.tmp'))
         except IOError:
             logging.debug('{0} remote log directory already exists'.format(os.path.join(remote_path, '.tmp')))
 
         oldpath = os.path.join(remote_path, file_name)
         newpath = os.path.join(remote_path, '.tmp', file_name)
+        count(self.__trace, 'sftp_ops', op='rename')
         self.__sftp.rename(oldpath, newpath)
+        self._invalidate(remote_path)
+        self._invalidate(os.path.join(remote_path, '.tmp'))
 
     def deleteFile(self, remote_path, file_name):
         """
@@ -175,7 +373,9 @@ class SFTPClient(object):
         """
         logging.info("Deleting file from data station: %s" % (os.path.join(remote_path,file_name)))
         try:
+            count(self.__trace, 'sftp_ops', op='remove')
             self.__sftp.remove(os.path.join(remote_path,file_name))
+            self._invalidate(remote_path)
         except IOError as e:
             logging.error(e)
         except socket.timeout:
@@ -183,6 +383,7 @@ class SFTPClient(object):
 
     # NOTICE: Make sure to close the SFTP connection after download is complete
     def close(self):
+        self._save_manifest()
         logging.debug("Closing connection to data station... [hostname: %s]" % (self.__hostname))
         self.__sftp.close()
         logging.info("Connection to data station closed [hostname: %s]" % (self.__hostname))
@@ -192,30 +393,237 @@ class SFTPClient(object):
     # Field data methods
     # -----------------------
 
-    def _walk(self, remote_path):
+    def _load_manifest(self):
+        try:
+            with open(self.__manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if self.__clock.time() - manifest.get('saved_at', 0) > self.MANIFEST_MAX_AGE_S:
+            logging.debug("Directory manifest is stale, re-listing everything")
+            return {}
+
+        # Compacted one directory at a time, the JSON of each is dropped as we go
+        directories = manifest.get('directories', {})
+        listings = {}
+        while directories:
+            path, entry = directories.popitem()
+            listings[path] = Listing.from_json(entry)
+        return listings
+
+    def _save_manifest(self):
+        """Keep this visit's listings for the next one, only directories seen this visit are kept
+
+        Written one directory at a time, the whole manifest is never held as JSON.
+        """
+
+        if not self.__listing:
+            return
+
+        try:
+            directory = os.path.dirname(self.__manifest_path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            tmp_path = self.__manifest_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write('{"saved_at": %s, "directories": {' % json.dumps(self.__clock.time()))
+                for index, (path, listing) in enumerate(self.__listing.items()):
+                    f.write('%s%s: %s' % (', ' if index else '', json.dumps(path), json.dumps(listing.to_json())))
+                f.write('}}')
+            os.rename(tmp_path, self.__manifest_path)
+        except (IOError, OSError) as e:
+            logging.error("Failed to save directory manifest: %s", e)
+
+    def _invalidate(self, remote_path):
+        """Forget a directory's listing after changing it
+
+        Directory mtimes only have one second resolution, so a change made in
+        the same second as the listing would otherwise go unnoticed.
+        """
+        self.__listing.pop(remote_path, None)
+        self.__manifest.pop(remote_path, None)
+
+    def _walk_attr(self, remote_path, mtime=None):
+        """
+        Yields (path, `FileColumns`) for every directory that has files
+
+        A directory whose mtime hasn't changed since the last visit has the
+        same entries, so its cached listing is used instead of listing it
+        again. That costs one `stat` per directory, and nothing for
+        subdirectories of a directory that was re-listed since the listing
+        already has their mtimes. Changes to a file's contents don't change
+        its directory's mtime, so cached sizes may be out of date; they're
+        only used for ordering and the byte quota.
+
+        Directories are read entry by entry (`listdir_iter`) straight into
+        columns, a large folder is never held as `SFTPAttributes`.
+        """
+
         path=remote_path
-        files=[]
-        folders=[]
 
-        for f in self.__sftp.listdir_attr(remote_path):
-            if S_ISDIR(f.st_mode):
-                folders.append(f.filename)
-            else:
-                files.append(f.filename)
+        if mtime is None:
+            count(self.__trace, 'sftp_ops', op='stat')
+            mtime = self.__sftp.stat(remote_path).st_mtime
+
+        # Listings from earlier in this visit are the most recent
+        cached = self.__listing.get(remote_path) or self.__manifest.get(remote_path)
 
-        if files:
-            yield path, files
+        if cached is not None and cached.mtime == mtime:
+            count(self.__trace, 'manifest_hits')
+            listing = cached
+        else:
+            listing = Listing(mtime)
 
-        for folder in folders:
+            count(self.__trace, 'sftp_ops', op='listdir')
+            for f in self.__sftp.listdir_iter(remote_path):
+                if S_ISDIR(f.st_mode):
+                    listing.folders.append((f.filename, f.st_mtime))
+                else:
+                    listing.files.append(f.filename, f.st_size, f.st_mtime)
+
+        self.__listing[remote_path] = listing
+
+        if len(listing.files):
+            yield path, listing.files
+
+        for folder, folder_mtime in listing.folders:
             new_path = os.path.join(remote_path, folder)
-            for x in self._walk(new_path):
+            for x in self._walk_attr(new_path, None if listing is cached else folder_mtime):
                 yield x
 
-    # TODO: ensure this handles files with same name in different directories
-    def downloadNewFieldData(self):
+    def _manifest(self, remote_path):
+        """Returns a `Manifest` of every file below `remote_path`"""
+
+        manifest = Manifest()
+        for path, files in self._walk_attr(remote_path):
+            manifest.add(path, files)
+        return manifest
+
+    def _downloaded(self, file_size):
+        count(self.__trace, 'bytes_downloaded', file_size)
+        count(self.__trace, 'files_downloaded')
+        if self.__progress is not None:
+            self.__progress(file_size)
+
+    def _is_thumbnail_directory(self, path):
+        return os.path.basename(path.rstrip('/')) == self.THUMBNAIL_DIRECTORY
+
+    def _readExifHeader(self, remote_file):
+        """
+        Read a remote JPEG's EXIF segment with a few small reads
+
+        Returns the start of image marker followed by the APP1 segment, or
+        just the marker if the file has none within `PREVIEW_HEADER_BYTES`.
+        Segments before it (e.g. JFIF) are skipped without being read.
+        """
+        count(self.__trace, 'sftp_ops', op='open')
+        with self.__sftp.open(remote_file, 'rb') as f:
+            start = f.read(2)
+            if start != b'\xff\xd8':
+                raise ValueError("%s is not a JPEG" % remote_file)
+
+            offset = 2
+            while offset < self.PREVIEW_HEADER_BYTES:
+                f.seek(offset)
+                marker = f.read(4)
+                if len(marker) < 4 or marker[0] != 0xFF or marker[1] in (0xDA, 0xD9):
+                    break
+
+                length = struct.unpack('>H', marker[2:])[0]
+                if marker[1] == 0xE1:
+                    return start + marker + f.read(length - 2)
+                offset += 2 + length
+
+        return start
+
+    def _readStationThumbnail(self, remote_file):
+        count(self.__trace, 'sftp_ops', op='open')
+        with self.__sftp.open(remote_file, 'rb') as f:
+            return f.read()
+
+    def downloadPreviews(self, files, station_thumbnails=()):
+        """
+        Download a thumbnail of every remote JPEG ahead of any full file (progressive mode)
+
+        The thumbnail the station made itself is used if there is one,
+        otherwise the one the camera embedded in the file's EXIF header, read
+        with a few small reads at the start of the file. Thumbnails go where
+        the ingest pipeline puts them, and files stay where they are on the
+        station until they are downloaded in full.
+
+        Returns number of previews and bytes read.
+        """
+
+        num_previews = 0
+        preview_bytes = 0
+
+        for remote_file in files:
+            if (self.__timeout_event.is_set()): # Quit early, full files get whatever time is left
+                logging.debug("Timeout raised, exiting previews")
+                break
+
+            remote_path = os.path.join(remote_file.path, remote_file.filename)
+            local_path = os.path.relpath(os.path.join(self._localDirectory(remote_file.path), remote_file.filename),
+                                         self.LOCAL_FIELD_DATA_DESTINATION)
+            thumbnail_file = os.path.join(self.LOCAL_THUMBNAIL_DESTINATION, local_path)
+            if os.path.exists(thumbnail_file):
+                continue    # Previewed on an earlier visit this flight
+
+            station_thumbnail = os.path.join(remote_file.path, self.THUMBNAIL_DIRECTORY, remote_file.filename)
+            try:
+                if station_thumbnail in station_thumbnails:
+                    thumbnail = self._readStationThumbnail(station_thumbnail)
+                    read = len(thumbnail)
+                    try:
+                        info = parse_exif(thumbnail)
+                    except ValueError:
+                        info = None
+                else:
+                    header = self._readExifHeader(remote_path)
+                    read = len(header)
+                    info = parse_exif(header)
+                    thumbnail = info.thumbnail
+            except (IOError, ValueError) as e:
+                logging.debug("No preview of %s: %s", remote_path, e)
+                continue
+            except socket.timeout:
+                logging.error("Preview timeout")
+                continue
+
+            preview_bytes += read
+            count(self.__trace, 'preview_bytes', read)
+
+            thumbnail_size = None
+            if thumbnail:
+                directory = os.path.dirname(thumbnail_file)
+                if not os.path.exists(directory):
+                    os.makedirs(directory, exist_ok=True)
+                with open(thumbnail_file + '.part', 'wb') as f:
+                    f.write(thumbnail)
+                os.replace(thumbnail_file + '.part', thumbnail_file)
+                thumbnail_size = len(thumbnail)
+
+            captured_at, camera_id = (info.captured_at, info.camera_id) if info else (None, None)
+            if thumbnail_size or captured_at or camera_id:
+                self.previewed_files.append((remote_path, local_path, captured_at, camera_id, thumbnail_size))
+                count(self.__trace, 'previews')
+                num_previews += 1
+
+        logging.info("Previewed %d files (%d bytes)", num_previews, preview_bytes)
+
+        return num_previews, preview_bytes
+
+    def downloadNewFieldData(self, order=DEFAULT_ORDER, byte_quota_mb=None, progressive=False):
         """
         Download all data station field data
-        Recurses from /media/ dir to download all data
+        Recurses from /media/ dir to build a manifest of all field data, then
+        downloads it in the order given by the station's ordering policy (see
+        `ordering.py`), stopping early once `byte_quota_mb` is reached.
+
+        In progressive mode a thumbnail of every file is fetched first (see
+        `downloadPreviews`), full files then get the rest of the window.
 
         Returns number of files to be downloaded as well as files successfully downloaded.
         """
@@ -225,42 +633,54 @@ class SFTPClient(object):
         new_data_downloaded_mb = 0
         did_find_device = False # A hacky test for the exitence of any file other than `/media/usb*/`
 
-        for path, files in self._walk(self.REMOTE_FIELD_DATA_SOURCE):
-            if not (path.endswith('.tmp') or path.endswith('.tmp/')):
-
-                # Loop through all files and count number to be downloaded
-                # This is separate from the loop below to account for inaccurate
-                # counts as a result of a failed download or download timeout.
-                for file in files:
-                    if (not file.startswith('.')) and (file.endswith('.JPG') or file.endswith('.JPEG') or file.endswith('.jpg') or file.endswith('.jpeg')):
-                        num_files_to_download+=1
-                    # Search for any file (other than '/media/usb*/') to signal that *something* is there
-                    # Also, we only need a single case to verify that it works
-
-                    # This is ugly, but it catches what SFTP returns when no data is available
-                    if (
-                        not (file.endswith('/') or file.endswith('usb0') or file.endswith('usb1')
-                        or file.endswith('usb2') or file.endswith('usb3') or file.endswith('usb4')
-                        or file.endswith('usb5')  or file.endswith('usb6') or file.endswith('usb7')
-                        or file.endswith('logs') or file == 'usb') and not did_find_device
-                      ):
-                        did_find_device = True
-
-                # Download files
-                for file in files:
-                    if (not file.startswith('.')) and (file.endswith('.JPG') or file.endswith('.JPEG') or file.endswith('.jpg') or file.endswith('.jpeg')):
-
-                        if (self.__timeout_event.is_set()): # Quit early and return data
-                            logging.debug("Timeout raised, exiting download")
-                            return num_files_downloaded, num_files_to_download, did_find_device, new_data_downloaded_mb
-
-                        try:
-                            self.downloadFile(path, self.LOCAL_FIELD_DATA_DESTINATION, file)
-                            new_data_downloaded_mb+=os.path.getsize(os.path.join(self.LOCAL_FIELD_DATA_DESTINATION, file)) / 1024 / 1024 # get size and conver to megabytes
-                            self.moveFileToTmp(path, file)
-                            num_files_downloaded+=1
-                        except: # Don't move file to tmp if error is raised in download
-                            pass
+        # Build the full manifest before downloading anything so that the
+        # ordering policy sees every file on the station.
+        # This also keeps the count separate from the download loop to account
+        # for inaccurate counts as a result of a failed download or download timeout.
+        manifest = self._manifest(self.REMOTE_FIELD_DATA_SOURCE)
+        is_data_directory = lambda path: not self._is_thumbnail_directory(path)
+
+        field_data = manifest.select(self.FIELD_DATA_SUFFIXES, is_data_directory, tmp=False, hidden=False)
+
+        # Search for any file (other than '/media/usb*/') to signal that *something* is there
+        # This catches what SFTP returns when no data is available
+        for f in manifest.select(directory=is_data_directory, tmp=False):
+            if not (f.filename.endswith(self.PLACEHOLDER_SUFFIXES) or f.filename == 'usb'):
+                did_find_device = True
+                break
+
+        num_files_to_download = len(field_data)
+
+        byte_quota = None
+        if byte_quota_mb is not None:
+            byte_quota = byte_quota_mb * 1024 * 1024
+
+        if progressive:
+            # Remote paths of thumbnails the station made itself
+            station_thumbnails = set(os.path.join(f.path, f.filename)
+                                     for f in manifest.select(directory=self._is_thumbnail_directory))
+            self.downloadPreviews(order_files(field_data, order), station_thumbnails)
+
+        # Download files
+        for remote_file in order_files(field_data, order, byte_quota):
+            path, file = remote_file.path, remote_file.filename
+
+            if (self.__timeout_event.is_set()): # Quit early and return data
+                logging.debug("Timeout raised, exiting download")
+                return num_files_downloaded, num_files_to_download, did_find_device, new_data_downloaded_mb
+
+            try:
+                local_directory = self._localDirectory(path)
+                self.downloadFile(path, local_directory, file)
+                file_size = os.path.getsize(os.path.join(local_directory, file))
+                new_data_downloaded_mb+=file_size / 1024 / 1024 # get size and conver to megabytes
+                self._downloaded(file_size)
+                self.moveFileToTmp(path, file)
+                num_files_downloaded+=1
+            except (IOError, EOFError, paramiko.SSHException): # Don't move file to tmp if error is raised in download
+                pass
+            except Exception:
+                logging.exception("Unexpected error downloading %s", os.path.join(path, file))
 
         return num_files_downloaded, num_files_to_download, did_find_device, new_data_downloaded_mb
 
@@ -278,30 +698,30 @@ class SFTPClient(object):
         num_files_downloaded = 0
         old_data_downloaded_mb = 0
 
-        for path, files in self._walk(self.REMOTE_FIELD_DATA_SOURCE):
-            # Recurse into /media/ and download only `.tmp` directories
-            if path.endswith('.tmp') or path.endswith('.tmp/'):
-                # Loop through all files and count number to be downloaded
-                # This is separate from the loop below to account for inaccurate
-                # counts as a result of a failed download or download timeout.
-
-                for file in files:
-                    if (not file.startswith('.')) and (file.endswith('.JPG') or file.endswith('.JPEG') or file.endswith('.jpg') or file.endswith('.jpeg')):
-                        num_files_to_download+=1
+        # Recurse into /media/ and download only `.tmp` directories
+        # Files are counted before the loop below to account for inaccurate
+        # counts as a result of a failed download or download timeout.
+        field_data = self._manifest(self.REMOTE_FIELD_DATA_SOURCE).select(self.FIELD_DATA_SUFFIXES, tmp=True, hidden=False)
+        num_files_to_download = len(field_data)
 
-                for file in files:
-                    if (not file.startswith('.')) and (file.endswith('.JPG') or file.endswith('.JPEG') or file.endswith('.jpg') or file.endswith('.jpeg')):
+        for remote_file in field_data:
+            path, file = remote_file.path, remote_file.filename
 
-                        if (self.__timeout_event.is_set()): # Quit early and return data
-                            logging.debug("Timeout raised, exiting download")
-                            return num_files_downloaded, num_files_to_download, old_data_downloaded_mb
+            if (self.__timeout_event.is_set()): # Quit early and return data
+                logging.debug("Timeout raised, exiting download")
+                return num_files_downloaded, num_files_to_download, old_data_downloaded_mb
 
-                        try:
-                            self.downloadFile(path, self.LOCAL_FIELD_DATA_DESTINATION, file)
-                            old_data_downloaded_mb+=os.path.getsize(os.path.join(self.LOCAL_FIELD_DATA_DESTINATION, file)) / 1024 / 1024 # get size and conver to megabytes
-                            num_files_downloaded+=1
-                        except:
-                            pass
+            try:
+                local_directory = self._localDirectory(path)
+                self.downloadFile(path, local_directory, file)
+                file_size = os.path.getsize(os.path.join(local_directory, file))
+                old_data_downloaded_mb+=file_size / 1024 / 1024 # get size and conver to megabytes
+                self._downloaded(file_size)
+                num_files_downloaded+=1
+            except (IOError, EOFError, paramiko.SSHException):
+                pass
+            except Exception:
+                logging.exception("Unexpected error downloading %s", os.path.join(path, file))
 
         return num_files_downloaded, num_files_to_download, old_data_downloaded_mb
 
@@ -312,7 +732,187 @@ class SFTPClient(object):
         download and this method is called unless the flight operator has ordered
         a redownload of previously downloaded data.
         """
-        for path, files in self._walk(self.REMOTE_FIELD_DATA_SOURCE):
-            if path.endswith('.tmp') or path.endswith('.tmp/'):
-                for file in files:
-                    self.deleteFile(path, file)
+        for remote_file in self._manifest(self.REMOTE_FIELD_DATA_SOURCE).select(tmp=True):
+            self.deleteFile(remote_file.path, remote_file.filename)
+
+    # -----------------------
+    # Data station log methods
+    # -----------------------
+
+    def downloadLogs(self, budget_s):
+        """
+        Collect data station logs for at most `budget_s` seconds, or until the
+        download is cancelled. Called once field data is done so it only uses
+        the idle tail of the visit.
+
+        Logs changed since the last collection are tarred and gzipped on the
+        station when it allows command execution, otherwise changed files are
+        fetched one by one over SFTP.
+
+        Returns number of log files (or archives) and bytes downloaded.
+        """
+
+        deadline = self.__clock.monotonic() + budget_s
+
+        try:
+            return self._downloadLogArchive(deadline)
+        except (paramiko.SSHException, socket.error) as e:
+            logging.debug("Can't compress logs on data station (%s), fetching over SFTP", e)
+
+        return self._downloadLogFiles(deadline)
+
+    def _out_of_time(self, deadline):
+        return self.__timeout_event.is_set() or self.__clock.monotonic() > deadline
+
+    def _downloadLogArchive(self, deadline):
+        marker_path = os.path.join(self.LOCAL_LOG_DESTINATION, '.last_collected')
+        try:
+            with open(marker_path) as f:
+                since = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            since = 0
+
+        # Station clock, so the next collection starts from the station's idea of now
+        try:
+            remote_now = int(self._exec('date +%s', deadline).strip())
+        except ValueError:
+            logging.warning("Can't read the data station's clock, skipping log collection")
+            return 0, 0
+
+        archive_path = os.path.join(self.LOCAL_LOG_DESTINATION, '%s_%d.tar.gz' % (self.__flight_id, remote_now))
+        command = ('cd %s && find . -type f -newermt @%d -print0 | tar czf - --null -T -'
+                   % (self.REMOTE_LOG_SOURCE, since))
+
+        tmp_path = archive_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                complete = self._exec(command, deadline, f)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        if not complete:
+            os.remove(tmp_path)
+            logging.info("Log collection out of time")
+            return 0, 0
+
+        try:
+            with tarfile.open(tmp_path) as archive:
+                members = archive.getmembers()
+        except tarfile.TarError as e:
+            logging.warning("Station log archive is unreadable (%s), dropping it", e)
+            os.remove(tmp_path)
+            return 0, 0
+
+        with open(marker_path, 'w') as f:
+            f.write(str(remote_now))
+
+        if not members:
+            logging.info("No new station logs")
+            os.remove(tmp_path)
+            return 0, 0
+
+        os.rename(tmp_path, archive_path)
+
+        size = os.path.getsize(archive_path)
+        count(self.__trace, 'log_bytes_downloaded', size)
+        logging.info("Downloaded compressed logs: %s (%d bytes)", archive_path, size)
+        return 1, size
+
+    def _exec(self, command, deadline, out=None):
+        """
+        Run a command on the data station. Without `out` returns its output,
+        otherwise streams it into `out` and returns whether it completed
+        successfully before the deadline.
+        """
+
+        count(self.__trace, 'sftp_ops', op='exec')
+        channel = self.__transport.open_session()
+        channel.settimeout(1)
+        output = []
+
+        try:
+            channel.exec_command(command)
+            while True:
+                if self._out_of_time(deadline):
+                    return False if out is not None else ''
+                try:
+                    data = channel.recv(32768)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                if out is not None:
+                    out.write(data)
+                else:
+                    output.append(data)
+
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+        if status != 0:
+            raise paramiko.SSHException("'%s' exited with status %d" % (command.split()[0], status))
+
+        if out is not None:
+            return True
+        return b''.join(output).decode('utf-8')
+
+    def _downloadLogFiles(self, deadline):
+        num_files_downloaded = 0
+        bytes_downloaded = 0
+
+        try:
+            walk = list(self._walk_attr(self.REMOTE_LOG_SOURCE))
+        except IOError as e:
+            logging.debug("No logs on data station: %s", e)
+            return 0, 0
+
+        for path, files in walk:
+            local_path = os.path.join(self.LOCAL_LOG_DESTINATION, os.path.relpath(path, self.REMOTE_LOG_SOURCE))
+            if not os.path.exists(local_path):
+                os.makedirs(local_path)
+
+            for filename, size, mtime in files.rows():
+                if self._out_of_time(deadline):
+                    logging.info("Log collection out of time")
+                    return num_files_downloaded, bytes_downloaded
+
+                local_file = os.path.join(local_path, filename)
+                if (os.path.exists(local_file) and os.path.getsize(local_file) == size
+                        and os.path.getmtime(local_file) >= mtime):
+                    continue    # Unchanged since the last collection
+
+                if self._downloadLogFile(path, local_path, filename):
+                    os.utime(local_file, (mtime, mtime))
+                    num_files_downloaded += 1
+                    bytes_downloaded += size
+                    count(self.__trace, 'log_bytes_downloaded', size)
+
+        return num_files_downloaded, bytes_downloaded
+
+    def _downloadLogFile(self, remote_path, local_path, file_name):
+        """Fetches one log file, returns whether it arrived
+
+        Unlike `downloadFile`, logs are not field data: they aren't recorded in
+        `downloaded_files`, so they stay out of the files table, the content
+        store, ingest and the export manifest.
+        """
+
+        remote_file = os.path.join(remote_path, file_name)
+        local_file = os.path.join(local_path, file_name)
+        try:
+            count(self.__trace, 'sftp_ops', op='get')
+            try:
+                self.__sftp.get(remote_file, local_file + '.part')
+            except BaseException:
+                if os.path.exists(local_file + '.part'):
+                    os.remove(local_file + '.part')
+                raise
+            os.replace(local_file + '.part', local_file)
+            return True
+        except IOError as e:
+            logging.error(e)
+        except socket.timeout:
+            logging.error("Log download timeout: %s", remote_file)
+        return False
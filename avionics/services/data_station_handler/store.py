@@ -0,0 +1,146 @@
+"""
+Content-addressed store for downloaded field data.
+
+A redownload writes the same files into the new flight's directory again, and
+a file whose `.tmp` rename failed on the station is transferred again on the
+next visit. With the store enabled, every file is hashed as it streams in and
+kept once under its SHA-256 digest:
+
+    <local root>/.store/objects/3f/a2c4...      one copy per distinct content
+    <local root>/<flight_id>/<station_id>/IMG_0001.JPG   hardlink to the object
+
+Files up to `SPOOL_BYTES` are held in memory until their digest is known, so a
+duplicate is never written to the SD card at all. Larger files are spooled to
+`.store/tmp/` and dropped if they turn out to be duplicates.
+
+Flight directories look exactly as they do without the store, so export and
+retention work on either. An object whose last flight link is removed is
+deleted by `collect_garbage`.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+
+class _Spool(object):
+    """File-like sink that hashes what is written and spills to disk past `SPOOL_BYTES`"""
+
+    def __init__(self, store):
+        self._store = store
+        self._hash = hashlib.sha256()
+        self._buffer = io.BytesIO()
+        self._file = None
+        self.path = None    # Spill file, once there is one
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+
+        if self._file is None and self.size > self._store.SPOOL_BYTES:
+            fd, self.path = tempfile.mkstemp(dir=self._store.tmp_directory)
+            self._file = os.fdopen(fd, 'wb')
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+
+        if self._file is None:
+            self._buffer.write(data)
+        else:
+            self._file.write(data)
+
+        return len(data)
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def save(self, path):
+        """Moves the content to `path`"""
+
+        if self._file is None:
+            with open(path + '.part', 'wb') as f:
+                f.write(self._buffer.getvalue())
+            os.replace(path + '.part', path)
+        else:
+            self._file.close()
+            os.replace(self.path, path)
+
+    def discard(self):
+        self._buffer = None
+        if self._file is not None:
+            self._file.close()
+            os.remove(self.path)
+
+
+class ContentStore(object):
+    """Stores files once under their digest and hardlinks them into flight directories"""
+
+    DIRECTORY = '.store'
+    SPOOL_BYTES = 16 * 1024 * 1024  # Largest file kept in memory until its digest is known
+
+    def __init__(self, local_root):
+        self.root = os.path.join(local_root, self.DIRECTORY)
+        self.objects_directory = os.path.join(self.root, 'objects')
+        self.tmp_directory = os.path.join(self.root, 'tmp')
+
+        for directory in [self.objects_directory, self.tmp_directory]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_directory, digest[:2], digest[2:])
+
+    def open(self):
+        """Returns a sink to stream a file into, pass it to `add` once complete"""
+        return _Spool(self)
+
+    def add(self, spool, view_path):
+        """Stores the spooled file and links it at `view_path`
+
+        Returns (digest, size, duplicate), `duplicate` is True if the content
+        was already in the store and nothing new was written.
+        """
+
+        digest = spool.digest
+        object_path = self.object_path(digest)
+
+        duplicate = os.path.exists(object_path)
+        if duplicate:
+            spool.discard()
+        else:
+            directory = os.path.dirname(object_path)
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            spool.save(object_path)
+
+        # Replace whatever is at the view path, a redownload into the same flight links again
+        link_path = view_path + '.link'
+        try:
+            os.link(object_path, link_path)
+        except OSError as e:
+            # File systems without hardlinks get a copy
+            logging.warning("Could not hardlink %s, copying: %s", view_path, e)
+            shutil.copyfile(object_path, link_path)
+        os.replace(link_path, view_path)
+
+        return digest, spool.size, duplicate
+
+    def collect_garbage(self):
+        """Deletes objects no flight directory links to any more, returns bytes freed"""
+
+        freed = 0
+        for root, _, files in os.walk(self.objects_directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.lstat(path)
+                    if stat.st_nlink == 1:
+                        os.remove(path)
+                        freed += stat.st_size
+                except OSError as e:
+                    logging.warning("Could not collect %s: %s", path, e)
+
+        return freed
@@ -2,22 +2,23 @@
 General utilities (functions and objects) used for data mule mission code.
 """
 
-import time
+from ..clock import SystemClock
 
 class Timer(object):
     """
     Timer function that monitors time elapsed when started.
     """
-    def __init__(self):
+    def __init__(self, _clock=None):
+        self.clock = _clock or SystemClock()
         self.start_timer()
 
     def start_timer(self):
         """Start the timer"""
-        self.start = time.time()
+        self.start = self.clock.time()
 
     def time_elapsed(self):
         """Return the time elapsed since the timer was started"""
-        return time.time()-self.start
+        return self.clock.time()-self.start
 
     def time_stamp(self):
         """Create and return a time stamp string for logging purposes"""
@@ -0,0 +1,134 @@
+"""
+Per-station transfer tuning from visit history.
+
+The SSH window, the number of read requests kept in flight per file and the
+boot delay were one global value, although the best values depend on the
+station's link and card. With auto-tuning on, every visit that transfers
+field data records the settings it used and the throughput it achieved in the
+`transfer_tuning` table, and the next visit to that station picks its
+settings from that history:
+
+* Each setting takes the candidate with the best effect on throughput over
+  the station's recent visits (exploit).
+* Values the station has never tried are tried first, one per visit, and
+  after that a visit changes one setting to a random candidate with
+  probability `EPSILON` (explore).
+
+Settings are ranked separately (see `_effects`) rather than as whole
+combinations, so a station converges after a season of visits instead of
+having to try every combination. Throughput is data over connection and transfer time, which is what
+a shorter boot delay or a wider window buys.
+"""
+
+import collections
+import logging
+import random
+
+from .database import Database
+
+# Transfer settings for one visit
+TransferSettings = collections.namedtuple('TransferSettings', [
+    'window_mb',            # SSH channel window, how much data may be in flight
+    'prefetch_requests',    # SFTP read requests in flight per file (paramiko 3.3+), None for all of them at once
+    'boot_delay_share',     # Share of the handler's boot delay waited before the first connection
+])
+
+# paramiko's own settings, used when tuning is off
+DEFAULT_SETTINGS = TransferSettings(window_mb=2, prefetch_requests=None, boot_delay_share=1.0)
+
+# Values each setting is chosen from
+CANDIDATES = TransferSettings(
+    window_mb=(1, 2, 4, 8),
+    prefetch_requests=(16, 64, None),
+    boot_delay_share=(0.5, 0.75, 1.0),
+)
+
+class TransferTuner(object):
+    """Chooses transfer settings per data station with an epsilon-greedy policy"""
+
+    EPSILON = 0.2       # Chance of a visit exploring a random value of one setting
+    HISTORY = 30        # Number of recent visits the choice is based on
+    FIT_ITERATIONS = 10
+
+    def __init__(self, _db=None, _random=None):
+        self.db = _db or Database()
+        self.random = _random or random.Random()
+
+    def _effects(self, history):
+        """Returns {setting: {value: effect on throughput}} fitted to the visits in `history`
+
+        Throughput is modelled as a baseline plus one effect per setting,
+        fitted by backfitting: each setting's effects are refitted in turn to
+        what the other settings leave unexplained. Unlike plain means per
+        value, a value tried alongside a poor value of another setting isn't
+        blamed for it.
+        """
+
+        visits = []
+        effects = dict((name, {}) for name in TransferSettings._fields)
+        for settings, throughput_mbps in history:
+            values = dict((name, settings.get(name, getattr(DEFAULT_SETTINGS, name))) for name in TransferSettings._fields)
+            visits.append((values, throughput_mbps))
+            for name, value in values.items():
+                if value in getattr(CANDIDATES, name):
+                    effects[name][value] = 0.0
+
+        if not visits:
+            return effects
+
+        baseline = sum(t for _, t in visits) / len(visits)
+
+        for _ in range(self.FIT_ITERATIONS):
+            for name in TransferSettings._fields:
+                residuals = collections.defaultdict(list)
+                for values, throughput_mbps in visits:
+                    if values[name] in effects[name]:
+                        others = sum(effects[o].get(values[o], 0) for o in TransferSettings._fields if o != name)
+                        residuals[values[name]].append(throughput_mbps - baseline - others)
+                effects[name] = dict((value, sum(r) / len(r)) for value, r in residuals.items())
+
+        return effects
+
+    def best(self, data_station_id):
+        """Returns the `TransferSettings` with the best fitted throughput so far, defaults where untried"""
+
+        effects = self._effects(self.db.get_transfer_results(data_station_id, self.HISTORY))
+
+        values = []
+        for name in TransferSettings._fields:
+            if effects[name]:
+                values.append(max(effects[name], key=effects[name].get))
+            else:
+                values.append(getattr(DEFAULT_SETTINGS, name))
+
+        return TransferSettings(*values)
+
+    def choose(self, data_station_id):
+        """Returns the `TransferSettings` for the next visit to a data station"""
+
+        history = self.db.get_transfer_results(data_station_id, self.HISTORY)
+        effects = self._effects(history)
+        best = self.best(data_station_id)
+
+        # Values never tried come first, then an occasional random one
+        untried = [(name, value) for name in TransferSettings._fields
+                   for value in getattr(CANDIDATES, name) if value not in effects[name]]
+
+        if untried:
+            name, value = self.random.choice(untried)
+        elif self.random.random() < self.EPSILON:
+            name = self.random.choice(TransferSettings._fields)
+            value = self.random.choice(getattr(CANDIDATES, name))
+        else:
+            name, value = None, None
+
+        # Only one setting differs from the best so far, its throughput isn't mixed up with another's
+        settings = best._replace(**{name: value}) if name is not None else best
+        logging.debug("Transfer settings for station %s after %d tuned visits: %s",
+                      data_station_id, len(history), settings)
+        return settings
+
+    def record(self, data_station_id, flight_id, settings, throughput_mbps):
+        """Records the throughput a visit achieved with its settings"""
+
+        self.db.insert_transfer_result(data_station_id, flight_id, settings._asdict(), throughput_mbps)
@@ -3,6 +3,46 @@ import time
 import logging
 import os
 import hashlib
+import random
+import collections
+import threading
+
+from ..clock import SystemClock
+from ..metrics import count, registry
+
+
+class RetryPolicy(collections.namedtuple('RetryPolicy', ['initial_delay_s', 'factor', 'max_delay_s', 'jitter', 'max_attempts'])):
+    """When to resend an unacknowledged XBee command
+
+    The first resend happens `initial_delay_s` after the first send, or just
+    after the station's expected reply time when that is known. Each later
+    wait is `factor` times longer, up to `max_delay_s`, and randomised by
+    +/- `jitter` so retries to several stations don't keep colliding. A
+    `max_attempts` of None keeps sending until the timeout.
+    """
+
+    __slots__ = ()
+
+    LATENCY_MARGIN = 1.5    # Resend after this many expected reply times
+    LATENCY_SLACK_S = 0.1
+    MIN_DELAY_S = 0.2
+
+    def delay(self, attempt, expected_latency_s=None, rng=random):
+        """Seconds to wait for an ACK after send number `attempt` (starting at 1)"""
+
+        if expected_latency_s:
+            base = expected_latency_s * self.LATENCY_MARGIN + self.LATENCY_SLACK_S
+        else:
+            base = self.initial_delay_s
+
+        delay = min(self.max_delay_s, base * self.factor ** (attempt - 1))
+        delay *= rng.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(self.MIN_DELAY_S, delay)
+
+RetryPolicy.__new__.__defaults__ = (1.0, 2.0, 8.0, 0.2, None)
+
+# Outcome of a command sent with `XBee.command`
+CommandResult = collections.namedtuple('CommandResult', ['acknowledged', 'attempts', 'latency_s'])
 
 class XBee(object):
 
@@ -13,21 +53,33 @@ class XBee(object):
     instruct the data station's microcontroller to boot the data station computer
     and initiate the download over Wi-Fi.
 
-    Todo:
-        * Wake up data station when on the way so it's ready when we arrive
+    Several stations can be sent the same command in one burst (`send_group`,
+    `command_group`) so a cluster of stations boots while we're on the way.
 
     """
 
-    def __init__(self, serial_port="/dev/ttyUSB0"):
+    FRAME_LENGTH = 5    # Start delimiter, 3 character station ID, command code
+
+    def __init__(self, serial_port="/dev/ttyUSB0", clock=None):
 
         self.xbee_port = None
         self.encode = None
         self.decode = None
         self.data_station_id = None
         self.serial_port = serial_port
+        self.clock = clock or SystemClock()
+        self.recorder = None    # Records the port's traffic once connected (see `services.recorder`)
 
         self.start_delimiter = '~' # 0x7E in ASCII
 
+        self.retry_policy = RetryPolicy()
+        self.poll_interval_s = 0.05    # How often to check for an ACK while waiting
+        self._rng = random.Random()
+
+        self._rx_buffer = ''    # Received bytes not yet parsed into a frame
+        self._acks = {}         # (station ID, command) -> monotonic time the ACK was parsed
+        self._lock = threading.Lock()   # Concurrent station sessions share the port and buffer
+
         # TODO: make single dictionary
         self.encode = {
             'POWER_ON' : '1',
@@ -50,78 +102,160 @@ class XBee(object):
                     self.xbee_port = serial.serial_for_url('loop://', timeout=5)
                 else: # Don't connect to XBee while in development
                     logging.info("In development mode, not connecting to XBee")
+
+                if self.xbee_port is not None and self.recorder is not None:
+                    self.xbee_port = self.recorder.wrap(self.xbee_port, 'xbee')
+
                 break
             except serial.SerialException:
                 logging.error("Failed to connect to xBee device. Retrying connection...")
-                time.sleep(3)
+                self.clock.sleep(3)
+
+    def _frame(self, data_station_id, command):
+        return self.start_delimiter + data_station_id + self.encode[command]
+
+    def send_command(self, data_station_id, command, trace=None):
+        return self.send_group([data_station_id], command, trace)
 
-    def send_command(self, data_station_id, command):
+    def send_group(self, data_station_ids, command, trace=None):
+        """Send the same command to several data stations in a single write
+
+        Each station's microcontroller picks its own frame out of the burst,
+        so the frames go out back to back rather than one write per byte.
+        """
 
         # Immediately return False if in development (XBee not actually connected)
         if os.getenv('DEVELOPMENT') == 'True':
             return False
 
-        identity_code = data_station_id
+        frames = ''.join(self._frame(i, command) for i in data_station_ids)
+
+        logging.debug("XBee TX: %s" % frames)
+        with self._lock:
+            self.xbee_port.write(frames.encode('utf-8'))
+
+        count(trace, 'xbee_tx_frames', len(data_station_ids), command=command)
+        count(trace, 'xbee_tx_bytes', len(frames))
+
+    def _read_frames(self, trace=None):
+        """Parse whatever is waiting on the port into `self._acks`
 
-        logging.debug("XBee TX: %s" % self.start_delimiter)
-        self.xbee_port.write(self.start_delimiter.encode('utf-8'))
+        Partial frames stay buffered until the rest arrives, and ACKs for
+        stations other than the one being waited on are kept for later.
+        """
 
-        logging.debug("XBee TX: %s" % identity_code)
-        self.xbee_port.write(identity_code.encode('utf-8'))
+        with self._lock:
+            self._read_waiting(trace)
 
-        logging.debug("XBee TX: %s" % self.encode[command])
-        self.xbee_port.write(self.encode[command].encode('utf-8'))
+    def _read_waiting(self, trace):
+        waiting = self.xbee_port.in_waiting
+        if waiting > 0:
+            data = self.xbee_port.read(waiting).decode('utf-8', 'replace')
+            count(trace, 'xbee_rx_bytes', len(data))
+            logging.debug("XBee RX: %s" % data)
+            self._rx_buffer += data
 
-    def acknowledge(self, data_station_id, command):
+        while True:
+            start = self._rx_buffer.find(self.start_delimiter)
+            if start < 0:
+                self._rx_buffer = ''
+                return
+            frame = self._rx_buffer[start:start + self.FRAME_LENGTH]
+            if len(frame) < self.FRAME_LENGTH:
+                self._rx_buffer = frame
+                return
+
+            if frame[-1] in self.decode and self.start_delimiter not in frame[1:]:
+                self._acks[(frame[1:4], self.decode[frame[-1]])] = self.clock.monotonic()
+                self._rx_buffer = self._rx_buffer[start + self.FRAME_LENGTH:]
+            else:
+                # Not a frame, resynchronise on the next delimiter
+                self._rx_buffer = self._rx_buffer[start + 1:]
+
+    def acknowledge(self, data_station_id, command, trace=None):
         """
-        Called after command is sent
+        Called after command is sent, returns True once the station's ACK has arrived
         """
 
         # Mimic successful ACK
         if (os.getenv('DEVELOPMENT') == 'True'):
-            time.sleep(5)
+            self.clock.sleep(5)
             return True
 
-        iden_match = False
-        identity_index = 0
-
-        start_delimiter_success = False
+        self._read_frames(trace)
 
-        identity_code = data_station_id
+        return self._acks.pop((data_station_id, command), None) is not None
 
-        command_code = self.encode[command]
-
-        while (self.xbee_port.in_waiting > 0): # There's something in the XBee buffer
-            incoming_byte = self.xbee_port.read().decode('utf-8') # Read a byte at a time
-            logging.debug("XBee RX: %s" % incoming_byte)
-
-            # Third pass: Read command
-            if (iden_match == True):
-                logging.debug("XBee ACK success: %s", str(incoming_byte == command_code))
-                return (incoming_byte == command_code)
+    def command(self, data_station_id, command, timeout_s, expected_latency_s=None, trace=None, policy=None):
+        """
+        Send a command and resend it according to the retry policy until it is
+        acknowledged, the policy runs out of attempts or `timeout_s` passes.
+        Returns a `CommandResult`, with the latency from the first send to
+        the ACK when one arrived.
+        """
 
-            # Second pass: Check for identity match
-            elif (start_delimiter_success == True):
-                logging.debug("XBee checking ID")
-                if (incoming_byte == identity_code[identity_index]):
-                    identity_index += 1
-                else:
-                    start_delimiter_success = False
+        return self.command_group([data_station_id], command, timeout_s, expected_latency_s, trace, policy)[data_station_id]
 
-                iden_match = (identity_index == 3)
+    def command_group(self, data_station_ids, command, timeout_s, expected_latency_s=None, trace=None, policy=None):
+        """
+        `command` for several data stations at once. Every send is a single
+        write with a frame for each station that hasn't acknowledged yet.
+        Returns {station ID: `CommandResult`}.
+        """
 
-            # First pass: Check for start delimiter match
-            elif (incoming_byte == self.start_delimiter):
-                logging.debug("XBee checking start delimiter")
-                start_delimiter_success = True
+        policy = policy or self.retry_policy
+        start = self.clock.monotonic()
+        pending = list(data_station_ids)
+        results = {}
+        attempts = 0
+        first_sent = None
+
+        # An old ACK must not count for this command
+        for i in pending:
+            self._acks.pop((i, command), None)
+
+        while pending:
+            if attempts > 0:
+                count(trace, 'xbee_retries', len(pending), command=command)
+                logging.debug("%s data stations %s, attempt %d", command, ','.join(pending), attempts + 1)
+
+            self.send_group(pending, command, trace)
+            attempts += 1
+            sent = self.clock.monotonic()
+            if first_sent is None:
+                first_sent = sent
+
+            deadline = min(sent + policy.delay(attempts, expected_latency_s, self._rng), start + timeout_s)
+
+            while pending:
+                for i in list(pending):
+                    if self.acknowledge(i, command, trace):
+                        # From the first send: a late ACK to an earlier send
+                        # would look like a near-instant reply to the last one
+                        latency_s = self.clock.monotonic() - first_sent
+                        registry.histogram('xbee_ack_seconds', latency_s, command=command, station_id=i)
+                        logging.debug("%s ACK from data station %s after %.3f s", command, i, latency_s)
+                        results[i] = CommandResult(True, attempts, latency_s)
+                        pending.remove(i)
+
+                remaining = deadline - self.clock.monotonic()
+                if remaining <= 0:
+                    break
+                self.clock.sleep(min(self.poll_interval_s, remaining))
+
+            if not pending:
+                break
+            if self.clock.monotonic() - start >= timeout_s:
+                logging.error("%s command ACK timeout after %d attempts", command, attempts)
+                break
+            if policy.max_attempts is not None and attempts >= policy.max_attempts:
+                logging.error("%s command ACK failure after %d attempts", command, attempts)
+                break
 
-            # Reset
-            else:
-                iden_match = False
-                start_delimiter_success = False
-                identity_index = 0
+        for i in pending:
+            results[i] = CommandResult(False, attempts, None)
 
-        return False # Unsuccessful ACK
+        return results
 
 # XBee hardware isolation debug test
 if __name__ == '__main__':
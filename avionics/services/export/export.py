@@ -0,0 +1,491 @@
+"""
+Post-flight bulk export of downloaded field data
+
+After landing, everything under `/srv/<flight_id>/<station_id>/` is served
+over HTTP so the ground station can pull a flight without logging in and
+copying by hand. Flights and the stations visited on them come from the
+database, files from the flight's directory on disk:
+
+    GET /flights                                    flights with their stations
+    GET /flights/<flight_id>/manifest.json          every station and file of a flight
+    GET /flights/<flight_id>/<station_id>/manifest.json
+    GET /flights/<flight_id>/<station_id>.tar       the station's files as one tar stream
+    GET /flights/<flight_id>/<station_id>/<path>    a single file, Range requests supported
+    GET /thumbnails/<flight_id>/<station_id>/<path> the file's thumbnail, once ingested
+    POST /flights/<flight_id>/exported              confirm a complete copy, see below
+
+The server listens on all interfaces by default, and the payload's Wi-Fi is
+shared with the data stations. With a token set (`EXPORT_TOKEN`), every
+request must carry it as `Authorization: Bearer <token>`. Without one, files
+can be read but confirming an export is refused, since a confirmed flight may
+be deleted.
+
+Files are sent with `os.sendfile` where the platform has it, so the payload's
+CPU stays out of the copy. Each request runs in its own thread, and while a
+station download is in progress requests are turned away with 503 so the
+export never competes with the download for the disk.
+
+Once the client holds every file, it posts the file count and bytes it has.
+If they match the flight manifest, the flight is marked exported in the
+database and its data may be evicted when space runs low (see
+`retention.py`).
+
+Manifest entries carry the EXIF capture time, camera ID and thumbnail size
+of files the ingest pipeline has seen (see `ingest.py`), so the ground
+station can triage a flight from its manifest and thumbnails alone. Files
+only previewed in progressive mode are listed under `previews`.
+
+`pull.py` is the matching client.
+"""
+
+import errno
+import hmac
+import json
+import logging
+import os
+import re
+import socket
+import socketserver
+import tarfile
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from ..data_station_handler.database import Database
+from ..data_station_handler.ingest import THUMBNAIL_DIRECTORY
+from ..data_station_handler.sftp import SFTPClient
+from ..metrics import registry
+
+CHUNK_SIZE = 1024 * 1024                       # Largest single sendfile/copy
+
+_FLIGHTS = re.compile(r'^/flights/?$')
+_FLIGHT_MANIFEST = re.compile(r'^/flights/(\d+)/manifest\.json$')
+_STATION_MANIFEST = re.compile(r'^/flights/(\d+)/(\d+)/manifest\.json$')
+_STATION_ARCHIVE = re.compile(r'^/flights/(\d+)/(\d+)\.tar$')
+_STATION_FILE = re.compile(r'^/flights/(\d+)/(\d+)/(.+)$')
+_THUMBNAIL = re.compile(r'^/thumbnails/(\d+)/(\d+)/(.+)$')
+_FLIGHT_EXPORTED = re.compile(r'^/flights/(\d+)/exported$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Manifest fields of a file the database knows nothing about
+_NO_INDEX = {'digest': None, 'captured_at': None, 'camera_id': None, 'thumbnail_size': None}
+
+def parse_range(header, size):
+    """Returns (start, end) inclusive for a single byte range, None for the whole file
+
+    Raises ValueError when the range can't be satisfied. Multiple ranges are
+    answered with the whole file, which HTTP allows.
+    """
+
+    match = _RANGE.match(header.strip())
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+
+    if first == '':
+        # Suffix range, the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = size - 1 if last == '' else min(int(last), size - 1)
+    if start >= size or end < start:
+        raise ValueError(header)
+
+    return start, end
+
+
+def station_files(directory):
+    """Returns [(relative path, size, mtime)] for every file below a station directory
+
+    Partial downloads and hidden files are skipped.
+    """
+
+    files = []
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        try:
+            entries = list(os.scandir(os.path.join(directory, relative)))
+        except FileNotFoundError:
+            continue
+
+        for entry in entries:
+            if entry.name.startswith('.') or entry.name.endswith('.part'):
+                continue
+            path = os.path.join(relative, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat()
+                files.append((path, stat.st_size, int(stat.st_mtime)))
+
+    files.sort()
+    return files
+
+
+class _ExportRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # Keep-alive, the pull client reuses one connection per worker
+    server_version = 'mission-mule-export'
+
+    def log_message(self, format, *args):
+        logging.debug("Export %s: %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def _authorized(self):
+        """Checks the request's token, answers 401 and returns False if it doesn't match"""
+
+        token = self.server.export.token
+        if token is None:
+            return True
+
+        header = self.headers.get('Authorization', '')
+        if header.startswith('Bearer ') and hmac.compare_digest(header[len('Bearer '):].encode('utf-8'),
+                                                                token.encode('utf-8')):
+            return True
+
+        self._error(401, "Missing or wrong token")
+        return False
+
+    def do_POST(self):
+        path = urllib.parse.unquote(self.path.split('?', 1)[0])
+        match = _FLIGHT_EXPORTED.match(path)
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not self._authorized():
+                return
+            if self.server.export.token is None:
+                # Anyone on the shared Wi-Fi could otherwise get a flight deleted
+                self._error(403, "Export confirmation needs a token, set EXPORT_TOKEN")
+                return
+            if match is None:
+                self._error(404, "Not found")
+                return
+
+            copy = json.loads(body.decode('utf-8'))
+            self._json(self.server.export.confirm_export(match.group(1), copy['files'], copy['bytes']), head=False)
+
+        except LookupError as e:
+            self._error(404, str(e))
+
+        except ValueError as e:
+            self._error(409, str(e))
+
+    def _handle(self, head):
+        export = self.server.export
+        path = urllib.parse.unquote(self.path.split('?', 1)[0])
+
+        if not self._authorized():
+            return
+
+        if export.is_downloading is not None and export.is_downloading.is_set():
+            self._error(503, "Downloading from a data station")
+            return
+
+        try:
+            match = _FLIGHTS.match(path)
+            if match:
+                return self._json(export.flights(), head)
+
+            match = _FLIGHT_MANIFEST.match(path)
+            if match:
+                return self._json(export.flight_manifest(match.group(1)), head)
+
+            match = _STATION_MANIFEST.match(path)
+            if match:
+                return self._json(export.station_manifest(*match.groups()), head)
+
+            match = _STATION_ARCHIVE.match(path)
+            if match:
+                return self._archive(*match.groups(), head=head)
+
+            match = _STATION_FILE.match(path)
+            if match:
+                return self._file(*match.groups(), head=head)
+
+            match = _THUMBNAIL.match(path)
+            if match:
+                return self._file(*match.groups(), head=head, thumbnail=True)
+
+            self._error(404, "Not found")
+
+        except LookupError as e:
+            self._error(404, str(e))
+
+        except (ConnectionError, socket.timeout) as e:
+            # The client went away, there is nobody to answer
+            logging.debug("Export client %s disconnected: %s", self.address_string(), e)
+            self.close_connection = True
+
+    def _error(self, code, message):
+        body = (json.dumps({'error': message}) + '\n').encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, data, head):
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _file(self, flight_id, station_id, relative_path, head, thumbnail=False):
+        path = self.server.export.file_path(flight_id, station_id, relative_path, thumbnail)
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+
+            try:
+                byte_range = parse_range(self.headers.get('Range', ''), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+
+            length = end - start + 1
+            self.send_header('Content-Type', 'image/jpeg' if thumbnail else 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+            self.end_headers()
+
+            if head or length <= 0:
+                return
+
+            self.wfile.flush()
+            self.server.export.send_file(self.connection, f, start, length)
+
+    def _archive(self, flight_id, station_id, head):
+        directory = self.server.export.station_directory(flight_id, station_id)
+
+        # The archive size isn't known up front, so the connection ends with it
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        if head:
+            return
+
+        sent = 0
+        with tarfile.open(fileobj=self.wfile, mode='w|') as archive:
+            for relative_path, size, _ in station_files(directory):
+                archive.add(os.path.join(directory, relative_path), arcname=os.path.join(station_id, relative_path))
+                sent += size
+
+        registry.inc('export_bytes', sent, kind='archive')
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ExportServer(object):
+
+    """
+    Serves downloaded field data from the local root directory over HTTP
+    """
+
+    def __init__(self, _port=8080, _address='', _local_root=None, _db=None, _token=None):
+        self.local_root = _local_root or SFTPClient.LOCAL_ROOT_DATA_DIRECTORY
+        self.db = _db or Database()
+        self.token = _token or None     # Required of every request when set, and for any export confirmation
+        self.is_downloading = None      # Set by `run`, requests are refused while it is set
+
+        self._server = _ThreadingHTTPServer((_address, _port), _ExportRequestHandler)
+        self._server.export = self
+
+    @property
+    def address(self):
+        """(host, port) the server is listening on"""
+        return self._server.server_address
+
+    def run(self, is_downloading=None):
+        logging.info("Export server listening on %s:%d", *self.address)
+        self.is_downloading = is_downloading
+        self._server.serve_forever(poll_interval=0.5)
+        self._server.server_close()
+        logging.info("Export server terminated")
+
+    def stop(self):
+        logging.info("Stopping export server...")
+        self._server.shutdown()
+
+    def flights(self):
+        """[{flight_id, timestamp, stations}] for every flight in the database"""
+
+        flights = self.db.get_flights()
+        for flight in flights:
+            flight['stations'] = [str(s['station_id']) for s in self.db.get_flight_stations(flight['flight_id'])]
+        return flights
+
+    def _station_directory(self, root, flight_id, station_id):
+        """The directory below `root`/<flight_id> a station visited on the flight was written to
+
+        Directories are named after the station ID as the XBee message had it,
+        which may be zero-padded ('007'), while the database keeps the number.
+        """
+
+        number = int(station_id)
+        if number not in set(s['station_id'] for s in self.db.get_flight_stations(flight_id)):
+            raise LookupError("Station %s wasn't visited on flight %s" % (station_id, flight_id))
+
+        flight_directory = os.path.join(root, str(int(flight_id)))
+        try:
+            names = sorted(os.listdir(flight_directory))
+        except (IOError, OSError):
+            names = []
+
+        for name in names:
+            directory = os.path.join(flight_directory, name)
+            if name.isdigit() and int(name) == number and os.path.isdir(directory):
+                return directory
+
+        raise LookupError("No data for station %s on flight %s" % (station_id, flight_id))
+
+    def station_directory(self, flight_id, station_id):
+        return self._station_directory(self.local_root, flight_id, station_id)
+
+    def station_manifest(self, flight_id, station_id, stats=None):
+        """Files downloaded from a station on a flight, plus the visit statistics if known"""
+
+        directory = self.station_directory(flight_id, station_id)
+        files = station_files(directory)
+
+        if stats is None:
+            stats = self.db.get_flight_station_stats(station_id, flight_id) or {}
+
+        # Digests are known when the content store is used and let the client
+        # skip content it already has, metadata once the file is ingested
+        index = self.db.get_file_index(station_id, flight_id)
+
+        # Files only previewed in progressive mode, their thumbnails are all there is
+        on_disk = set(path for path, _, _ in files)
+        previews = [dict(entry, path=path) for path, entry in sorted(index.items())
+                    if path not in on_disk and entry['thumbnail_size']]
+
+        return {
+            'flight_id': int(flight_id),
+            'station_id': os.path.basename(directory),
+            'successful_downloads': stats.get('successful_downloads'),
+            'total_files': stats.get('total_files'),
+            'total_bytes': sum(size for _, size, _ in files),
+            'files': [dict(_NO_INDEX, **index.get(path, {}), path=path, size=size, mtime=mtime) for path, size, mtime in files],
+            'previews': previews,
+        }
+
+    def flight_manifest(self, flight_id):
+        """Station manifests of every station visited on a flight that has data on disk"""
+
+        visits = self.db.get_flight_stations(flight_id)
+        if not visits:
+            raise LookupError("No such flight %s" % flight_id)
+
+        stations = []
+        for stats in visits:
+            try:
+                stations.append(self.station_manifest(flight_id, stats['station_id'], stats))
+            except LookupError:
+                continue    # Visited, but nothing was downloaded
+
+        return {
+            'flight_id': int(flight_id),
+            'total_bytes': sum(s['total_bytes'] for s in stations),
+            'stations': stations,
+        }
+
+    def confirm_export(self, flight_id, files, total_bytes):
+        """Marks the flight exported if the ground station's copy matches the manifest
+
+        Raises ValueError if it doesn't.
+        """
+
+        manifest = self.flight_manifest(flight_id)
+        expected_files = sum(len(s['files']) for s in manifest['stations'])
+
+        if (files, total_bytes) != (expected_files, manifest['total_bytes']):
+            raise ValueError("Copy has %d files, %d bytes, flight has %d files, %d bytes" % (
+                files, total_bytes, expected_files, manifest['total_bytes']))
+
+        self.db.mark_flight_exported(flight_id)
+        logging.info("Flight %s exported: %d files, %d bytes", flight_id, files, total_bytes)
+
+        return {'flight_id': int(flight_id), 'exported': True}
+
+    def thumbnail_directory(self, flight_id, station_id):
+        return self._station_directory(os.path.join(self.local_root, THUMBNAIL_DIRECTORY), flight_id, station_id)
+
+    def file_path(self, flight_id, station_id, relative_path, thumbnail=False):
+        """Resolves a requested file or its thumbnail, refusing anything outside the station directory"""
+
+        if thumbnail:
+            directory = self.thumbnail_directory(flight_id, station_id)
+        else:
+            directory = self.station_directory(flight_id, station_id)
+        path = os.path.realpath(os.path.join(directory, relative_path))
+
+        if not path.startswith(os.path.realpath(directory) + os.sep) or not os.path.isfile(path):
+            raise LookupError("No such file %s" % relative_path)
+
+        return path
+
+    @staticmethod
+    def send_file(connection, f, offset, length):
+        """Sends `length` bytes of `f` from `offset`, zero-copy where possible"""
+
+        sent = 0
+        if hasattr(os, 'sendfile'):
+            try:
+                while sent < length:
+                    n = os.sendfile(connection.fileno(), f.fileno(), offset + sent, min(CHUNK_SIZE, length - sent))
+                    if n == 0:
+                        break
+                    sent += n
+            except OSError as e:
+                # Not every file system and socket pair supports sendfile, copy instead
+                if sent or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+
+        if sent < length:
+            f.seek(offset + sent)
+            remaining = length - sent
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                connection.sendall(data)
+                remaining -= len(data)
+                sent += len(data)
+
+        registry.inc('export_bytes', sent, kind='file')
+        return sent
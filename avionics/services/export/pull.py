@@ -0,0 +1,279 @@
+"""
+Pull a flight's field data from the payload's export server
+
+    python3 -m avionics.services.export.pull http://payload.local:8080 12 ./flights --jobs 8
+
+Files land in `<destination>/<flight_id>/<station_id>/<path>`. Files that are
+already there with the manifest's size are skipped, and a file interrupted
+part way through continues from its `.part` file with a Range request, so
+re-running after a dropped link only fetches what is missing.
+
+Files the payload kept in its content store come with a digest. Content
+already pulled before, from any flight, is hardlinked locally instead of
+fetched again; digests of pulled files are kept in
+`<destination>/.digests.json`.
+
+When a whole flight is on disk, the copy is confirmed to the payload, which
+may then free the flight's space when it runs low. Pass `--no-confirm` to
+keep it.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import urllib.parse
+
+CHUNK_SIZE = 1024 * 1024
+
+PullResult = collections.namedtuple('PullResult', ['files', 'skipped', 'failed', 'bytes', 'seconds', 'exported'])
+
+class Puller(object):
+    """Fetches a flight over parallel keep-alive connections"""
+
+    def __init__(self, url, destination, jobs=4, timeout_s=60, token=None):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.destination = destination
+        self.jobs = jobs
+        self.timeout_s = timeout_s
+        self.token = token      # The export server's EXPORT_TOKEN, if it has one
+
+        self._local = threading.local()
+
+        # Digest -> path relative to the destination of content pulled before
+        self._digests_path = os.path.join(destination, '.digests.json')
+        self._digests_lock = threading.Lock()
+        try:
+            with open(self._digests_path) as f:
+                self._digests = json.load(f)
+        except (IOError, ValueError):
+            self._digests = {}
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout_s)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, path, headers=None, body=None):
+        """GET (or POST with a body) with one reconnect, the server may have closed an idle connection"""
+
+        for attempt in range(2):
+            connection = self._connection()
+            headers = dict(headers or {})
+            if self.token:
+                headers['Authorization'] = 'Bearer %s' % self.token
+            try:
+                connection.request('GET' if body is None else 'POST', urllib.parse.quote(path),
+                                   body=body, headers=headers)
+                return connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def get_json(self, path):
+        response = self._request(path)
+        body = response.read()
+        if response.status != 200:
+            raise IOError("GET %s: %d %s" % (path, response.status, body.decode('utf-8', 'replace').strip()))
+        return json.loads(body.decode('utf-8'))
+
+    def post_json(self, path, data):
+        body = json.dumps(data).encode('utf-8')
+        response = self._request(path, {'Content-Type': 'application/json'}, body)
+        reply = response.read()
+        if response.status != 200:
+            raise IOError("POST %s: %d %s" % (path, response.status, reply.decode('utf-8', 'replace').strip()))
+        return json.loads(reply.decode('utf-8'))
+
+    def manifest(self, flight_id, station_id=None):
+        if station_id is None:
+            return self.get_json('/flights/%s/manifest.json' % flight_id)
+        return {'flight_id': int(flight_id), 'stations': [self.get_json('/flights/%s/%s/manifest.json' % (flight_id, station_id))]}
+
+    def fetch(self, flight_id, station_id, entry):
+        """Downloads one file, returns the bytes transferred (0 if already complete)"""
+
+        local_path = os.path.join(self.destination, str(flight_id), str(station_id), entry['path'])
+        if os.path.exists(local_path) and os.path.getsize(local_path) == entry['size']:
+            return 0
+
+        directory = os.path.dirname(local_path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        if self._link_known(entry, local_path):
+            return 0
+
+        part_path = local_path + '.part'
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > entry['size']:
+            offset = 0
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+
+        response = self._request('/flights/%s/%s/%s' % (flight_id, station_id, entry['path']), headers)
+        if response.status == 200:
+            offset = 0      # Whole file, start over
+        elif response.status != 206:
+            response.read()
+            raise IOError("%s: %d %s" % (entry['path'], response.status, response.reason))
+
+        received = 0
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+
+        if os.path.getsize(part_path) != entry['size']:
+            raise IOError("%s: incomplete, %d of %d bytes" % (entry['path'], os.path.getsize(part_path), entry['size']))
+
+        os.replace(part_path, local_path)
+        os.utime(local_path, (entry['mtime'], entry['mtime']))
+
+        if entry.get('digest'):
+            with self._digests_lock:
+                self._digests[entry['digest']] = os.path.relpath(local_path, self.destination)
+
+        return received
+
+    def _link_known(self, entry, local_path):
+        """Links content pulled before to `local_path`, returns False if there is none"""
+
+        with self._digests_lock:
+            known = self._digests.get(entry.get('digest'))
+        if known is None:
+            return False
+
+        known_path = os.path.join(self.destination, known)
+        if not os.path.exists(known_path) or os.path.getsize(known_path) != entry['size']:
+            return False
+
+        try:
+            os.link(known_path, local_path + '.link')
+        except OSError:
+            shutil.copyfile(known_path, local_path + '.link')
+        os.replace(local_path + '.link', local_path)
+
+        logging.debug("%s: already pulled as %s", entry['path'], known)
+        return True
+
+    def _save_digests(self):
+        with self._digests_lock:
+            if not self._digests:
+                return
+            with open(self._digests_path + '.part', 'w') as f:
+                json.dump(self._digests, f)
+            os.replace(self._digests_path + '.part', self._digests_path)
+
+    def confirm(self, flight_id, manifest):
+        """Tells the payload the local copy of the flight is complete, returns True if accepted"""
+
+        files = total_bytes = 0
+        for station in manifest['stations']:
+            for entry in station['files']:
+                local_path = os.path.join(self.destination, str(flight_id), str(station['station_id']), entry['path'])
+                if os.path.exists(local_path):
+                    files += 1
+                    total_bytes += os.path.getsize(local_path)
+
+        try:
+            self.post_json('/flights/%s/exported' % flight_id, {'files': files, 'bytes': total_bytes})
+        except IOError as e:
+            logging.error("Export of flight %s not confirmed: %s", flight_id, e)
+            return False
+
+        return True
+
+    def pull(self, flight_id, station_id=None, confirm=True):
+        """Pulls a flight (or one station of it), returns a `PullResult`
+
+        A complete pull of a whole flight is confirmed to the payload unless
+        `confirm` is False.
+        """
+
+        start = time.monotonic()
+        manifest = self.manifest(flight_id, station_id)
+
+        files = skipped = failed = total_bytes = 0
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            futures = {}
+            for station in manifest['stations']:
+                for entry in station['files']:
+                    future = executor.submit(self.fetch, flight_id, station['station_id'], entry)
+                    futures[future] = entry['path']
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    received = future.result()
+                except (IOError, OSError, http.client.HTTPException) as e:
+                    logging.error("Failed to pull %s: %s", futures[future], e)
+                    failed += 1
+                    continue
+
+                files += 1
+                total_bytes += received
+                if received == 0:
+                    skipped += 1
+
+        self._save_digests()
+
+        exported = False
+        if confirm and station_id is None and not failed:
+            exported = self.confirm(flight_id, manifest)
+
+        return PullResult(files, skipped, failed, total_bytes, time.monotonic() - start, exported)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pull a flight's field data from the payload export server")
+    parser.add_argument('url', help='export server, e.g. http://payload.local:8080')
+    parser.add_argument('flight_id', nargs='?', help='flight to pull, omit to list flights')
+    parser.add_argument('destination', nargs='?', default='.')
+    parser.add_argument('--station', help='only pull this data station')
+    parser.add_argument('--jobs', type=int, default=4, help='parallel connections')
+    parser.add_argument('--no-confirm', action='store_true', help="don't let the payload free the flight's space")
+    parser.add_argument('--token', default=os.getenv('EXPORT_TOKEN'), help="the payload's EXPORT_TOKEN")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s',
+                        datefmt="%d %b %Y %H:%M:%S")
+
+    puller = Puller(args.url, args.destination, args.jobs, token=args.token)
+
+    if args.flight_id is None:
+        for flight in puller.get_json('/flights'):
+            sys.stdout.write('%6s  %s  %s\n' % (flight['flight_id'], flight['timestamp'], ','.join(flight['stations'])))
+        return 0
+
+    result = puller.pull(args.flight_id, args.station, not args.no_confirm)
+    mb = result.bytes / 1024 / 1024
+    sys.stdout.write('%d files (%d already present), %d failed, %.1f MB in %.1f s (%.1f MB/s)%s\n' % (
+        result.files, result.skipped, result.failed, mb, result.seconds, mb / max(result.seconds, 1e-6),
+        ', export confirmed' if result.exported else ''))
+
+    return 1 if result.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,16 @@
 import logging
-import time
+import threading
+from ..clock import SystemClock
 
 class Heartbeat(object):
 
-    def __init__(self, _tx_queue, _frequency_millis=1000):
+    def __init__(self, _tx_queue, _frequency_millis=1000, _clock=None):
 
         self.tx_queue = _tx_queue
         self.frequency_millis = _frequency_millis          # Frequency of heartbeat in milliseconds
+        self.clock = _clock or SystemClock()
         self._alive = True
+        self.first_beat = threading.Event()     # Set once the first heartbeat is queued
 
     def run(self, tx_lock, is_downloading):
         logging.info('Heartbeat initiated')
@@ -23,7 +26,8 @@ class Heartbeat(object):
                 self.tx_queue.put((0,b'\x00')) # Tuple with 0 (top) prority
                 tx_lock.release()
                 logging.debug('Heartbeat: idle')
-            time.sleep(self.frequency_millis / 1000)
+            self.first_beat.set()
+            self.clock.sleep(self.frequency_millis / 1000)
 
         logging.error('Heartbeat terminated')
 
@@ -0,0 +1 @@
+from .logger import RateLimitFilter, start_logging, stop_logging
@@ -0,0 +1,134 @@
+"""
+Non-blocking logging pipeline
+
+Log records are put on a bounded in-memory queue by the calling thread and
+written out by a single background `QueueListener` thread, so an SD card
+write stall never holds up the serial reader, heartbeat or download
+threads. High frequency debug lines (XBee bytes, serial RX/TX, heartbeat)
+are rate limited per call site.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from ..metrics import registry
+
+FORMAT = '%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s'
+DATE_FORMAT = "%d %b %Y %H:%M:%S"
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most `rate` records per `per` seconds through from each call site
+
+    Only records at or below `level` are limited, so warnings and errors are
+    never dropped. The first record let through after a suppressed burst
+    says how many similar records were dropped.
+    """
+
+    def __init__(self, rate=10, per=1.0, level=logging.DEBUG):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.per = per
+        self.level = level
+        self._lock = threading.Lock()
+        self._sites = {}    # (pathname, lineno) -> [window start, count, suppressed]
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.per:
+                suppressed = site[2] if site is not None else 0
+                self._sites[key] = [now, 1, 0]
+            elif site[1] < self.rate:
+                site[1] += 1
+                suppressed = 0
+            else:
+                site[2] += 1
+                registry.inc('log_records_suppressed')
+                return False
+
+        if suppressed:
+            record.msg = '%s [%d similar messages suppressed]' % (record.msg, suppressed)
+
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks and defers formatting to the listener"""
+
+    def prepare(self, record):
+        # Tracebacks can't cross to another thread once the frame is gone,
+        # render them now. The message itself is formatted by the listener.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            registry.inc('log_records_dropped')
+
+
+def start_logging(filename, level=logging.INFO, stdout=False, max_bytes=10 * 1024 * 1024,
+    backup_count=5, queue_size=10000, rate=10, per=1.0):
+    """Route all logging through a background thread
+
+    Logs go to `filename`, rotated at `max_bytes` with `backup_count` old
+    files kept, and also to stdout when `stdout` is set.
+    """
+
+    global _listener
+
+    formatter = logging.Formatter(FORMAT, DATE_FORMAT)
+
+    handlers = []
+
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(formatter)
+    handlers.append(file_handler)
+
+    if stdout:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(formatter)
+        handlers.append(stream_handler)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate, per))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+
+    return _listener
+
+def stop_logging():
+    """Flush queued records and stop the background thread"""
+
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
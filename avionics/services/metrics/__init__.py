@@ -0,0 +1 @@
+from .metrics import LATENCY_BUCKETS, MetricsRegistry, Span, Trace, count, registry
@@ -0,0 +1,282 @@
+"""
+Lightweight instrumentation: monotonic spans, counters and a process-wide registry.
+
+Each data station visit gets a `Trace` that records how long every phase
+took (wakeup, connect, transfer, shutdown) and what happened during it
+(bytes, files, retries, XBee traffic, SFTP operations). Finished traces
+are written to a per-visit JSON file and folded into the `registry`, which
+can be exported as Prometheus text or JSON lines.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+PREFIX = 'mission_mule_'
+
+# Histogram bucket upper bounds for latencies, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+
+class MetricsRegistry(object):
+    """Thread-safe store of counters and duration summaries"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}     # (name, labels) -> value
+        self._summaries = {}    # (name, labels) -> [count, sum, max]
+        self._histograms = {}   # (name, labels) -> [bounds, bucket counts, count, sum]
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record one observation (usually a duration in seconds)"""
+        key = _key(name, labels)
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def histogram(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Record one observation into a histogram with the given bucket bounds"""
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [buckets, [0] * len(buckets), 0, 0.0])
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += 1
+            histogram[3] += value
+
+    def get(self, name, **labels):
+        """Return the current value of a counter"""
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def record(self, trace):
+        """Fold a finished trace into the registry"""
+        for span in trace.spans:
+            if span.duration is not None:
+                self.observe('phase_seconds', span.duration, phase=span.name)
+        for (name, labels), value in trace.counters():
+            self.inc(name, value, **dict(labels))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+            self._histograms.clear()
+
+    def to_prometheus(self):
+        """Export in the Prometheus text exposition format"""
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+            histograms = sorted((k, (h[0], list(h[1]), h[2], h[3])) for k, h in self._histograms.items())
+
+        lines = []
+        typed = set()
+
+        for (name, labels), value in counters:
+            metric = PREFIX + name + '_total'
+            if metric not in typed:
+                lines.append('# TYPE %s counter' % metric)
+                typed.add(metric)
+            lines.append('%s%s %s' % (metric, _format_labels(labels), value))
+
+        for (name, labels), (count, total, maximum) in summaries:
+            metric = PREFIX + name
+            if metric not in typed:
+                lines.append('# TYPE %s summary' % metric)
+                typed.add(metric)
+            lines.append('%s_count%s %s' % (metric, _format_labels(labels), count))
+            lines.append('%s_sum%s %s' % (metric, _format_labels(labels), total))
+            lines.append('%s_max%s %s' % (metric, _format_labels(labels), maximum))
+
+        for (name, labels), (bounds, buckets, count, total) in histograms:
+            metric = PREFIX + name
+            if metric not in typed:
+                lines.append('# TYPE %s histogram' % metric)
+                typed.add(metric)
+            cumulative = 0
+            for bound, bucket in zip(bounds, buckets):
+                cumulative += bucket
+                lines.append('%s_bucket%s %s' % (metric, _format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_bucket%s %s' % (metric, _format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_count%s %s' % (metric, _format_labels(labels), count))
+            lines.append('%s_sum%s %s' % (metric, _format_labels(labels), total))
+
+        return '\n'.join(lines) + '\n'
+
+    def to_json_lines(self):
+        """Export as one JSON object per metric"""
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+            histograms = sorted((k, (h[0], list(h[1]), h[2], h[3])) for k, h in self._histograms.items())
+
+        lines = []
+        for (name, labels), value in counters:
+            lines.append(json.dumps({'name': name, 'type': 'counter', 'labels': dict(labels), 'value': value}, sort_keys=True))
+        for (name, labels), (count, total, maximum) in summaries:
+            lines.append(json.dumps({'name': name, 'type': 'summary', 'labels': dict(labels),
+                'count': count, 'sum': total, 'max': maximum}, sort_keys=True))
+        for (name, labels), (bounds, buckets, count, total) in histograms:
+            lines.append(json.dumps({'name': name, 'type': 'histogram', 'labels': dict(labels),
+                'buckets': dict(zip([str(b) for b in bounds], buckets)), 'count': count, 'sum': total}, sort_keys=True))
+
+        return ''.join(line + '\n' for line in lines)
+
+    def write(self, path, format='prometheus'):
+        """Atomically write the registry to a file"""
+
+        if format == 'prometheus':
+            data = self.to_prometheus()
+        else:
+            data = self.to_json_lines()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+
+class Span(object):
+    """A timed phase, measured with the monotonic clock"""
+
+    def __init__(self, name, origin, clock=None):
+        self.name = name
+        self._clock = clock or time
+        self.start = self._clock.monotonic()
+        self.offset = self.start - origin   # Seconds since the trace started
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def elapsed(self):
+        """Time since the span started, whether or not it has finished"""
+        return (self.end or self._clock.monotonic()) - self.start
+
+    def finish(self):
+        if self.end is None:
+            self.end = self._clock.monotonic()
+        return self.duration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finish()
+        return False
+
+
+class Trace(object):
+    """Spans and counters for a single data station visit"""
+
+    def __init__(self, name, _clock=None, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self._clock = _clock
+        self.started_at = (_clock or time).time()
+        self._origin = (_clock or time).monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self.spans = []
+
+    def span(self, name):
+        """Start a new span, use as a context manager or call `finish()`"""
+        span = Span(name, self._origin, self._clock)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def counters(self):
+        with self._lock:
+            return sorted(self._counters.items())
+
+    def merge(self, data):
+        """Fold in the spans and counters of another trace's `to_dict()`, e.g. one recorded in a worker process"""
+
+        shift = data['started_at'] - self.started_at
+        for s in data['spans']:
+            if s['duration_s'] is None:
+                continue
+            span = Span(s['name'], self._origin, self._clock)
+            span.offset = shift + s['offset_s']
+            span.start = self._origin + span.offset
+            span.end = span.start + s['duration_s']
+            with self._lock:
+                self.spans.append(span)
+
+        for c in data['counters']:
+            self.count(c['name'], c['value'], **c['labels'])
+
+    def duration(self, name):
+        """Total duration of all finished spans with the given name"""
+        return sum(s.duration for s in self.spans if s.name == name and s.duration is not None)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'attributes': self.attributes,
+            'started_at': self.started_at,
+            'spans': [{'name': s.name, 'offset_s': s.offset, 'duration_s': s.duration} for s in self.spans],
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters()],
+        }
+
+    def write(self, directory):
+        """Write the trace to `<directory>/<name>.json`, returns the path or None on failure"""
+
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, '%s.json' % self.name)
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            return path
+        except (IOError, OSError) as e:
+            logging.error("Failed to write trace %s: %s", self.name, e)
+            return None
+
+
+# Process-wide registry
+registry = MetricsRegistry()
+
+def count(trace, name, value=1, **labels):
+    """Count into a visit's trace when there is one, otherwise straight into the registry"""
+    if trace is not None:
+        trace.count(name, value, **labels)
+    else:
+        registry.inc(name, value, **labels)
@@ -0,0 +1,125 @@
+"""
+On-demand sampling profiler
+
+When a field pass is slower than expected, send the process SIGUSR1 (or
+the autopilot sends `PROFILE` over serial) and every thread's stack is
+sampled until a second SIGUSR1 or `PROFILE STOP`, or until the duration
+runs out. Samples are written in the collapsed stack format that
+flamegraph.pl and speedscope read:
+
+    Serial Communication Reader;reader (serial_handler.py:71);_read (serial_handler.py:79) 42
+
+Nothing runs while the profiler is off, so it is safe to leave installed in
+flight builds.
+"""
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from ..metrics import registry
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all threads at a fixed interval"""
+
+    def __init__(self, directory='/var/log/mission-mule-profiles/', interval_s=0.01, duration_s=60):
+        self.directory = directory
+        self.interval_s = interval_s
+        self.duration_s = duration_s    # Default time to sample for
+        self.last_path = None           # Output of the last finished run
+
+        self._lock = threading.RLock()   # Also taken from the signal handler
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration_s=None):
+        """Start sampling, returns False if already running"""
+
+        with self._lock:
+            if self.is_running:
+                return False
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(duration_s or self.duration_s,))
+            self._thread.daemon = True
+            self._thread.name = 'Profiler'
+            self._thread.start()
+
+        logging.info("Profiler started for at most %s s", duration_s or self.duration_s)
+        return True
+
+    def stop(self):
+        """Stop sampling, the profile is written by the sampling thread"""
+        self._stop.set()
+
+    def toggle(self, duration_s=None):
+        if self.is_running:
+            self.stop()
+        else:
+            self.start(duration_s)
+
+    def join(self, timeout=None):
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self, duration_s):
+        started_at = time.time()
+        deadline = time.monotonic() + duration_s
+        own = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                stacks[';'.join(reversed(stack))] += 1
+
+            samples += 1
+            self._stop.wait(self.interval_s)
+
+        registry.inc('profiler_samples', samples)
+        self.last_path = self._write(stacks, started_at)
+        logging.info("Profiler stopped after %d samples: %s", samples, self.last_path)
+
+    def _write(self, stacks, started_at):
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, 'profile_%s.folded' % time.strftime('%Y%m%d_%H%M%S', time.localtime(started_at)))
+            with open(path, 'w') as f:
+                for stack, samples in sorted(stacks.items()):
+                    f.write('%s %d\n' % (stack, samples))
+            return path
+        except (IOError, OSError) as e:
+            logging.error("Failed to write profile: %s", e)
+            return None
+
+
+# Process-wide profiler, toggled by SIGUSR1 and the PROFILE control message
+profiler = SamplingProfiler()
+
+def install(signum=signal.SIGUSR1):
+    """Toggle the process-wide profiler on a signal"""
+    signal.signal(signum, lambda signum, frame: profiler.toggle())
@@ -0,0 +1 @@
+from .recorder import Frame, Recorder, RecordingPort, read_recording, RX, TX
@@ -0,0 +1,180 @@
+"""
+Serial and XBee traffic recorder
+
+Reproducing a field problem used to mean flying again. With recording on,
+every read from and write to the autopilot serial port and the XBee port is
+appended to a compact binary log, which `avionics.simulator.replay` feeds
+back through fake ports at real time or faster.
+
+A recording starts with `MAGIC` and is followed by records of
+
+    uint32  microseconds since the previous record (little endian)
+    uint8   channel, port index * 2 + direction (RX 0, TX 1)
+    uint16  data length
+    bytes   data
+
+Channel `DECLARE` names the next port index (the data is the name), and a
+`GAP` record with no data carries the time of a silence too long for one
+delta. A heartbeat costs 8 bytes, so a flight fits in a few hundred KB.
+"""
+
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'MMREC1\n'
+RECORD = struct.Struct('<IBH')
+MAX_DELTA_US = 0xFFFFFFFF
+MAX_LENGTH = 0xFFFF
+
+RX = 0
+TX = 1
+
+DECLARE = 0xFF
+GAP = 0xFE
+
+# One recorded read or write, `time_s` from the start of the recording
+Frame = collections.namedtuple('Frame', ['time_s', 'port', 'direction', 'data'])
+
+class RecordingPort(object):
+    """Wraps a pyserial port and records what is read from and written to it
+
+    Anything other than reads and writes is passed to the wrapped port.
+    """
+
+    def __init__(self, port, recorder, index):
+        self._port = port
+        self._recorder = recorder
+        self._index = index
+
+    def read(self, size=1):
+        data = self._port.read(size)
+        self._recorder.record(self._index, RX, data)
+        return data
+
+    def readline(self, *args, **kwargs):
+        data = self._port.readline(*args, **kwargs)
+        self._recorder.record(self._index, RX, data)
+        return data
+
+    def write(self, data):
+        written = self._port.write(data)
+        self._recorder.record(self._index, TX, bytes(data))
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+
+class Recorder(object):
+    """Appends timestamped frames of any number of ports to one recording"""
+
+    def __init__(self, path, flush_interval_s=1.0):
+        self.path = path
+        self.flush_interval_s = flush_interval_s   # Longest time a frame stays in the write buffer
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._ports = []
+        self._last = time.monotonic()
+        self._flushed = self._last
+
+        self.frames = 0
+        self.bytes = 0
+
+    def wrap(self, port, name):
+        """Returns `port` wrapped to record its traffic under `name`"""
+
+        with self._lock:
+            index = len(self._ports)
+            self._ports.append(name)
+            self._write(DECLARE, name.encode('utf-8'))
+        logging.info("Recording %s traffic to %s", name, self.path)
+        return RecordingPort(port, self, index)
+
+    def record(self, index, direction, data):
+        if not data:
+            return
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            # Longer frames than a record holds are split, they are rare on either port
+            for start in range(0, len(data), MAX_LENGTH):
+                self._write(index * 2 + direction, data[start:start + MAX_LENGTH])
+
+            self.frames += 1
+            self.bytes += len(data)
+
+            if self._last - self._flushed >= self.flush_interval_s:
+                self._file.flush()
+                self._flushed = self._last
+
+    def _write(self, channel, data):
+        now = time.monotonic()
+        delta_us = int((now - self._last) * 1e6)
+        self._last = now
+
+        while delta_us > MAX_DELTA_US:
+            self._file.write(RECORD.pack(MAX_DELTA_US, GAP, 0))
+            delta_us -= MAX_DELTA_US
+
+        self._file.write(RECORD.pack(delta_us, channel, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                logging.info("Recorded %d frames (%d bytes) to %s", self.frames, self.bytes, self.path)
+
+    def stop(self):
+        self.close()
+
+
+def read_recording(path):
+    """Returns ([port names], [`Frame`]) of a recording
+
+    A recording cut short by a crash is read up to its last complete record.
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a recording" % path)
+
+    ports = []
+    frames = []
+    elapsed_us = 0
+    offset = len(MAGIC)
+
+    while offset + RECORD.size <= len(data):
+        delta_us, channel, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+
+        payload = data[offset:offset + length]
+        offset += length
+        elapsed_us += delta_us
+
+        if channel == DECLARE:
+            ports.append(payload.decode('utf-8'))
+        elif channel != GAP:
+            index, direction = divmod(channel, 2)
+            if index >= len(ports):
+                raise ValueError("Frame for undeclared port %d at byte %d" % (index, offset))
+            frames.append(Frame(elapsed_us / 1e6, ports[index], direction, payload))
+
+    return ports, frames
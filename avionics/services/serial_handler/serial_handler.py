@@ -1,10 +1,12 @@
 import logging
 import os
 import serial
-import time
 import threading
 import queue
 
+from ..clock import SystemClock
+from ..metrics import registry
+
 class SerialHandler(object):
     """Handle serial RX and TX
 
@@ -16,7 +18,7 @@ class SerialHandler(object):
 
     """
 
-    def __init__(self, _port, _baudrate=57600, _timeout=1):
+    def __init__(self, _port, _baudrate=57600, _timeout=1, _clock=None):
 
         self.rx_queue = queue.Queue(maxsize=50)
         self.tx_queue = queue.PriorityQueue(maxsize=50) # Priority 0: heartbeat, Priority 1: otherwise
@@ -29,6 +31,8 @@ class SerialHandler(object):
         self.timeout = _timeout
 
         self.serial = None
+        self.clock = _clock or SystemClock()
+        self.recorder = None    # Records the port's traffic once connected (see `services.recorder`)
 
         self._alive = True
 
@@ -55,10 +59,13 @@ class SerialHandler(object):
                     self.serial = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
                     logging.info("Connected to serial")
 
+                if self.serial is not None and self.recorder is not None:
+                    self.serial = self.recorder.wrap(self.serial, 'serial')
+
                 break
             except serial.SerialException:
                 logging.error("Failed to connect to serial device. Retrying connection...")
-                time.sleep(3)
+                self.clock.sleep(3)
 
     def reader(self):
         """Loop forever and accept messages from autopilot into RX queue"""
@@ -79,6 +86,7 @@ class SerialHandler(object):
 
             if data and data != b'\x00': # Ignore NULL bytes (sent at beginning of connection)
                 logging.debug('RX: %s', data)
+                registry.inc('serial_rx_messages')
                 self.rx_lock.acquire()
                 self.rx_queue.put(data.decode())
                 self.rx_lock.release()
@@ -93,7 +101,7 @@ class SerialHandler(object):
         while self._alive:
             while not self.tx_queue.empty():
                 self._write()   # Pulled out to test
-            time.sleep(0.1) # Check Tx queue again in 100ms (and give the CPU a break!)
+            self.clock.sleep(0.1) # Check Tx queue again in 100ms (and give the CPU a break!)
 
         self._alive = False
         logging.error('Serial writer thread terminated')
@@ -107,6 +115,7 @@ class SerialHandler(object):
 
             if (os.getenv('DEVELOPMENT') != 'True'):
                 self.serial.write(data[1])
+            registry.inc('serial_tx_messages')
 
             self.tx_queue.task_done()
 
@@ -0,0 +1,3 @@
+from .link import LinkProfile, ShapedLink
+from .sftp_server import DataStationSimulator, SyntheticTree
+from .xbee_station import FakeXBeeStation
@@ -0,0 +1,229 @@
+"""
+End-to-end data station benchmark
+
+Runs the real `DataStationHandler` wakeup, connect, download and shutdown
+path against simulated data stations on this machine and reports the phase
+timings recorded in `flights_stations` for every visit.
+
+    python3 -m avionics.simulator.benchmark --stations 3 --files 200 --bandwidth-mbps 20
+
+A heartbeat thread runs alongside the visits, as it does in flight, and the
+worst deviation from its period during each visit is reported as
+`heartbeat_jitter_ms`. Compare `--worker thread` and `--worker process` to
+see how much the download holds up the other threads.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from avionics.services.data_station_handler import DataStationHandler
+from avionics.services.data_station_handler.database import Database
+from avionics.services.data_station_handler.xbee import XBee
+from avionics.services.heartbeat import Heartbeat
+
+from .link import LinkProfile
+from .sftp_server import DataStationSimulator, SyntheticTree
+from .xbee_station import FakeXBeeStation
+
+PHASES = ['wakeup_time_s', 'connection_time_s', 'download_time_s', 'shutdown_time_s']
+
+
+class HeartbeatMonitor(object):
+    """Runs a `Heartbeat` and records when each beat reaches the TX side"""
+
+    def __init__(self, period_ms=100):
+        self.period_ms = period_ms
+        self.tx_queue = queue.PriorityQueue()
+        self.heartbeat = Heartbeat(self.tx_queue, period_ms)
+        self.beats = []
+
+    def _consume(self):
+        while True:
+            self.tx_queue.get()
+            self.beats.append(time.monotonic())
+
+    def start(self):
+        for target, args in [(self.heartbeat.run, (threading.Lock(), threading.Event())), (self._consume, ())]:
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self.heartbeat.stop()
+
+    def jitter_ms(self, start, end):
+        """Worst deviation from the heartbeat period between two monotonic times"""
+        beats = [t for t in self.beats if start <= t <= end]
+        intervals = [(b - a) * 1000 for a, b in zip(beats, beats[1:])]
+        if not intervals:
+            return 0.0
+        return max(abs(i - self.period_ms) for i in intervals)
+
+
+class Mission(object):
+    """A set of simulated data stations wired to a real `DataStationHandler`"""
+
+    def __init__(self, work_dir, stations=1, devices=1, folders_per_device=1, files_per_folder=10,
+        size_distribution=('fixed', 64 * 1024), boot_time_s=0, boot_delay_s=0, ack_delay_s=0.5,
+        link=None, seed=0, worker='thread', exif=False):
+
+        self.work_dir = work_dir
+        self.rx_queue = queue.Queue()
+        self.rx_lock = threading.Lock()
+        self.is_downloading = threading.Event()
+
+        self.db = Database(os.path.join(work_dir, 'avionics.db'))
+
+        self.xbee_station = FakeXBeeStation(ack_delay_s)
+        self.xbee = XBee()
+        self.xbee.xbee_port = self.xbee_station
+
+        self.handler = DataStationHandler(120000, 120000, 900000, self.rx_queue, self.xbee, self.db)
+        self.handler.simulate = False
+        self.handler.boot_delay_s = boot_delay_s
+        self.handler.local_root = os.path.join(work_dir, 'srv')
+        self.handler.trace_directory = os.path.join(work_dir, 'traces')
+        self.handler.download_worker = worker
+
+        self.heartbeat = HeartbeatMonitor().start()
+
+        self.stations = []
+        self.trees = {}
+
+        # A number of stations numbered from 101, or their IDs
+        if isinstance(stations, int):
+            stations = [str(101 + index) for index in range(stations)]
+
+        for index, station_id in enumerate(stations):
+            tree = SyntheticTree(os.path.join(work_dir, 'stations', station_id), devices,
+                folders_per_device, files_per_folder, size_distribution, seed + index, exif)
+            tree.build()
+
+            simulator = DataStationSimulator(station_id, tree.root, boot_time_s, link).start()
+            self.xbee_station.add_station(station_id, simulator)
+            self.handler.station_addresses[station_id] = simulator.address
+
+            self.stations.append(simulator)
+            self.trees[station_id] = tree
+
+    def visit(self, station_id):
+        """Run one full station visit and return its recorded statistics"""
+
+        start = time.monotonic()
+        self.handler.visit(station_id, self.is_downloading)
+        end = time.monotonic()
+        visit_time_s = end - start
+
+        stats = self.db.get_flight_station_stats(station_id, self.handler.flight_id)
+        stats['visit_time_s'] = visit_time_s
+        stats['total_bytes'] = self.trees[station_id].total_bytes
+
+        trace = self.handler.last_trace
+        stats['boot_wait_s'] = trace.duration('boot_wait')
+        stats['connect_attempts'] = trace.get('connect_attempts')
+        stats['xbee_retries'] = trace.get('xbee_retries', command='POWER_ON') + trace.get('xbee_retries', command='POWER_OFF')
+        stats['sftp_ops'] = sum(value for (name, _), value in trace.counters() if name == 'sftp_ops')
+        stats['previews'] = trace.get('previews')
+        stats['heartbeat_jitter_ms'] = self.heartbeat.jitter_ms(start, end)
+        return stats
+
+    def wake_all(self):
+        """Wake every station with one group wake, as the autopilot would ahead of a cluster"""
+        self.handler.handle_message('WAKE %s' % ','.join(s.station_id for s in self.stations), self.is_downloading)
+
+    def run(self, group_wake=False):
+        if group_wake:
+            self.wake_all()
+        return [self.visit(simulator.station_id) for simulator in self.stations]
+
+    def stop(self):
+        self.heartbeat.stop()
+        for simulator in self.stations:
+            simulator.stop()
+
+
+def _print_table(results, out):
+    columns = ['station_id'] + PHASES + ['visit_time_s', 'successful_downloads', 'total_files', 'download_speed_mbps',
+        'heartbeat_jitter_ms']
+    out.write(' '.join('%20s' % c for c in columns) + '\n')
+    for r in results:
+        out.write(' '.join('%20s' % (('%.3f' % r[c]) if isinstance(r[c], float) else r[c]) for c in columns) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark data station visits against local simulated stations')
+    parser.add_argument('--stations', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=1, help='usbN devices per station')
+    parser.add_argument('--folders', type=int, default=1, help='DCIM folders per device')
+    parser.add_argument('--files', type=int, default=50, help='files per folder')
+    parser.add_argument('--size-kb', type=int, default=512, help='mean file size')
+    parser.add_argument('--size-distribution', choices=['fixed', 'uniform', 'lognormal'], default='fixed')
+    parser.add_argument('--boot-time', type=float, default=2, help='simulated station boot time (s)')
+    parser.add_argument('--boot-delay', type=float, default=0, help='payload wait before first connection (s)')
+    parser.add_argument('--ack-delay', type=float, default=0.5, help='XBee ACK delay (s)')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=None)
+    parser.add_argument('--loss', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--group-wake', action='store_true', help='wake all stations before the first visit')
+    parser.add_argument('--worker', choices=['thread', 'process'], default='thread', help='download worker type')
+    parser.add_argument('--content-store', action='store_true', help='keep downloads in the content-addressed store')
+    parser.add_argument('--exif', action='store_true', help='write EXIF headers with embedded thumbnails')
+    parser.add_argument('--progressive', action='store_true', help='fetch thumbnails of every file before full files')
+    parser.add_argument('--autotune', action='store_true', help='choose transfer settings per station from its history')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per visit')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s',
+                        datefmt="%d %b %Y %H:%M:%S")
+
+    size = args.size_kb * 1024
+    if args.size_distribution == 'fixed':
+        distribution = ('fixed', size)
+    elif args.size_distribution == 'uniform':
+        distribution = ('uniform', size // 2, size * 3 // 2)
+    else:
+        distribution = ('lognormal', math.log(size), 0.5)
+
+    link = None
+    if args.latency_ms or args.bandwidth_mbps or args.loss:
+        bandwidth_bps = args.bandwidth_mbps * 1e6 if args.bandwidth_mbps else None
+        link = LinkProfile(args.latency_ms / 1000.0, bandwidth_bps, args.loss, 0.2, args.seed)
+
+    work_dir = tempfile.mkdtemp(prefix='mission-mule-bench-')
+    mission = Mission(work_dir, args.stations, args.devices, args.folders, args.files, distribution,
+        args.boot_time, args.boot_delay, args.ack_delay, link, args.seed, args.worker, args.exif)
+    mission.handler.content_store = args.content_store
+    mission.handler.progressive = args.progressive
+    mission.handler.autotune = args.autotune
+
+    try:
+        results = mission.run(args.group_wake)
+    finally:
+        mission.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        for r in results:
+            sys.stdout.write(json.dumps(r, sort_keys=True) + '\n')
+    else:
+        _print_table(results, sys.stdout)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
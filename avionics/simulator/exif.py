@@ -0,0 +1,65 @@
+"""
+EXIF headers for synthetic field data
+
+Writes the little-endian EXIF APP1 segment a camera trap puts at the start of
+every JPEG: make, model, body serial number, capture time and an embedded
+thumbnail. Only the tags `avionics.services.data_station_handler.exif` reads
+are written.
+"""
+
+import struct
+
+def _ifd(entries, offset, next_offset):
+    """Returns an IFD at `offset` followed by the values that don't fit in its entries
+
+    `entries` is [(tag, value)], strings are written as ASCII and integers as LONG.
+    """
+
+    size = 2 + 12 * len(entries) + 4
+    table = struct.pack('<H', len(entries))
+    values = b''
+
+    for tag, value in sorted(entries):
+        if isinstance(value, int):
+            table += struct.pack('<HHII', tag, 4, 1, value)
+            continue
+
+        encoded = value.encode('ascii') + b'\x00'
+        if len(encoded) <= 4:
+            table += struct.pack('<HHI', tag, 2, len(encoded)) + encoded.ljust(4, b'\x00')
+        else:
+            table += struct.pack('<HHII', tag, 2, len(encoded), offset + size + len(values))
+            values += encoded + (b'\x00' if len(encoded) % 2 else b'')
+
+    return table + struct.pack('<I', next_offset) + values
+
+
+def exif_header(captured_at, make='Simulated', model='Trap', serial=None, thumbnail=None):
+    """Returns the start of a JPEG (SOI and an Exif APP1 segment)
+
+    `captured_at` is a `time.struct_time` or None.
+    """
+
+    ifd0 = [(0x010F, make), (0x0110, model), (0x8769, 0)]
+
+    exif = []
+    if captured_at is not None:
+        exif.append((0x9003, '%04d:%02d:%02d %02d:%02d:%02d' % tuple(captured_at[:6])))
+    if serial is not None:
+        exif.append((0xA431, serial))
+
+    # Sizes don't depend on the pointers, so lay out once to find the offsets
+    exif_offset = 8 + len(_ifd(ifd0, 8, 0))
+    exif_block = _ifd(exif, exif_offset, 0)
+    ifd1_offset = exif_offset + len(exif_block)
+
+    ifd1 = b''
+    if thumbnail is not None:
+        thumbnail_offset = ifd1_offset + 2 + 12 * 2 + 4
+        ifd1 = _ifd([(0x0201, thumbnail_offset), (0x0202, len(thumbnail))], ifd1_offset, 0) + thumbnail
+
+    ifd0 = [(0x010F, make), (0x0110, model), (0x8769, exif_offset)]
+    tiff = b'II*\x00' + struct.pack('<I', 8) + _ifd(ifd0, 8, ifd1_offset if ifd1 else 0) + exif_block + ifd1
+
+    segment = b'Exif\x00\x00' + tiff
+    return b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment
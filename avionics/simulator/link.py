@@ -0,0 +1,130 @@
+import collections
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+
+# Shaping parameters for the Wi-Fi link between payload and data station.
+#
+#   latency_s:     one-way delay added to every chunk
+#   bandwidth_bps: link capacity in bits per second (None for unlimited)
+#   loss:          probability that a chunk is "lost" and has to be resent
+#   rto_s:         delay added for a lost chunk (TCP retransmission timeout);
+#                  later chunks queue up behind it as they would in TCP
+#   seed:          random seed, so the same profile always loses the same chunks
+LinkProfile = collections.namedtuple('LinkProfile', ['latency_s', 'bandwidth_bps', 'loss', 'rto_s', 'seed'])
+LinkProfile.__new__.__defaults__ = (0, None, 0, 0.2, 0)
+
+
+class _Pipe(object):
+    """One direction of a shaped link"""
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, source, destination, profile, rng):
+        self._source = source
+        self._destination = destination
+        self._profile = profile
+        self._rng = rng
+        self._queue = queue.Queue()
+        self.bytes = 0
+
+    def start(self, name):
+        for target in (self._receive, self._send):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.name = name
+            thread.start()
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._source.recv(self.CHUNK_SIZE)
+            except OSError:
+                data = b''
+
+            deliver_at = time.time() + self._profile.latency_s
+            if data and self._rng.random() < self._profile.loss:
+                deliver_at += self._profile.rto_s
+
+            self._queue.put((deliver_at, data))
+            if not data:
+                break
+
+    def _send(self):
+        busy_until = 0
+        while True:
+            deliver_at, data = self._queue.get()
+
+            if data and self._profile.bandwidth_bps:
+                # Chunks are serialized onto the link one after the other
+                busy_until = max(busy_until, time.time()) + len(data) * 8.0 / self._profile.bandwidth_bps
+                deliver_at = max(deliver_at, busy_until)
+
+            delay = deliver_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                if not data:
+                    self._destination.shutdown(socket.SHUT_WR)
+                    break
+                self._destination.sendall(data)
+                self.bytes += len(data)
+            except OSError:
+                break
+
+
+class ShapedLink(object):
+    """TCP proxy that adds latency, a bandwidth cap and loss in front of a server"""
+
+    def __init__(self, target, profile, bind_address='127.0.0.1'):
+        self._target = target
+        self._profile = profile
+        self._rng = random.Random(profile.seed)
+        self._alive = False
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((bind_address, 0))
+
+    @property
+    def address(self):
+        return self._socket.getsockname()[:2]
+
+    def start(self):
+        self._socket.listen(5)
+        self._socket.settimeout(0.2)
+        self._alive = True
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.name = 'Shaped Link %s:%s' % self.address
+        thread.start()
+
+        return self
+
+    def stop(self):
+        self._alive = False
+        self._socket.close()
+
+    def _accept(self):
+        while self._alive:
+            try:
+                client, _ = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            try:
+                upstream = socket.create_connection(self._target)
+            except OSError as e:
+                logging.debug("Shaped link: upstream connection failed: %s", e)
+                client.close()
+                continue
+
+            client.settimeout(None)
+            _Pipe(client, upstream, self._profile, self._rng).start('Shaped Link Uplink')
+            _Pipe(upstream, client, self._profile, self._rng).start('Shaped Link Downlink')
@@ -0,0 +1,272 @@
+"""
+Replay recorded serial and XBee traffic through the real handlers
+
+    python3 -m avionics.simulator.replay mission-mule-recordings/20260612-101500.mmrec --speed 20
+
+A recording made in flight (see `avionics.services.recorder`) is played back
+through `ReplayPort`s, fake pyserial ports that deliver each recorded read at
+its recorded time, or `speed` times sooner. The serial handler, heartbeat
+and a data station handler in simulate mode run against them on a
+`ScaledClock` with the same speed, so a flight's message rates and the
+handlers' timings are reproduced without flying.
+
+What the handlers write is compared with what was written in flight, per
+port and in order. Heartbeats are left out, and repeats of the same write
+(XBee retries) count once. The exit status is 1 if any port differs.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ..services.clock import ScaledClock
+from ..services.data_station_handler.data_station_handler import DataStationHandler
+from ..services.data_station_handler.database import Database
+from ..services.data_station_handler.xbee import XBee
+from ..services.heartbeat import Heartbeat
+from ..services.recorder import RX, TX, read_recording
+from ..services.serial_handler import SerialHandler
+
+HEARTBEATS = (b'\x00', b'\x01')
+
+# Outcome of comparing a port's writes with the recording
+ReplayCheck = collections.namedtuple('ReplayCheck', [
+    'port',
+    'expected',     # Writes recorded in flight
+    'actual',       # Writes made during the replay
+    'mismatches',   # [(index, expected, actual)], None where one side ran out
+])
+
+class ReplayPort(object):
+    """pyserial-like port that plays back one port's recorded reads and keeps what is written
+
+    Implements the part of the pyserial interface the handlers use (`read`,
+    `readline`, `in_waiting`, `write`, `close`), with pyserial's blocking
+    semantics: reads wait up to `timeout` seconds for enough data.
+    """
+
+    def __init__(self, replay, name, timeout=1):
+        self.name = name
+        self.timeout = timeout
+        self.written = []       # Data of every write, in order
+
+        self._replay = replay
+        self._frames = collections.deque(f for f in replay.frames if f.port == name and f.direction == RX)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+
+    def _deliver(self):
+        elapsed_s = self._replay.elapsed_s()
+        while self._frames and self._frames[0].time_s <= elapsed_s:
+            self._buffer.extend(self._frames.popleft().data)
+
+    def _wait(self, ready):
+        """Waits up to `timeout` for `ready(buffer)` to return how many bytes to take, returns them"""
+
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else float('inf'))
+        while True:
+            with self._lock:
+                self._deliver()
+                size = ready(self._buffer)
+                if size or time.monotonic() >= deadline:
+                    size = size or len(self._buffer)
+                    data = bytes(self._buffer[:size])
+                    del self._buffer[:size]
+                    return data
+                next_s = self._replay.until_s(self._frames[0].time_s) if self._frames else deadline - time.monotonic()
+
+            time.sleep(max(0.001, min(next_s, deadline - time.monotonic(), 0.05)))
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._deliver()
+            return len(self._buffer)
+
+    @property
+    def is_drained(self):
+        """True once every recorded read has been delivered and taken"""
+        with self._lock:
+            return not self._frames and not self._buffer
+
+    def read(self, size=1):
+        return self._wait(lambda buffer: size if len(buffer) >= size else 0)
+
+    def readline(self):
+        return self._wait(lambda buffer: buffer.find(b'\n') + 1)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class Replay(object):
+    """A recording and the fake ports replaying it, on one shared timeline"""
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.ports, self.frames = read_recording(path)
+        self.duration_s = self.frames[-1].time_s if self.frames else 0
+        self.replay_ports = {}
+        self._start = None
+
+    def port(self, name, timeout=1):
+        """Returns the fake port replaying `name`, ports not in the recording stay silent"""
+
+        if name not in self.replay_ports:
+            self.replay_ports[name] = ReplayPort(self, name, timeout)
+        return self.replay_ports[name]
+
+    def start(self):
+        self._start = time.monotonic()
+
+    def elapsed_s(self):
+        """Recording time reached so far"""
+        if self._start is None:
+            return 0
+        return (time.monotonic() - self._start) * self.speed
+
+    def until_s(self, time_s):
+        """Real seconds until recording time `time_s`"""
+        return max(0, (time_s - self.elapsed_s()) / self.speed)
+
+    def wait(self, ports=None, timeout_s=None):
+        """Waits for the end of the recording and for every recorded read of `ports` (default all) to be taken
+
+        Returns False if `timeout_s` passed first.
+        """
+
+        ports = [self.port(name) for name in ports] if ports is not None else list(self.replay_ports.values())
+        deadline = None if timeout_s is None else time.monotonic() + timeout_s
+        while not (self.elapsed_s() >= self.duration_s and all(p.is_drained for p in ports)):
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+
+        return True
+
+    def expected(self, name):
+        return [f.data for f in self.frames if f.port == name and f.direction == TX]
+
+    @staticmethod
+    def _outputs(writes, ignore):
+        outputs = []
+        for data in writes:
+            if data in ignore:
+                continue
+            if outputs and outputs[-1] == data:
+                continue    # A retry of the previous write
+            outputs.append(data)
+        return outputs
+
+    def check(self, name, ignore=()):
+        """Returns a `ReplayCheck` of what was written to `name` against the recording"""
+
+        expected = self._outputs(self.expected(name), ignore)
+        actual = self._outputs(self.port(name).written, ignore)
+
+        mismatches = []
+        for index in range(max(len(expected), len(actual))):
+            e = expected[index] if index < len(expected) else None
+            a = actual[index] if index < len(actual) else None
+            if e != a:
+                mismatches.append((index, e, a))
+
+        return ReplayCheck(name, expected, actual, mismatches)
+
+
+def replay_handlers(path, work_dir, speed=1.0, settle_s=2.0):
+    """Replays a recording through the serial handler, heartbeat and data station handler
+
+    The handler's database is created in `work_dir`. Returns ([`ReplayCheck`] for the serial and XBee ports, real seconds taken).
+    """
+
+    replay = Replay(path, speed)
+    clock = ScaledClock(speed)
+    is_downloading = threading.Event()
+
+    ser = SerialHandler('replay', _clock=clock)
+    ser.serial = replay.port('serial', ser.timeout)
+
+    hb = Heartbeat(ser.tx_queue, 500, _clock=clock)
+
+    xbee = XBee(clock=clock)
+    xbee.xbee_port = replay.port('xbee', 5)
+
+    db = Database(os.path.join(work_dir, 'avionics.db'), _clock=clock)
+    dl = DataStationHandler(120000, 120000, 900000, ser.rx_queue, xbee, db, _tx_queue=ser.tx_queue, _clock=clock)
+    dl.simulate = True
+    dl.trace_directory = None
+
+    threads = [
+        threading.Thread(target=hb.run, args=(ser.tx_lock, is_downloading), name='Heartbeat'),
+        threading.Thread(target=ser.reader, name='Serial Communication Reader'),
+        threading.Thread(target=ser.writer, name='Serial Communication Writer'),
+        threading.Thread(target=dl.run, args=(ser.rx_lock, is_downloading), name='Data Station Communication Handler'),
+    ]
+
+    start = time.monotonic()
+    replay.start()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # XBee ACKs are only read when waiting for them, which simulate mode doesn't
+    replay.wait(['serial'])
+
+    # The last arrival may still be in a visit, its answers are part of the replay
+    while ser.rx_queue.unfinished_tasks and dl._alive:
+        time.sleep(0.01)
+    time.sleep(settle_s)
+    elapsed_s = time.monotonic() - start
+
+    for service in [dl, hb, ser]:
+        service.stop()
+
+    return [replay.check('serial', HEARTBEATS), replay.check('xbee')], elapsed_s
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded serial and XBee traffic through the handlers')
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1.0, help='times faster than recorded')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s',
+                        datefmt="%d %b %Y %H:%M:%S")
+
+    # The handlers skip their ports in development mode
+    os.environ['DEVELOPMENT'] = 'False'
+
+    work_dir = tempfile.mkdtemp(prefix='mission-mule-replay-')
+    try:
+        checks, elapsed_s = replay_handlers(args.recording, work_dir, args.speed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    failed = False
+    for check in checks:
+        sys.stdout.write('%-8s %4d writes recorded, %4d replayed, %d mismatches\n' % (
+            check.port, len(check.expected), len(check.actual), len(check.mismatches)))
+        for index, expected, actual in check.mismatches[:10]:
+            sys.stdout.write('    #%d expected %r, got %r\n' % (index, expected, actual))
+        failed = failed or bool(check.mismatches)
+
+    sys.stdout.write('Replayed in %.1f s\n' % elapsed_s)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,385 @@
+import collections
+import logging
+import os
+import random
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+
+from .exif import exif_header
+from .link import ShapedLink
+
+class SyntheticTree(object):
+    """Synthetic `/media/usbN` field data tree written to a local directory
+
+    Files are laid out the way camera traps leave them on a data station:
+
+        <root>/media/usb0/DCIM/100MEDIA/IMG_0001.JPG
+
+    File sizes are drawn from a seeded distribution so that the same
+    arguments always produce the same tree:
+
+        ('fixed', size)
+        ('uniform', low, high)
+        ('lognormal', mu, sigma)    # sizes in bytes, like `random.lognormvariate`
+
+    With `exif`, every file starts with an EXIF header holding the camera
+    serial `CAM-<station>-<device>`, its mtime as the capture time and a 1 KB
+    embedded thumbnail, the way camera traps write them.
+    """
+
+    def __init__(self, root, devices=1, folders_per_device=1, files_per_folder=10,
+        size_distribution=('fixed', 64 * 1024), seed=0, exif=False):
+
+        self.root = root
+        self.devices = devices
+        self.folders_per_device = folders_per_device
+        self.files_per_folder = files_per_folder
+        self.size_distribution = size_distribution
+        self.seed = seed
+        self.exif = exif
+
+        self.total_files = 0
+        self.total_bytes = 0
+
+    def _size(self, rng):
+        kind = self.size_distribution[0]
+        if kind == 'fixed':
+            return int(self.size_distribution[1])
+        elif kind == 'uniform':
+            return rng.randint(self.size_distribution[1], self.size_distribution[2])
+        elif kind == 'lognormal':
+            return max(1024, int(rng.lognormvariate(self.size_distribution[1], self.size_distribution[2])))
+        raise ValueError("Unknown size distribution: %s" % kind)
+
+    def build(self):
+        """Write the tree to disk and return its media directory"""
+
+        rng = random.Random(self.seed)
+        block = bytes(rng.getrandbits(8) for _ in range(64 * 1024))
+
+        media = os.path.join(self.root, 'media')
+        mtime = 1500000000
+
+        for device in range(self.devices):
+            for folder in range(self.folders_per_device):
+                path = os.path.join(media, 'usb%d' % device, 'DCIM', '%03dMEDIA' % (100 + folder))
+                os.makedirs(path, exist_ok=True)
+
+                for index in range(self.files_per_folder):
+                    size = self._size(rng)
+                    file_path = os.path.join(path, 'IMG_%04d.JPG' % (index + 1))
+                    mtime += rng.randint(1, 600)
+
+                    header = b'\xff\xd8\xff'
+                    if self.exif:
+                        header = exif_header(time.gmtime(mtime), serial='CAM-%s-%d' % (os.path.basename(self.root), device),
+                                             thumbnail=b'\xff\xd8' + block[:1024] + b'\xff\xd9') + b'\xff\xda'
+                        size = max(size, len(header))
+
+                    with open(file_path, 'wb') as f:
+                        f.write(header)
+                        remaining = size - len(header)
+                        while remaining > 0:
+                            chunk = block[:min(remaining, len(block))]
+                            f.write(chunk)
+                            remaining -= len(chunk)
+
+                    os.utime(file_path, (mtime, mtime))
+
+                    self.total_files += 1
+                    self.total_bytes += size
+
+        return media
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _SFTPServerInterface(paramiko.SFTPServerInterface):
+    """SFTP server rooted in a local directory, counting every operation"""
+
+    def __init__(self, server, root, ops, *args, **kwargs):
+        super(_SFTPServerInterface, self).__init__(server, *args, **kwargs)
+        self._root = root
+        self._ops = ops
+
+    def _local(self, path):
+        return os.path.join(self._root, self.canonicalize(path).lstrip('/'))
+
+    def _count(self, op):
+        self._ops[op] += 1
+
+    def list_folder(self, path):
+        self._count('list_folder')
+        path = self._local(path)
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        self._count('stat')
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        self._count('lstat')
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        self._count('open')
+        path = self._local(path)
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        f = os.fdopen(fd, mode)
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        self._count('remove')
+        try:
+            os.remove(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self._count('rename')
+        try:
+            os.rename(self._local(oldpath), self._local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        self._count('mkdir')
+        try:
+            os.mkdir(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        self._count('rmdir')
+        try:
+            os.rmdir(self._local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class _ServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, username, password, root=None, ops=None):
+        self._username = username
+        self._password = password
+        self._root = root   # Commands are only allowed when set, paths under / are rooted here
+        self._ops = ops
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == self._username and password == self._password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if self._root is None:
+            return False
+
+        self._ops['exec'] += 1
+        command = command.decode('utf-8').replace(' /media/', ' %s/media/' % self._root)
+
+        def run():
+            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            for data in iter(lambda: process.stdout.read(32768), b''):
+                channel.sendall(data)
+            channel.send_exit_status(process.wait())
+            channel.close()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class DataStationSimulator(object):
+    """In-process data station: an SFTP server with a power and boot cycle
+
+    The station only accepts SSH connections `boot_time_s` after it has been
+    powered on (normally by `FakeXBeeStation` receiving POWER_ON), so the
+    payload's connection retry loop is exercised as it would be in the field.
+    When a `LinkProfile` is given, connections go through a `ShapedLink`.
+    """
+
+    # One host key per process, generating RSA keys is slow on small machines
+    _host_key = None
+    _host_key_lock = threading.Lock()
+
+    def __init__(self, station_id, root, boot_time_s=0, link=None,
+        username='pi', password='raspberry', bind_address='127.0.0.1', powered=False, allow_exec=False):
+
+        self.station_id = station_id
+        self.root = root
+        self.boot_time_s = boot_time_s
+        self.link = link
+        self.username = username
+        self.password = password
+        self.bind_address = bind_address
+        self.allow_exec = allow_exec    # Run shell commands (e.g. tar) against the station's tree
+
+        self.ops = collections.Counter()    # SFTP operation counts
+        self.peers = []                     # Address of every client that connected
+
+        self._powered_at = time.time() if powered else None
+        self._alive = False
+        self._socket = None
+        self._port = None
+        self._proxy = None
+        self._transports = []
+
+    @classmethod
+    def _get_host_key(cls):
+        with cls._host_key_lock:
+            if cls._host_key is None:
+                cls._host_key = paramiko.RSAKey.generate(2048)
+            return cls._host_key
+
+    @property
+    def address(self):
+        """(address, port) the payload should connect to"""
+        if self._proxy is not None:
+            return self._proxy.address
+        return (self.bind_address, self._port)
+
+    @property
+    def is_booted(self):
+        return self._powered_at is not None and time.time() - self._powered_at >= self.boot_time_s
+
+    def power_on(self, at=None):
+        if self._powered_at is None:
+            logging.debug("Simulator: station %s powered on", self.station_id)
+            self._powered_at = at or time.time()
+
+    def power_off(self):
+        logging.debug("Simulator: station %s powered off", self.station_id)
+        self._powered_at = None
+
+    def start(self):
+        self._get_host_key()
+
+        # Reserve a port, it is only listened on while the station is booted
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((self.bind_address, 0))
+        self._port = s.getsockname()[1]
+        s.close()
+
+        self._alive = True
+
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.name = 'Data Station Simulator %s' % self.station_id
+        thread.start()
+
+        if self.link is not None:
+            self._proxy = ShapedLink((self.bind_address, self._port), self.link, self.bind_address)
+            self._proxy.start()
+
+        return self
+
+    def stop(self):
+        self._alive = False
+        if self._proxy is not None:
+            self._proxy.stop()
+        for transport in self._transports:
+            transport.close()
+        self._close()
+
+    def _listen(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.bind_address, self._port))
+        self._socket.listen(5)
+        self._socket.settimeout(0.05)
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _accept(self):
+        while self._alive:
+            # Nothing listens on port 22 until the station computer is up,
+            # so connection attempts are refused as they are in the field
+            if not self.is_booted:
+                self._close()
+                time.sleep(0.05)
+                continue
+
+            if self._socket is None:
+                self._listen()
+
+            try:
+                client, peer = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                continue
+
+            client.settimeout(None)
+            self.peers.append(peer[0])
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self._get_host_key())
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPServerInterface, self.root, self.ops)
+            try:
+                transport.start_server(server=_ServerInterface(self.username, self.password,
+                    self.root if self.allow_exec else None, self.ops))
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                logging.debug("Simulator: SSH negotiation failed: %s", e)
+                continue
+            self._transports.append(transport)
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+class FakeXBeeStation(object):
+    """Stands in for the XBee serial port with one or more data stations on the air
+
+    Implements the part of the pyserial interface used by `XBee` (`write`,
+    `read`, `in_waiting`, `close`). Every command frame written to it
+    (`~` + 3 character station ID + command code) is answered with the same
+    frame `ack_delay_s` later, the way a data station's microcontroller ACKs.
+    POWER_ON and POWER_OFF are forwarded to the matching
+    `DataStationSimulator` once the ACK is sent.
+
+    Stations that are not registered never answer.
+    """
+
+    START_DELIMITER = b'~'
+    FRAME_LENGTH = 5
+
+    def __init__(self, ack_delay_s=0.5):
+        self.ack_delay_s = ack_delay_s
+        self.stations = {}      # Station ID -> DataStationSimulator (or None)
+        self.ack_delays = {}    # Station ID -> ACK delay override
+
+        self.tx_frames = 0      # Frames received from the payload
+        self.rx_frames = 0      # ACK frames returned to the payload
+
+        self._lock = threading.Lock()
+        self._frame = b''
+        self._pending = []      # (deliver_at, frame, station ID, command code)
+        self._buffer = bytearray()
+
+    def add_station(self, station_id, simulator=None, ack_delay_s=None):
+        self.stations[station_id] = simulator
+        if ack_delay_s is not None:
+            self.ack_delays[station_id] = ack_delay_s
+
+    # pyserial interface
+
+    def write(self, data):
+        with self._lock:
+            for byte in bytes(data):
+                byte = bytes([byte])
+                if byte == self.START_DELIMITER:
+                    self._frame = byte
+                elif self._frame:
+                    self._frame += byte
+
+                if len(self._frame) == self.FRAME_LENGTH:
+                    self._receive_frame(self._frame)
+                    self._frame = b''
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._deliver()
+            return len(self._buffer)
+
+    def read(self, size=1):
+        with self._lock:
+            self._deliver()
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def close(self):
+        pass
+
+    # Station side
+
+    def _receive_frame(self, frame):
+        station_id = frame[1:4].decode('utf-8')
+        command = frame[4:5].decode('utf-8')
+        self.tx_frames += 1
+
+        if station_id not in self.stations:
+            return
+
+        delay = self.ack_delays.get(station_id, self.ack_delay_s)
+        self._pending.append((time.time() + delay, frame, station_id, command))
+
+    def _deliver(self):
+        now = time.time()
+        ready = [p for p in self._pending if p[0] <= now]
+        self._pending = [p for p in self._pending if p[0] > now]
+
+        for sent_at, frame, station_id, command in sorted(ready, key=lambda p: p[0]):
+            self._buffer.extend(frame)
+            self.rx_frames += 1
+
+            simulator = self.stations[station_id]
+            if simulator is None:
+                continue
+            if command == '1':
+                simulator.power_on(sent_at)
+            elif command == '2':
+                simulator.power_off()
+            logging.debug("Fake XBee: station %s ACK %s", station_id, command)
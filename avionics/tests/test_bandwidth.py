@@ -0,0 +1,49 @@
+import unittest
+
+from avionics.services.clock import SimulatedClock
+from avionics.services.data_station_handler.bandwidth import BandwidthShare
+
+CHUNK = 32 * 1024
+
+class TestBandwidthShare(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = SimulatedClock()
+
+    def _transfer(self, budget, size):
+        start = self.clock.monotonic()
+        for _ in range(size // CHUNK):
+            budget.consume(CHUNK)
+        return self.clock.monotonic() - start
+
+    def test_unlimited(self):
+        """Without a total rate sessions are only counted"""
+
+        share = BandwidthShare(None, self.clock)
+        with share.session('101') as budget:
+            self.assertEqual(self._transfer(budget, 100 * CHUNK), 0)
+            self.assertEqual(budget.bytes, 100 * CHUNK)
+        self.assertEqual(share.sessions, [])
+
+    def test_split_between_sessions(self):
+        """The total rate is split evenly between running sessions, and given back when one ends"""
+
+        share = BandwidthShare(8, self.clock)    # 1 MB/s
+        size = 1000 * 1000 // CHUNK * CHUNK
+
+        with share.session('101') as a:
+            self.assertAlmostEqual(self._transfer(a, size), 1.0, delta=0.05)
+
+            with share.session('102') as b:
+                self.assertEqual(share.rate_bps(), 500000)
+
+                # Interleaved like two session threads, each at half the rate
+                start = self.clock.monotonic()
+                for _ in range(size // CHUNK):
+                    a.consume(CHUNK)
+                    b.consume(CHUNK)
+                self.assertAlmostEqual(self.clock.monotonic() - start, 2.0, delta=0.05)
+                self.assertEqual(b.bytes, size)
+
+            self.assertAlmostEqual(self._transfer(a, size), 1.0, delta=0.05)
+            self.assertAlmostEqual(a.wait_s, 4.0, delta=0.1)
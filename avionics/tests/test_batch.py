@@ -0,0 +1,69 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from avionics.services.data_station_handler.batch import compare, main
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _run(self, *argv):
+        out = io.StringIO()
+        status = main(list(argv) + ['--simulate', '--files', '3', '--size-kb', '16'], out)
+        return status, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_batch_and_baseline(self):
+        """Concurrent visits print a line each and a summary, a slower run than the baseline exits with 1"""
+
+        baseline = os.path.join(self._work_dir, 'baseline.json')
+        status, lines = self._run('101,102', '--sessions', '2', '--mode', 'progressive', '--save-baseline', baseline)
+
+        self.assertEqual(status, 0)
+        visits, summary = lines[:-1], lines[-1]
+        self.assertEqual(sorted(v['station_id'] for v in visits), ['101', '102'])
+        for visit in visits:
+            self.assertTrue(visit['ok'])
+            self.assertEqual((visit['files'], visit['bytes'], visit['mode'], visit['sessions']), (3, 3 * 16 * 1024, 'progressive', 2))
+            self.assertIn('transfer', visit['phases'])
+        self.assertEqual((summary['record'], summary['visits'], summary['failed'], summary['regressions']), ('summary', 2, 0, []))
+
+        # A baseline ten times as fast
+        with open(baseline) as f:
+            stored = json.load(f)
+        for station in stored['stations'].values():
+            station['throughput_mbps'] *= 10
+        with open(baseline, 'w') as f:
+            json.dump(stored, f)
+
+        status, lines = self._run('101', '--baseline', baseline)
+
+        self.assertEqual(status, 1)
+        self.assertEqual([(r['station_id'], r['metric']) for r in lines[-1]['regressions']], [('101', 'throughput_mbps')])
+
+    def test_compare(self):
+        """Slower, longer or incomplete visits are regressions past the tolerance, stations not in both are skipped"""
+
+        baseline = {'aggregate_mbps': 10, 'stations': {
+            '101': {'throughput_mbps': 10, 'visit_s': 60, 'files': 100},
+            '102': {'throughput_mbps': 10, 'visit_s': 60, 'files': 100},
+        }}
+        summary = {'aggregate_mbps': 9, 'stations': {
+            '101': {'throughput_mbps': 8.5, 'visit_s': 80, 'files': 99},
+            '103': {'throughput_mbps': 1, 'visit_s': 600, 'files': 1},
+        }}
+
+        regressions = compare(baseline, summary, 0.2)
+        self.assertEqual([(r['station_id'], r['metric']) for r in regressions], [('101', 'visit_s'), ('101', 'files')])
+
+        # Aggregate rates compare once both runs visited the same stations
+        summary['stations']['102'] = summary['stations'].pop('103')
+        self.assertEqual(compare(baseline, summary, 0.2)[-1]['metric'], 'files')
+        self.assertEqual(compare(baseline, summary, 0.05)[-1]['metric'], 'aggregate_mbps')
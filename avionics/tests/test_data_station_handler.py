@@ -1,5 +1,7 @@
 import os
 import queue
+import shutil
+import tempfile
 import threading
 import time
 import unittest
@@ -7,6 +9,10 @@ import sqlite3
 
 from avionics.services.data_station_handler import DataStationHandler
 from avionics.services.data_station_handler.database import Database
+from avionics.services.data_station_handler.ordering import RemoteFile, order_files
+from avionics.services.data_station_handler.scheduler import StationScheduler
+from avionics.services.data_station_handler.xbee import CommandResult
+from avionics.services.profiler import SamplingProfiler
 
 class TestDataStationHandler(unittest.TestCase):
 
@@ -139,3 +145,240 @@ class TestDataStationHandler(unittest.TestCase):
         conn.close()
 
         self.assertTrue(self.db.get_redownload_request(station_id))
+
+    def test_database_get_transfer_policy_default(self):
+        """Database defaults to listing order with no byte quota"""
+
+        self.db.insert_data_station('123')
+
+        self.assertEqual(self.db.get_transfer_policy('123'), ('listing', None))
+
+    def test_database_get_transfer_policy(self):
+        """Database retrieves per-station transfer order and byte quota"""
+
+        self.db.insert_data_station('123')
+
+        conn = sqlite3.connect('avionics.db')
+        c = conn.cursor()
+        c.execute('''UPDATE stations SET transfer_order='newest', byte_quota_mb=50 WHERE station_id=123''')
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(self.db.get_transfer_policy('123'), ('newest', 50))
+
+
+    def test_ack_latency_average(self):
+        """XBee ACK latency is kept as a moving average per data station"""
+
+        self.db.insert_data_station('123')
+        self.assertIsNone(self.db.get_ack_latency('123'))
+
+        self.db.update_ack_latency('123', 1.0)
+        self.db.update_ack_latency('123', 2.0, weight=0.5)
+
+        self.assertAlmostEqual(self.db.get_ack_latency('123'), 1.5)
+
+        # ACKs that came after a resend are ambiguous and leave the average alone
+        self._data_station_handler._learn_ack_latency('123', CommandResult(True, 2, 0.01))
+        self.assertAlmostEqual(self.db.get_ack_latency('123'), 1.5)
+
+    def test_local_root_override(self):
+        """Retention and ingest follow the handler's local root"""
+
+        handler = self._data_station_handler
+        handler.local_root = '/tmp/mission-mule-srv'
+
+        self.assertEqual(handler.retention.local_root, '/tmp/mission-mule-srv')
+        self.assertEqual(handler.ingest.local_root, '/tmp/mission-mule-srv')
+
+    def test_database_migrates_legacy_file(self):
+        """A database from before schema versioning is upgraded in place"""
+
+        work_dir = tempfile.mkdtemp()
+        path = os.path.join(work_dir, 'legacy.db')
+
+        # Original schema, with a duplicate row from a repeat visit
+        conn = sqlite3.connect(path)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE flights(flight_id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME)''')
+        c.execute('''CREATE TABLE stations(station_id INTEGER PRIMARY KEY, last_visited DATETIME, redownload INTEGER)''')
+        c.execute('''CREATE TABLE flights_stations(flight_id INTEGER, station_id INTEGER, successful_downloads INTEGER, total_files INTEGER, total_data_downloaded_mb FLOAT, download_speed_mbps FLOAT, did_wake_up_ack INTEGER, did_connect INTEGER, did_find_device INTEGER, did_shutdown_ack INTEGER, wakeup_time_s INTEGER, connection_time_s INTEGER, download_time_s INTEGER, shutdown_time_s INTEGER)''')
+        c.execute('''CREATE TABLE timeouts(timeout_id TEXT PRIMARY KEY, time_in_min INTEGER)''')
+        c.execute('''INSERT INTO flights (timestamp) VALUES ('2020-01-01 10:00:00')''')
+        c.execute('''INSERT INTO stations VALUES (123, '2020-01-01 10:00:00', 0)''')
+        c.execute('''INSERT INTO flights_stations VALUES (1, 123, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)''')
+        c.execute('''INSERT INTO flights_stations VALUES (1, 123, 5, 10, 2.5, 8.0, 1, 1, 1, 1, 2, 3, 4, 1)''')
+        conn.commit()
+        conn.close()
+
+        try:
+            db = Database(path)
+
+            conn = sqlite3.connect(path)
+            c = conn.cursor()
+            self.assertEqual(c.execute('PRAGMA user_version').fetchone()[0], Database.SCHEMA_VERSION)
+            self.assertEqual(c.execute('SELECT count(*) FROM flights_stations').fetchone()[0], 1)
+
+            # Lookups use the key and indexes rather than scanning every visit
+            plan = ' '.join(row[3] for row in c.execute('''EXPLAIN QUERY PLAN
+                UPDATE flights_stations SET total_files=1 WHERE station_id=123 AND flight_id=1'''))
+            self.assertIn('(flight_id=? AND station_id=?)', plan)
+            plan = ' '.join(row[3] for row in c.execute('''EXPLAIN QUERY PLAN
+                SELECT * FROM flights_stations WHERE station_id=123'''))
+            self.assertIn('USING INDEX flights_stations_station', plan)
+            conn.close()
+
+            self.assertEqual(db.get_flight_station_stats('123', 1)['successful_downloads'], 5)
+            self.assertEqual(db.get_transfer_policy('123'), ('listing', None))
+            self.assertEqual(db.get_timeout('download'), 10)
+
+            # A repeat visit replaces the row rather than adding another
+            db.add_station_to_flight('123', 1)
+            self.assertEqual(db.get_flight_station_stats('123', 1)['successful_downloads'], 0)
+
+            # Opening an up to date file again changes nothing
+            Database(path)
+            self.assertEqual(len(db.get_flight_stations(1)), 1)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_profile_control_message(self):
+        """PROFILE control messages start and stop the profiler and are answered"""
+
+        tx_queue = queue.PriorityQueue()
+        self._data_station_handler.tx_queue = tx_queue
+        self._data_station_handler.profiler = SamplingProfiler(tempfile.mkdtemp(), interval_s=0.01)
+
+        self._rx_queue.put('PROFILE 30')
+        self._data_station_handler._wake_download_and_sleep(self._rx_lock, self._is_downloading)
+        self.assertTrue(self._data_station_handler.profiler.is_running)
+
+        self._rx_queue.put('PROFILE STOP')
+        self._data_station_handler._wake_download_and_sleep(self._rx_lock, self._is_downloading)
+        self._data_station_handler.profiler.join(5)
+        self.assertFalse(self._data_station_handler.profiler.is_running)
+        shutil.rmtree(self._data_station_handler.profiler.directory)
+
+        self.assertEqual(tx_queue.get_nowait(), (1, b'PROFILE STARTED\n'))
+        self.assertEqual(tx_queue.get_nowait(), (1, b'PROFILE STOPPED\n'))
+
+class TestOrdering(unittest.TestCase):
+
+    def setUp(self):
+        self.files = [
+            RemoteFile('/media/usb0/DCIM', 'a.JPG', 300, 10),
+            RemoteFile('/media/usb0/DCIM', 'b.JPG', 100, 30),
+            RemoteFile('/media/usb1/DCIM', 'c.JPG', 200, 20),
+            RemoteFile('/media/usb0/DCIM', 'd.JPG', 400, 40),
+        ]
+
+    def _names(self, files):
+        return [f.filename for f in files]
+
+    def test_listing_order(self):
+        """Listing order keeps the remote listing order"""
+
+        self.assertEqual(self._names(order_files(self.files, 'listing')), ['a.JPG', 'b.JPG', 'c.JPG', 'd.JPG'])
+
+    def test_newest_first(self):
+        """Newest-first orders by modification time, most recent first"""
+
+        self.assertEqual(self._names(order_files(self.files, 'newest')), ['d.JPG', 'b.JPG', 'c.JPG', 'a.JPG'])
+
+    def test_smallest_first(self):
+        """Smallest-first orders by size, smallest first"""
+
+        self.assertEqual(self._names(order_files(self.files, 'smallest')), ['b.JPG', 'c.JPG', 'a.JPG', 'd.JPG'])
+
+    def test_round_robin(self):
+        """Round-robin alternates between usb devices"""
+
+        self.assertEqual(self._names(order_files(self.files, 'round_robin')), ['d.JPG', 'c.JPG', 'b.JPG', 'a.JPG'])
+
+    def test_byte_quota(self):
+        """Ordering stops once the byte quota would be exceeded"""
+
+        self.assertEqual(self._names(order_files(self.files, 'smallest', 350)), ['b.JPG', 'c.JPG'])
+
+    def test_unknown_policy(self):
+        """Unknown policies fall back to listing order"""
+
+        self.assertEqual(self._names(order_files(self.files, 'bogus')), ['a.JPG', 'b.JPG', 'c.JPG', 'd.JPG'])
+
+
+class TestStationScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.scheduler = StationScheduler(self.db)
+
+    def tearDown(self):
+        os.remove('avionics.db')
+
+    def _add_visit(self, station_id, days_ago, total_files, successful_downloads, data_mb, speed_mbps):
+        conn = sqlite3.connect('avionics.db')
+        c = conn.cursor()
+        c.execute('''INSERT INTO flights (timestamp) VALUES (datetime('now', ?))''', ('-%d days' % days_ago,))
+        flight_id = c.lastrowid
+        c.execute('''INSERT OR REPLACE INTO stations (station_id, last_visited, redownload)
+                     VALUES (?, datetime('now', ?), 0)''', (station_id, '-%d days' % days_ago))
+        c.execute('''INSERT INTO flights_stations (flight_id, station_id, successful_downloads, total_files, did_wake_up_ack, did_connect, did_find_device, did_shutdown_ack, total_data_downloaded_mb, download_speed_mbps, wakeup_time_s, connection_time_s, download_time_s, shutdown_time_s)
+                     VALUES (?, ?, ?, ?, 1, 1, 1, 1, ?, ?, 5, 45, 60, 2)''',
+                  (flight_id, station_id, successful_downloads, total_files, data_mb, speed_mbps))
+        conn.commit()
+        conn.close()
+
+    def test_estimate_from_history(self):
+        """Scheduler estimates file rate, size, link speed and boot time from visit history"""
+
+        self._add_visit(101, 20, 100, 100, 200, 16)
+        self._add_visit(101, 10, 100, 100, 200, 24)
+
+        estimate = self.scheduler.estimate('101')
+
+        self.assertAlmostEqual(estimate.files_per_day, 10, places=3)
+        self.assertAlmostEqual(estimate.file_size_mb, 2)
+        self.assertAlmostEqual(estimate.link_speed_mbps, 20)
+        self.assertAlmostEqual(estimate.boot_time_s, 50)
+        self.assertAlmostEqual(estimate.expected_files, 100, places=1)
+
+    def test_estimate_without_history(self):
+        """Scheduler falls back to defaults for unknown stations"""
+
+        estimate = self.scheduler.estimate('999')
+
+        self.assertEqual(estimate.visits, 0)
+        self.assertEqual(estimate.file_size_mb, StationScheduler.DEFAULT_FILE_SIZE_MB)
+
+    def test_plan_orders_by_yield(self):
+        """Scheduler puts stations with more expected data per hover second first"""
+
+        self._add_visit(101, 20, 10, 10, 20, 20)
+        self._add_visit(101, 10, 10, 10, 20, 20)
+        self._add_visit(102, 20, 500, 500, 1000, 20)
+        self._add_visit(102, 10, 500, 500, 1000, 20)
+
+        plan = self.scheduler.plan(['101', '102'])
+
+        self.assertEqual([station_id for station_id, _ in plan], ['102', '101'])
+        self.assertTrue(all(hover_s > 0 for _, hover_s in plan))
+
+    def test_plan_control_message(self):
+        """Data station handler answers PLAN requests on the TX queue"""
+
+        rx_queue = queue.Queue()
+        tx_queue = queue.PriorityQueue()
+        handler = DataStationHandler(1000, 1000, 2000, rx_queue, _db=self.db, _tx_queue=tx_queue)
+        is_downloading = threading.Event()
+
+        rx_queue.put('PLAN 101,102\n')
+        handler._wake_download_and_sleep(threading.Lock(), is_downloading)
+
+        priority, message = tx_queue.get(timeout=1)
+
+        self.assertEqual(priority, 1)
+        self.assertTrue(message.startswith(b'PLAN '))
+        self.assertTrue(message.endswith(b'\n'))
+        self.assertEqual(len(message.split(b',')), 2)
+        self.assertFalse(is_downloading.is_set())
+        self.assertEqual(handler.flight_id, None)
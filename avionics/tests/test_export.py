@@ -0,0 +1,250 @@
+import http.client
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from avionics.services.export import ExportServer
+from avionics.services.export.export import parse_range
+from avionics.services.data_station_handler.database import Database
+from avionics.services.export.pull import Puller
+from avionics.simulator.benchmark import Mission
+
+TOKEN = 'ground-station-secret'
+
+class TestExport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # One real station visit provides the flight, the database rows and the files
+        cls._work_dir = tempfile.mkdtemp()
+        mission = Mission(cls._work_dir, stations=2, files_per_folder=4,
+            size_distribution=('uniform', 8 * 1024, 64 * 1024), ack_delay_s=0)
+        mission.handler.content_store = True
+        try:
+            mission.run()
+        finally:
+            mission.stop()
+
+        cls._flight_id = mission.handler.flight_id
+        cls._local_root = mission.handler.local_root
+        cls._trees = mission.trees
+
+        cls._export = ExportServer(0, '127.0.0.1', cls._local_root, mission.db, TOKEN)
+        cls._is_downloading = threading.Event()
+        cls._thread = threading.Thread(target=cls._export.run, args=(cls._is_downloading,))
+        cls._thread.daemon = True
+        cls._thread.start()
+        cls._url = 'http://127.0.0.1:%d' % cls._export.address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._export.stop()
+        cls._thread.join()
+        shutil.rmtree(cls._work_dir)
+
+    def _get(self, path, headers=None, token=TOKEN, method='GET', port=None):
+        headers = dict(headers or {})
+        if token:
+            headers['Authorization'] = 'Bearer %s' % token
+        connection = http.client.HTTPConnection('127.0.0.1', port or self._export.address[1], timeout=10)
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def test_parse_range(self):
+        """Single byte ranges are resolved against the file size"""
+
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=990-2000', 1000), (990, 999))
+        self.assertIsNone(parse_range('', 1000))
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 1000))
+        self.assertRaises(ValueError, parse_range, 'bytes=1000-', 1000)
+
+    def test_manifest(self):
+        """Flight manifest lists every visited station with its downloaded files"""
+
+        response, body = self._get('/flights/%d/manifest.json' % self._flight_id)
+        self.assertEqual(response.status, 200)
+
+        manifest = json.loads(body.decode('utf-8'))
+        stations = dict((s['station_id'], s) for s in manifest['stations'])
+        self.assertEqual(sorted(stations), ['101', '102'])
+
+        for station_id, tree in self._trees.items():
+            self.assertEqual(len(stations[station_id]['files']), tree.total_files)
+            self.assertEqual(stations[station_id]['total_bytes'], tree.total_bytes)
+            self.assertEqual(stations[station_id]['successful_downloads'], tree.total_files)
+
+        response, body = self._get('/flights')
+        flights = json.loads(body.decode('utf-8'))
+        self.assertEqual(flights[0]['stations'], ['101', '102'])
+
+        response, _ = self._get('/flights/%d/999/manifest.json' % self._flight_id)
+        self.assertEqual(response.status, 404)
+
+    def test_range_request(self):
+        """Range requests return the requested slice of the file"""
+
+        name = 'usb0/DCIM/100MEDIA/IMG_0001.JPG'
+        with open(os.path.join(self._local_root, str(self._flight_id), '101', name), 'rb') as f:
+            data = f.read()
+
+        path = '/flights/%d/101/%s' % (self._flight_id, name)
+
+        response, body = self._get(path)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, data)
+
+        response, body = self._get(path, {'Range': 'bytes=100-199'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 100-199/%d' % len(data))
+        self.assertEqual(body, data[100:200])
+
+        response, _ = self._get(path, {'Range': 'bytes=%d-' % len(data)})
+        self.assertEqual(response.status, 416)
+
+        response, _ = self._get('/flights/%d/101/..%%2F..%%2Favionics.db' % self._flight_id)
+        self.assertEqual(response.status, 404)
+
+    def test_station_archive(self):
+        """Station archive is a tar stream of all of the station's files"""
+
+        response, body = self._get('/flights/%d/102.tar' % self._flight_id)
+        self.assertEqual(response.status, 200)
+
+        with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+            members = archive.getmembers()
+
+        self.assertEqual(len(members), self._trees['102'].total_files)
+        self.assertEqual(sum(m.size for m in members), self._trees['102'].total_bytes)
+
+    def test_busy_while_downloading(self):
+        """Requests are refused while a station download is running"""
+
+        self._is_downloading.set()
+        try:
+            response, _ = self._get('/flights')
+        finally:
+            self._is_downloading.clear()
+
+        self.assertEqual(response.status, 503)
+
+    def test_pull_and_resume(self):
+        """Pull fetches the whole flight and a second pull only fetches what is missing"""
+
+        destination = os.path.join(self._work_dir, 'ground')
+        puller = Puller(self._url, destination, jobs=3, token=TOKEN)
+
+        result = puller.pull(self._flight_id)
+        total_files = sum(t.total_files for t in self._trees.values())
+        total_bytes = sum(t.total_bytes for t in self._trees.values())
+        self.assertEqual((result.files, result.skipped, result.failed, result.bytes), (total_files, 0, 0, total_bytes))
+        self.assertTrue(result.exported)
+        self.assertTrue(self._export.db.is_flight_exported(self._flight_id))
+
+        # Interrupt one file half way and lose another
+        station_directory = os.path.join(destination, str(self._flight_id), '101', 'usb0', 'DCIM', '100MEDIA')
+        names = sorted(os.listdir(station_directory))
+        partial = os.path.join(station_directory, names[0])
+        size = os.path.getsize(partial)
+        with open(partial, 'rb') as f:
+            head = f.read(size // 2)
+        os.remove(partial)
+        with open(partial + '.part', 'wb') as f:
+            f.write(head)
+        lost_size = os.path.getsize(os.path.join(station_directory, names[1]))
+        os.remove(os.path.join(station_directory, names[1]))
+
+        result = puller.pull(self._flight_id)
+        self.assertEqual(result.failed, 0)
+        self.assertEqual(result.skipped, total_files - 2)
+        self.assertEqual(result.bytes, size - size // 2 + lost_size)
+
+        with open(partial, 'rb') as f:
+            resumed = f.read()
+        with open(os.path.join(self._local_root, str(self._flight_id), '101', 'usb0', 'DCIM', '100MEDIA', names[0]), 'rb') as f:
+            self.assertEqual(resumed, f.read())
+        self.assertFalse(os.path.exists(partial + '.part'))
+
+    def test_confirm_mismatch(self):
+        """A copy that doesn't match the manifest is not confirmed"""
+
+        puller = Puller(self._url, os.path.join(self._work_dir, 'incomplete'), token=TOKEN)
+        self.assertRaises(IOError, puller.post_json, '/flights/%d/exported' % self._flight_id, {'files': 1, 'bytes': 1})
+
+    def test_token(self):
+        """Requests without the token are refused, and without a token set no export can be confirmed"""
+
+        for token in (None, 'wrong'):
+            response, _ = self._get('/flights', token=token)
+            self.assertEqual(response.status, 401)
+            response, _ = self._get('/flights/%d/exported' % self._flight_id, token=token, method='POST')
+            self.assertEqual(response.status, 401)
+
+        export = ExportServer(0, '127.0.0.1', self._local_root, self._export.db)
+        thread = threading.Thread(target=export.run)
+        thread.daemon = True
+        thread.start()
+        try:
+            response, _ = self._get('/flights', token=None, port=export.address[1])
+            self.assertEqual(response.status, 200)
+            response, _ = self._get('/flights/%d/exported' % self._flight_id, token=None, method='POST', port=export.address[1])
+            self.assertEqual(response.status, 403)
+        finally:
+            export.stop()
+            thread.join()
+
+    def test_zero_padded_station(self):
+        """A station written to a zero-padded directory is found, stations not visited on the flight aren't"""
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            db = Database(os.path.join(work_dir, 'avionics.db'))
+            flight_id = db.insert_new_flight()
+            db.insert_data_station('007')
+            db.add_station_to_flight('007', flight_id)
+
+            directory = os.path.join(work_dir, str(flight_id), '007')
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'IMG_0001.JPG'), 'wb') as f:
+                f.write(b'x' * 10)
+            os.makedirs(os.path.join(work_dir, str(flight_id), '008'))
+
+            export = ExportServer(0, '127.0.0.1', work_dir, db)
+            try:
+                self.assertEqual(export.station_directory(flight_id, '7'), directory)
+                manifest = export.station_manifest(flight_id, '007')
+                self.assertEqual((manifest['station_id'], manifest['total_bytes']), ('007', 10))
+                self.assertRaises(LookupError, export.station_directory, flight_id, '8')
+            finally:
+                export._server.server_close()
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_pull_links_known_content(self):
+        """Content pulled before is linked locally rather than fetched again"""
+
+        destination = os.path.join(self._work_dir, 'ground-digests')
+        puller = Puller(self._url, destination, token=TOKEN)
+        puller.pull(self._flight_id, confirm=False)
+
+        entry = puller.manifest(self._flight_id, '101')['stations'][0]['files'][0]
+        self.assertTrue(entry['digest'])
+
+        # A fresh client picks the digests up from disk, the station ID here doesn't exist on the server
+        puller = Puller(self._url, destination, token=TOKEN)
+        self.assertEqual(puller.fetch(self._flight_id, 'elsewhere', entry), 0)
+
+        with open(os.path.join(destination, str(self._flight_id), 'elsewhere', entry['path']), 'rb') as f:
+            copy = f.read()
+        with open(os.path.join(self._local_root, str(self._flight_id), '101', entry['path']), 'rb') as f:
+            self.assertEqual(copy, f.read())
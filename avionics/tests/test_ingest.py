@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from avionics.services.data_station_handler.exif import parse_exif
+from avionics.services.data_station_handler.ingest import IngestPipeline, thumbnail_path
+from avionics.services.export import ExportServer
+from avionics.simulator.benchmark import Mission
+from avionics.simulator.exif import exif_header
+
+class TestExif(unittest.TestCase):
+
+    def test_parse_exif(self):
+        """Capture time, camera serial and embedded thumbnail are read from the header"""
+
+        thumbnail = b'\xff\xd8' + os.urandom(300) + b'\xff\xd9'
+        header = exif_header(time.gmtime(1500000000), 'Reconyx', 'HP2X', 'H500-42', thumbnail)
+
+        info = parse_exif(header + b'\xff\xda\x00\x02')
+        self.assertEqual(info, ('2017-07-14 02:40:00', 'H500-42', thumbnail))
+
+    def test_camera_without_serial(self):
+        """Make and model identify cameras that don't record a serial number"""
+
+        info = parse_exif(exif_header(None, 'Reconyx', 'HP2X'))
+        self.assertEqual(info, (None, 'Reconyx HP2X', None))
+
+    def test_malformed(self):
+        """Non-JPEG data is rejected, a JPEG without EXIF has no metadata"""
+
+        self.assertRaises(ValueError, parse_exif, b'not a jpeg')
+        self.assertRaises(ValueError, parse_exif, b'\xff\xd8\xff\xe1\x00\x10Exif\x00\x00XX*\x00\x08\x00')
+        self.assertEqual(parse_exif(b'\xff\xd8\xff\xda\x00\x02'), (None, None, None))
+
+
+class TestIngest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._work_dir = tempfile.mkdtemp()
+        mission = Mission(cls._work_dir, stations=1, devices=2, files_per_folder=5,
+            size_distribution=('uniform', 8 * 1024, 64 * 1024), ack_delay_s=0, exif=True)
+        try:
+            mission.run()
+        finally:
+            mission.stop()
+
+        cls._mission = mission
+        cls._flight_id = mission.handler.flight_id
+        cls._local_root = mission.handler.local_root
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._work_dir)
+
+    def setUp(self):
+        self.ingest = IngestPipeline(self._mission.db, self._local_root, _workers=2)
+
+    def tearDown(self):
+        self.ingest._shutdown()
+
+    def test_ingest(self):
+        """Every downloaded file gets its capture time, camera and thumbnail"""
+
+        while self.ingest.ingest_pending():
+            pass
+
+        index = self._mission.db.get_file_index('101', self._flight_id)
+        self.assertEqual(len(index), 10)
+
+        for local_path, entry in index.items():
+            path = os.path.join(self._local_root, str(self._flight_id), '101', local_path)
+
+            # Synthetic trees start their capture times at 1500000000
+            self.assertTrue(entry['captured_at'].startswith('2017-07-14 '))
+            self.assertEqual(entry['camera_id'], 'CAM-101-%s' % local_path[3])
+
+            thumbnail = thumbnail_path(self._local_root, self._flight_id, '101', local_path)
+            self.assertEqual(os.path.getsize(thumbnail), entry['thumbnail_size'])
+            with open(path, 'rb') as f:
+                self.assertEqual(parse_exif(f.read(4096)).thumbnail, open(thumbnail, 'rb').read())
+
+        # The export manifest carries the index and the thumbnails are served
+        export = ExportServer(0, '127.0.0.1', self._local_root, self._mission.db)
+        try:
+            manifest = export.station_manifest(self._flight_id, '101')
+            entry = manifest['files'][0]
+            self.assertTrue(entry['captured_at'])
+            self.assertEqual(entry['camera_id'], 'CAM-101-0')
+            self.assertTrue(os.path.isfile(export.file_path(self._flight_id, '101', entry['path'], thumbnail=True)))
+        finally:
+            export._server.server_close()
+
+    def test_paused_while_downloading(self):
+        """Nothing is ingested while a station download is running"""
+
+        # A flight of its own keeps this file out of the other test's index
+        self._mission.db.insert_files('101', 999, [('/media/usb9/missing.JPG', 'usb9/missing.JPG', None, 1)])
+
+        is_downloading = threading.Event()
+        is_downloading.set()
+        self.assertEqual(self.ingest.ingest_pending(is_downloading), 0)
+        self.assertIn((999, 101, 'usb9/missing.JPG'), self._mission.db.get_pending_ingest(100))
+
+        # Files that are gone are recorded without metadata
+        is_downloading.clear()
+        while self.ingest.ingest_pending(is_downloading):
+            pass
+        self.assertEqual(self._mission.db.get_file_index('101', 999)['usb9/missing.JPG']['captured_at'], None)
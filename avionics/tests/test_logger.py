@@ -0,0 +1,81 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from avionics.services.logger import RateLimitFilter, start_logging, stop_logging
+
+class TestLogger(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._root = logging.getLogger()
+        self._handlers = list(self._root.handlers)
+        self._level = self._root.level
+
+    def tearDown(self):
+        stop_logging()
+        for handler in list(self._root.handlers):
+            self._root.removeHandler(handler)
+        for handler in self._handlers:
+            self._root.addHandler(handler)
+        self._root.setLevel(self._level)
+        shutil.rmtree(self._directory)
+
+    def _record(self, level=logging.DEBUG, lineno=1):
+        return logging.LogRecord('root', level, 'xbee.py', lineno, 'XBee RX: %s', ('~',), None)
+
+    def test_rate_limit(self):
+        """Rate limit filter drops debug records beyond the rate for a call site"""
+
+        f = RateLimitFilter(rate=3, per=60)
+
+        passed = [f.filter(self._record()) for i in range(10)]
+
+        self.assertEqual(passed.count(True), 3)
+
+    def test_rate_limit_per_call_site(self):
+        """Rate limit filter counts each call site separately"""
+
+        f = RateLimitFilter(rate=1, per=60)
+
+        self.assertTrue(f.filter(self._record(lineno=1)))
+        self.assertTrue(f.filter(self._record(lineno=2)))
+        self.assertFalse(f.filter(self._record(lineno=1)))
+
+    def test_rate_limit_ignores_errors(self):
+        """Rate limit filter never drops warnings or errors"""
+
+        f = RateLimitFilter(rate=1, per=60)
+
+        passed = [f.filter(self._record(logging.ERROR)) for i in range(5)]
+
+        self.assertTrue(all(passed))
+
+    def test_rate_limit_reports_suppressed(self):
+        """First record after a suppressed burst reports the number dropped"""
+
+        f = RateLimitFilter(rate=1, per=0)
+        f.filter(self._record())
+
+        f.per = 60
+        f._sites[('xbee.py', 1)][0] -= 120   # Window expired
+        f._sites[('xbee.py', 1)][2] = 4
+
+        record = self._record()
+        f.filter(record)
+
+        self.assertIn('[4 similar messages suppressed]', record.getMessage())
+
+    def test_background_file_logging(self):
+        """Records are written to the log file by the background listener"""
+
+        path = os.path.join(self._directory, 'flight.log')
+        start_logging(path, logging.DEBUG)
+
+        logging.info('mission start %s', 42)
+        stop_logging()
+
+        with open(path) as f:
+            self.assertIn('mission start 42', f.read())
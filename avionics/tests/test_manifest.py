@@ -0,0 +1,79 @@
+import random
+import tracemalloc
+import unittest
+
+from avionics.services.data_station_handler.manifest import FileColumns, Listing, Manifest
+from avionics.services.data_station_handler.ordering import RemoteFile, _order_listing, order_files, policy_names
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest = Manifest()
+        self.manifest.append('/media/usb0/DCIM', 'a.JPG', 300, 10)
+        self.manifest.append('/media/usb0/DCIM', '.hidden.JPG', 5, 50)
+        self.manifest.append('/media/usb0/DCIM', 'notes.txt', 7, 60)
+        self.manifest.append('/media/usb1/DCIM', 'c.jpeg', 200, 20)
+        self.manifest.append('/media/usb0/DCIM/.tmp', 'b.JPG', 100, 30)
+        self.manifest.append('/media/usb0/DCIM', 'd.JPG', None, None)
+
+    def _names(self, files):
+        return [f.filename for f in files]
+
+    def test_select(self):
+        """Files are filtered by suffix, directory, .tmp membership and hidden names"""
+
+        suffixes = ('.JPG', '.jpeg')
+        self.assertEqual(self._names(self.manifest.select(suffixes, tmp=False, hidden=False)), ['a.JPG', 'c.jpeg', 'd.JPG'])
+        self.assertEqual(self._names(self.manifest.select(suffixes, tmp=True)), ['b.JPG'])
+        self.assertEqual(self._names(self.manifest.select(directory=lambda path: 'usb1' in path)), ['c.jpeg'])
+
+        view = self.manifest.select(suffixes, tmp=False)
+        self.assertEqual(len(view), 4)
+        self.assertEqual(view[3], RemoteFile('/media/usb0/DCIM', 'd.JPG', None, None))
+        self.assertEqual(view.total_size(), 505)
+
+        # Each directory path is stored once
+        self.assertEqual(len(self.manifest.directories), 3)
+
+    def test_ordering_matches_lists(self):
+        """Every ordering policy orders a view like the list of the same files"""
+
+        files = self.manifest.select(hidden=False)
+        for order in policy_names():
+            for quota in (None, 400):
+                self.assertEqual(list(order_files(files, order, quota)), list(order_files(list(files), order, quota)),
+                                 '%s, quota %s' % (order, quota))
+
+    def test_listing_order_keeps_view(self):
+        """Listing order hands a view on as it is, without expanding it into RemoteFile"""
+
+        files = self.manifest.select(hidden=False)
+        self.assertIs(_order_listing(files), files)
+
+    def test_listing_json(self):
+        """Listings round-trip through the manifest cache's JSON format, non-UTF-8 names included"""
+
+        entry = {'mtime': 100, 'files': [['IMG_0001.JPG', 1024, 90], ['caf\udce9.JPG', None, None]], 'folders': [['sub', 95]]}
+        self.assertEqual(Listing.from_json(entry).to_json(), entry)
+
+    def test_compact(self):
+        """A manifest of 100k files takes well under 100 bytes per file"""
+
+        rng = random.Random(0)
+        tracemalloc.start()
+        try:
+            manifest = Manifest()
+            for folder in range(100):
+                files = FileColumns()
+                for index in range(1000):
+                    files.append('IMG_%04d.JPG' % index, rng.randint(1, 1 << 24), 1500000000 + index)
+                manifest.add('/media/usb%d/DCIM/%03dMEDIA' % (folder // 25, folder), files)
+            del files
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(len(manifest), 100000)
+        self.assertLess(size / len(manifest), 60)
+        last = manifest.file(99999)
+        self.assertEqual((last.path, last.filename, last.mtime), ('/media/usb3/DCIM/099MEDIA', 'IMG_0999.JPG', 1500000999))
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from avionics.services.metrics import MetricsRegistry, Trace
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self._registry = MetricsRegistry()
+
+    def test_counter(self):
+        """Registry counters accumulate per label set"""
+
+        self._registry.inc('sftp_ops', op='get')
+        self._registry.inc('sftp_ops', 2, op='get')
+        self._registry.inc('sftp_ops', op='rename')
+
+        self.assertEqual(self._registry.get('sftp_ops', op='get'), 3)
+        self.assertEqual(self._registry.get('sftp_ops', op='rename'), 1)
+        self.assertEqual(self._registry.get('sftp_ops', op='remove'), 0)
+
+    def test_span_duration(self):
+        """Spans measure elapsed monotonic time"""
+
+        trace = Trace('visit')
+        with trace.span('wakeup') as span:
+            time.sleep(0.05)
+
+        self.assertTrue(span.duration >= 0.05)
+        self.assertEqual(trace.duration('wakeup'), span.duration)
+
+    def test_trace_merge(self):
+        """Spans and counters from another trace's dict are folded in"""
+
+        child = Trace('download')
+        with child.span('transfer'):
+            time.sleep(0.01)
+        child.count('files_downloaded', 3)
+
+        trace = Trace('visit')
+        trace.count('files_downloaded')
+        trace.merge(json.loads(json.dumps(child.to_dict())))
+
+        self.assertEqual(trace.get('files_downloaded'), 4)
+        self.assertAlmostEqual(trace.duration('transfer'), child.duration('transfer'))
+
+    def test_record_trace(self):
+        """Finished traces are folded into the registry"""
+
+        trace = Trace('visit')
+        trace.span('wakeup').finish()
+        trace.count('bytes_downloaded', 1024)
+
+        self._registry.record(trace)
+
+        self.assertEqual(self._registry.get('bytes_downloaded'), 1024)
+        self.assertIn('mission_mule_phase_seconds_count{phase="wakeup"} 1', self._registry.to_prometheus())
+
+    def test_prometheus_export(self):
+        """Registry exports counters in Prometheus text format"""
+
+        self._registry.inc('xbee_tx_frames', command='POWER_ON')
+
+        text = self._registry.to_prometheus()
+
+        self.assertIn('# TYPE mission_mule_xbee_tx_frames_total counter', text)
+        self.assertIn('mission_mule_xbee_tx_frames_total{command="POWER_ON"} 1', text)
+
+    def test_histogram_export(self):
+        """Histograms export cumulative Prometheus buckets"""
+
+        self._registry.histogram('xbee_ack_seconds', 0.3, buckets=(0.1, 0.5, 1.0), command='POWER_ON')
+        self._registry.histogram('xbee_ack_seconds', 0.7, buckets=(0.1, 0.5, 1.0), command='POWER_ON')
+
+        text = self._registry.to_prometheus()
+
+        self.assertIn('# TYPE mission_mule_xbee_ack_seconds histogram', text)
+        self.assertIn('mission_mule_xbee_ack_seconds_bucket{command="POWER_ON",le="0.1"} 0', text)
+        self.assertIn('mission_mule_xbee_ack_seconds_bucket{command="POWER_ON",le="0.5"} 1', text)
+        self.assertIn('mission_mule_xbee_ack_seconds_bucket{command="POWER_ON",le="+Inf"} 2', text)
+
+    def test_json_lines_export(self):
+        """Registry exports one JSON object per metric"""
+
+        self._registry.inc('files_downloaded', 5)
+        self._registry.observe('phase_seconds', 1.5, phase='transfer')
+
+        lines = [json.loads(line) for line in self._registry.to_json_lines().splitlines()]
+
+        self.assertEqual(lines[0], {'name': 'files_downloaded', 'type': 'counter', 'labels': {}, 'value': 5})
+        self.assertEqual(lines[1]['sum'], 1.5)
+
+    def test_trace_write(self):
+        """Traces are written to a per-visit JSON file"""
+
+        directory = tempfile.mkdtemp()
+        try:
+            trace = Trace('flight_1_station_123', flight_id=1, station_id='123')
+            trace.span('shutdown').finish()
+
+            with open(trace.write(directory)) as f:
+                data = json.load(f)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(data['attributes']['station_id'], '123')
+        self.assertEqual(data['spans'][0]['name'], 'shutdown')
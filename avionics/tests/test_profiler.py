@@ -0,0 +1,75 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from avionics.services.profiler import SamplingProfiler, install, profiler
+
+def _busy_wait_for_profiler(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=_busy_wait_for_profiler, args=(self._stop,), name='Busy')
+        self._thread.start()
+
+    def tearDown(self):
+        self._stop.set()
+        self._thread.join()
+        shutil.rmtree(self._work_dir)
+
+    def test_collapsed_stacks(self):
+        """Profiles hold collapsed stacks for every thread, rooted at the thread name"""
+
+        p = SamplingProfiler(self._work_dir, interval_s=0.005)
+        self.assertTrue(p.start())
+        self.assertFalse(p.start())
+
+        time.sleep(0.2)
+        p.stop()
+        p.join()
+
+        with open(p.last_path) as f:
+            lines = f.read().splitlines()
+
+        busy = [l for l in lines if l.startswith('Busy;')]
+        self.assertTrue(busy)
+        self.assertIn('_busy_wait_for_profiler (test_profiler.py:', busy[0])
+        self.assertTrue(int(busy[0].rsplit(' ', 1)[1]) > 0)
+
+    def test_duration(self):
+        """Profiler stops by itself after the requested duration"""
+
+        p = SamplingProfiler(self._work_dir, interval_s=0.005)
+        p.start(0.1)
+        p.join(5)
+
+        self.assertFalse(p.is_running)
+        self.assertTrue(os.path.exists(p.last_path))
+
+    def test_signal_toggle(self):
+        """SIGUSR1 starts and stops the process-wide profiler"""
+
+        previous = signal.getsignal(signal.SIGUSR1)
+        directory = profiler.directory
+        profiler.directory = self._work_dir
+
+        try:
+            install(signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.1)
+            self.assertTrue(profiler.is_running)
+
+            os.kill(os.getpid(), signal.SIGUSR1)
+            profiler.join(5)
+            self.assertFalse(profiler.is_running)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+            profiler.directory = directory
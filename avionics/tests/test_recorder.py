@@ -0,0 +1,148 @@
+import os
+import queue
+import serial
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from avionics.services.clock import ScaledClock
+from avionics.services.data_station_handler.data_station_handler import DataStationHandler
+from avionics.services.data_station_handler.database import Database
+from avionics.services.data_station_handler.xbee import XBee
+from avionics.services.recorder import Recorder, RX, TX, read_recording
+from avionics.services.serial_handler import SerialHandler
+from avionics.simulator import FakeXBeeStation
+from avionics.simulator.replay import Replay, replay_handlers
+
+class _Autopilot(object):
+    """Serial port on the autopilot's side, messages put on `lines` are read by the handler"""
+
+    def __init__(self):
+        self.lines = queue.Queue()
+        self.written = []
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=0.1)
+        except queue.Empty:
+            return b''
+
+    def write(self, data):
+        self.written.append(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._work_dir, 'flight.mmrec')
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def test_round_trip(self):
+        """Reads and writes of every port are read back in order with their timing"""
+
+        recorder = Recorder(self._path)
+        port = recorder.wrap(serial.serial_for_url('loop://', timeout=1), 'serial')
+        xbee = recorder.wrap(serial.serial_for_url('loop://', timeout=1), 'xbee')
+
+        port.write(b'101\n')
+        self.assertEqual(port.readline(), b'101\n')
+        time.sleep(0.05)
+        xbee.write(b'~1011')
+        self.assertEqual(xbee.read(xbee.in_waiting), b'~1011')
+        recorder.close()
+
+        ports, frames = read_recording(self._path)
+        self.assertEqual(ports, ['serial', 'xbee'])
+        self.assertEqual([(f.port, f.direction, f.data) for f in frames], [
+            ('serial', TX, b'101\n'), ('serial', RX, b'101\n'), ('xbee', TX, b'~1011'), ('xbee', RX, b'~1011')])
+        self.assertGreaterEqual(frames[2].time_s - frames[1].time_s, 0.05)
+
+        # A recording cut short is read up to its last whole frame
+        with open(self._path, 'ab') as f:
+            f.write(b'\x10\x00\x00\x00\x00\x20\x00trunc')
+        self.assertEqual(len(read_recording(self._path)[1]), 4)
+
+    def test_replay_port(self):
+        """Replay ports deliver recorded reads on time and compare writes with the recording"""
+
+        recorder = Recorder(self._path)
+        port = recorder.wrap(serial.serial_for_url('loop://', timeout=1), 'serial')
+        port.write(b'PLAN 101\n')
+        port.readline()
+        time.sleep(0.2)
+        port.write(b'\x00')
+        port.write(b'SPACE\n')
+        port.readline()
+        recorder.close()
+
+        replay = Replay(self._path, speed=2)
+        replay_port = replay.port('serial', timeout=1)
+        replay.start()
+
+        self.assertEqual(replay_port.readline(), b'PLAN 101\n')
+        start = time.monotonic()
+        self.assertEqual(replay_port.readline(), b'\x00SPACE\n')   # The loopback echoed the heartbeat too
+        self.assertGreater(time.monotonic() - start, 0.05)
+        self.assertTrue(replay.wait(timeout_s=1))
+
+        replay_port.write(b'PLAN 101\n')
+        replay_port.write(b'PLAN 101\n')   # Repeats count once
+        replay_port.write(b'SPACE?\n')
+        check = replay.check('serial', ignore=(b'\x00',))
+        self.assertEqual(check.mismatches, [(1, b'SPACE\n', b'SPACE?\n')])
+
+    def test_replay_handlers(self):
+        """A recorded session replayed through the handlers writes what was written in flight"""
+
+        speed = 50
+        clock = ScaledClock(speed)
+        recorder = Recorder(self._path)
+        autopilot = _Autopilot()
+
+        ser = SerialHandler('test', _clock=clock)
+        ser.serial = recorder.wrap(autopilot, 'serial')
+
+        xbee_station = FakeXBeeStation(ack_delay_s=0)
+        xbee_station.add_station('101')
+        xbee = XBee(clock=clock)
+        xbee.xbee_port = recorder.wrap(xbee_station, 'xbee')
+
+        db = Database(os.path.join(self._work_dir, 'flight.db'), _clock=clock)
+        dl = DataStationHandler(120000, 120000, 900000, ser.rx_queue, xbee, db, _tx_queue=ser.tx_queue, _clock=clock)
+        dl.simulate = True
+        dl.trace_directory = None
+
+        is_downloading = threading.Event()
+        threads = [threading.Thread(target=ser.reader), threading.Thread(target=ser.writer),
+                   threading.Thread(target=dl.run, args=(ser.rx_lock, is_downloading))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for line in [b'PLAN 101,102\n', b'101\n', b'PLAN 101,102\n']:
+            autopilot.lines.put(line)
+            time.sleep(0.1)
+        while ser.rx_queue.unfinished_tasks or not ser.tx_queue.empty():
+            time.sleep(0.05)
+        time.sleep(0.2)
+
+        for service in [dl, ser]:
+            service.stop()
+        recorder.close()
+
+        checks, _ = replay_handlers(self._path, self._work_dir, speed, settle_s=0.5)
+        serial_check, xbee_check = checks
+
+        self.assertEqual(len(serial_check.expected), 2)
+        self.assertEqual(serial_check.mismatches, [])
+        self.assertEqual(xbee_check.expected, [b'~1011', b'~1012'])
+        self.assertEqual(xbee_check.mismatches, [])
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from avionics.services.data_station_handler.database import Database
+from avionics.services.data_station_handler.retention import MB, RetentionManager
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._local_root = os.path.join(self._work_dir, 'srv')
+        self.db = Database(os.path.join(self._work_dir, 'avionics.db'))
+
+        # Three flights of 4 files in 2 stations, the first two exported
+        self._flights = []
+        for _ in range(3):
+            flight_id = self.db.insert_new_flight()
+            for station_id in ['101', '102']:
+                directory = os.path.join(self._local_root, str(flight_id), station_id)
+                os.makedirs(directory)
+                for index in range(2):
+                    with open(os.path.join(directory, 'IMG_%04d.JPG' % index), 'wb') as f:
+                        f.write(b'\0' * 1024)
+            self._flights.append(flight_id)
+
+        self.db.mark_flight_exported(self._flights[0])
+        self.db.mark_flight_exported(self._flights[1])
+
+        self.retention = RetentionManager(self.db, _local_root=self._local_root)
+
+        # Force eviction whatever the real free space is
+        self.retention.min_free_mb = self.retention.free_mb() + 1024 * 1024
+        self.retention.target_free_mb = self.retention.min_free_mb
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def test_nothing_to_do(self):
+        """No flight is evicted while there is enough free space"""
+
+        self.retention.min_free_mb = 0
+        self.assertEqual(self.retention.enforce(), 0)
+        self.assertEqual(self.db.get_evictable_flights(), self._flights[:2])
+
+    def test_evicts_exported_flights_only(self):
+        """Eviction removes exported flights and never touches the rest"""
+
+        freed_mb = self.retention.enforce()
+
+        self.assertAlmostEqual(freed_mb, 8 * 1024 / MB)
+        self.assertFalse(os.path.exists(os.path.join(self._local_root, str(self._flights[0]))))
+        self.assertFalse(os.path.exists(os.path.join(self._local_root, str(self._flights[1]))))
+        self.assertEqual(len(os.listdir(os.path.join(self._local_root, str(self._flights[2]), '101'))), 2)
+
+        self.assertEqual(self.db.get_evictable_flights(), [])
+        evicted = [f['flight_id'] for f in self.db.get_flights() if f['evicted_at'] is not None]
+        self.assertEqual(sorted(evicted), self._flights[:2])
+
+    def test_stops_when_download_starts(self):
+        """Eviction gives way to a download after the current batch"""
+
+        self.retention.batch_files = 2
+        is_downloading = threading.Event()
+        is_downloading.set()
+
+        freed_mb = self.retention.enforce(is_downloading)
+
+        self.assertAlmostEqual(freed_mb, 2 * 1024 / MB)
+        self.assertEqual(self.db.get_evictable_flights(), self._flights[:2])
+
+    def test_forecast(self):
+        """Forecast weighs expected downloads against free and evictable space"""
+
+        self.db.insert_data_station('101')
+        forecast = self.retention.forecast()
+
+        expected_mb = self.retention.scheduler.estimate('101').expected_data_mb
+        self.assertAlmostEqual(forecast.expected_mb, expected_mb)
+        self.assertAlmostEqual(forecast.evictable_mb, 8 * 1024 / MB)
+        self.assertAlmostEqual(forecast.margin_mb, forecast.free_mb + forecast.evictable_mb - expected_mb
+                               - self.retention.min_free_mb)
+        self.assertTrue(forecast.margin_mb < 0)
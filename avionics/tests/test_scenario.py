@@ -0,0 +1,91 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from avionics.services.clock import SimulatedClock
+from avionics.services.data_station_handler import DataStationHandler
+from avionics.services.data_station_handler.database import Database
+
+class TestMissionScenario(unittest.TestCase):
+
+    STATIONS = [str(101 + i) for i in range(40)]
+    TRANSIT_S = 90  # Flight time between stations
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self._clock = SimulatedClock(epoch=1500000000)
+
+        self._rx_queue = queue.Queue()
+        self._rx_lock = threading.Lock()
+        self._is_downloading = threading.Event()
+
+        self.db = Database(os.path.join(self._work_dir, 'avionics.db'), self._clock)
+        self._data_station_handler = DataStationHandler(1000, 1000, 2000, self._rx_queue, _db=self.db,
+            _clock=self._clock)
+        self._data_station_handler.simulate = True
+        self._data_station_handler.connect()
+
+    def tearDown(self):
+        self._data_station_handler.stop()
+        shutil.rmtree(self._work_dir)
+
+    def _fly(self):
+        for station_id in self.STATIONS:
+            self._clock.sleep(self.TRANSIT_S)
+            self._rx_queue.put(station_id)
+            self._data_station_handler._wake_download_and_sleep(self._rx_lock, self._is_downloading)
+
+        flight_id = self._data_station_handler.flight_id
+        self._data_station_handler.flight_id = None
+        return flight_id
+
+    def test_forty_station_mission(self):
+        """A 40 station mission runs on simulated time with real phase timings recorded"""
+
+        start = time.monotonic()
+        flight_id = self._fly()
+        elapsed = time.monotonic() - start
+
+        self.assertLess(elapsed, 20)
+        self.assertGreaterEqual(self._clock.monotonic(), 40 * (self.TRANSIT_S + 10))
+
+        for station_id in self.STATIONS:
+            stats = self.db.get_flight_station_stats(station_id, flight_id)
+            self.assertTrue(stats['did_wake_up_ack'])
+
+        trace = self._data_station_handler.last_trace
+        self.assertTrue(10 <= trace.duration('transfer') <= 20)
+
+    def test_next_day_plan(self):
+        """Visit history recorded on simulated days feeds the next day's plan"""
+
+        self._fly()
+        self._clock.sleep(24 * 3600)
+
+        self.assertAlmostEqual(self.db.get_days_since_visit('101'), 1, places=1)
+
+        plan = self._data_station_handler.scheduler.plan(self.STATIONS)
+        self.assertEqual(sorted(station_id for station_id, _ in plan), self.STATIONS)
+
+    def test_new_flight_after_export(self):
+        """Without a restart, downloads after the ground station took a flight start a new flight"""
+
+        self._rx_queue.put('101')
+        self._data_station_handler._wake_download_and_sleep(self._rx_lock, self._is_downloading)
+        first_flight_id = self._data_station_handler.flight_id
+
+        self._rx_queue.put('102')
+        self._data_station_handler._wake_download_and_sleep(self._rx_lock, self._is_downloading)
+        self.assertEqual(self._data_station_handler.flight_id, first_flight_id)
+
+        self.db.mark_flight_exported(first_flight_id)
+        self.assertTrue(self.db.is_flight_exported(first_flight_id))
+
+        self._rx_queue.put('101')
+        self._data_station_handler._wake_download_and_sleep(self._rx_lock, self._is_downloading)
+        self.assertNotEqual(self._data_station_handler.flight_id, first_flight_id)
+        self.assertEqual(self.db.get_evictable_flights(), [first_flight_id])
@@ -0,0 +1,467 @@
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+from avionics.services.clock import SimulatedClock
+from avionics.services.data_station_handler import sftp
+from avionics.services.data_station_handler.sftp import SFTPClient
+from avionics.services.data_station_handler.tuner import TransferSettings
+from avionics.simulator import DataStationSimulator, FakeXBeeStation, SyntheticTree
+from avionics.simulator.benchmark import Mission
+
+def _local_files(directory):
+    """Paths of all files below a local station directory, relative to it"""
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, files in os.walk(directory) for name in files)
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def test_synthetic_tree_deterministic(self):
+        """Synthetic trees with the same seed have the same files and sizes"""
+
+        a = SyntheticTree(os.path.join(self._work_dir, 'a'), 2, 2, 5, ('uniform', 1000, 5000), seed=7)
+        b = SyntheticTree(os.path.join(self._work_dir, 'b'), 2, 2, 5, ('uniform', 1000, 5000), seed=7)
+        a.build()
+        b.build()
+
+        self.assertEqual(a.total_files, 20)
+        self.assertEqual(a.total_bytes, b.total_bytes)
+
+    def test_fake_xbee_acknowledges(self):
+        """Fake XBee station echoes command frames back as ACKs"""
+
+        xbee_station = FakeXBeeStation(ack_delay_s=0)
+        xbee_station.add_station('123')
+
+        xbee_station.write(b'~1231')
+
+        self.assertEqual(xbee_station.in_waiting, 5)
+        self.assertEqual(xbee_station.read(5), b'~1231')
+
+    def test_fake_xbee_ignores_unknown_station(self):
+        """Fake XBee station does not answer for stations that aren't there"""
+
+        xbee_station = FakeXBeeStation(ack_delay_s=0)
+
+        xbee_station.write(b'~1231')
+
+        self.assertEqual(xbee_station.in_waiting, 0)
+
+    def test_station_visit(self):
+        """Real download path transfers every file from a simulated station"""
+
+        mission = Mission(self._work_dir, stations=1, files_per_folder=5,
+            size_distribution=('fixed', 16 * 1024), ack_delay_s=0.1)
+
+        try:
+            stats = mission.visit('101')
+        finally:
+            mission.stop()
+
+        self.assertEqual(stats['total_files'], 5)
+        self.assertEqual(stats['successful_downloads'], 5)
+        self.assertTrue(stats['did_wake_up_ack'])
+        self.assertTrue(stats['did_shutdown_ack'])
+
+        local = os.path.join(self._work_dir, 'srv', str(mission.handler.flight_id), '101')
+        self.assertEqual(len(_local_files(local)), 5)
+
+    def test_autotuned_visit(self):
+        """An auto-tuned visit downloads with its chosen settings and records their throughput"""
+
+        mission = Mission(self._work_dir, stations=1, files_per_folder=5,
+            size_distribution=('fixed', 16 * 1024), ack_delay_s=0.1)
+        mission.handler.autotune = True
+
+        try:
+            stats = mission.visit('101')
+        finally:
+            mission.stop()
+
+        self.assertEqual(stats['successful_downloads'], 5)
+
+        results = mission.db.get_transfer_results('101')
+        self.assertEqual(len(results), 1)
+        settings, throughput_mbps = results[0]
+        self.assertEqual(sorted(settings), ['boot_delay_share', 'prefetch_requests', 'window_mb'])
+        self.assertGreater(throughput_mbps, 0)
+
+    def test_concurrent_sessions(self):
+        """Two stations are downloaded at once, each connection from its own source address"""
+
+        mission = Mission(self._work_dir, stations=2, files_per_folder=4,
+            size_distribution=('fixed', 16 * 1024), boot_time_s=1, ack_delay_s=0.1)
+        handler = mission.handler
+        handler.max_sessions = 2
+        handler.station_sources = {'101': '127.0.0.2', '102': '127.0.0.3'}
+
+        traces = []
+        handler.on_visit = traces.append
+
+        try:
+            for station_id in ('101', '102'):
+                mission.rx_queue.put(station_id)
+                handler._wake_download_and_sleep(mission.rx_lock, mission.is_downloading)
+            self.assertTrue(handler.wait_for_sessions(60))
+        finally:
+            mission.stop()
+
+        for simulator in mission.stations:
+            stats = mission.db.get_flight_station_stats(simulator.station_id, handler.flight_id)
+            self.assertEqual(stats['successful_downloads'], 4)
+            self.assertEqual(set(simulator.peers), {handler.station_sources[simulator.station_id]})
+
+        # The visits overlapped in time
+        visits = [next(s for s in trace.spans if s.name == 'visit') for trace in traces]
+        self.assertEqual(len(visits), 2)
+        self.assertLess(max(v.start for v in visits), min(v.end for v in visits))
+
+        self.assertFalse(mission.is_downloading.is_set())
+        self.assertEqual(mission.rx_queue.unfinished_tasks, 0)
+
+    def test_sessions_queue_arrivals(self):
+        """Arrivals beyond the free sessions are queued without holding up control messages"""
+
+        mission = Mission(self._work_dir, stations=3, files_per_folder=2,
+            size_distribution=('fixed', 1024), boot_time_s=1, ack_delay_s=0.1)
+        handler = mission.handler
+        handler.max_sessions = 2
+
+        answered = []
+        handler.control_handlers['PING'] = answered.append
+
+        try:
+            start = time.monotonic()
+            for message in ('101', '102', '103', 'PING now'):
+                mission.rx_queue.put(message)
+                handler._wake_download_and_sleep(mission.rx_lock, mission.is_downloading)
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertEqual(answered, ['now'])
+
+            self.assertTrue(handler.wait_for_sessions(60))
+
+            # Nothing is visited once the handler stops
+            handler.stop()
+            mission.rx_queue.put('101')
+            handler._wake_download_and_sleep(mission.rx_lock, mission.is_downloading)
+            self.assertTrue(handler.wait_for_sessions(1))
+        finally:
+            mission.stop()
+
+        for simulator in mission.stations:
+            stats = mission.db.get_flight_station_stats(simulator.station_id, handler.flight_id)
+            self.assertEqual(stats['successful_downloads'], 2)
+        self.assertEqual(mission.rx_queue.unfinished_tasks, 0)
+
+    def test_same_names_in_different_folders(self):
+        """Files with the same name on different cards and folders are all kept"""
+
+        mission = Mission(self._work_dir, stations=1, devices=2, folders_per_device=2, files_per_folder=3,
+            size_distribution=('fixed', 1024), ack_delay_s=0.1)
+
+        try:
+            stats = mission.visit('101')
+        finally:
+            mission.stop()
+
+        self.assertEqual(stats['successful_downloads'], 12)
+
+        local = os.path.join(self._work_dir, 'srv', str(mission.handler.flight_id), '101')
+        files = _local_files(local)
+        self.assertEqual(len(files), 12)
+        self.assertIn(os.path.join('usb1', 'DCIM', '101MEDIA', 'IMG_0003.JPG'), files)
+
+        paths = mission.db.get_local_paths('101', mission.handler.flight_id)
+        self.assertEqual(sorted(paths.values()), files)
+        self.assertEqual(paths['/media/usb1/DCIM/101MEDIA/IMG_0003.JPG'], os.path.join('usb1', 'DCIM', '101MEDIA', 'IMG_0003.JPG'))
+
+    def test_station_visit_process_worker(self):
+        """Process-backed download worker reports the same results and trace as the thread"""
+
+        mission = Mission(self._work_dir, stations=1, files_per_folder=5,
+            size_distribution=('fixed', 16 * 1024), ack_delay_s=0.1, worker='process')
+
+        try:
+            stats = mission.visit('101')
+        finally:
+            mission.stop()
+
+        self.assertTrue(stats['did_connect'])
+        self.assertEqual(stats['successful_downloads'], 5)
+
+        trace = mission.handler.last_trace
+        self.assertEqual(trace.get('files_downloaded'), 5)
+        self.assertEqual(trace.get('bytes_downloaded'), 5 * 16 * 1024)
+        self.assertGreater(trace.duration('transfer'), 0)
+
+    def test_group_wake(self):
+        """Stations woken by a group wake skip the wakeup on arrival"""
+
+        mission = Mission(self._work_dir, stations=2, files_per_folder=2,
+            size_distribution=('fixed', 1024), ack_delay_s=0.1)
+
+        try:
+            mission.wake_all()
+            self.assertEqual(sorted(mission.handler.woken), ['101', '102'])
+
+            stats = mission.visit('102')
+        finally:
+            mission.stop()
+
+        self.assertTrue(stats['did_wake_up_ack'])
+        self.assertEqual(stats['successful_downloads'], 2)
+        self.assertEqual(mission.handler.last_trace.get('xbee_tx_frames', command='POWER_ON'), 0)
+
+    def test_content_store_redownload(self):
+        """A redownload into a new flight links the stored content instead of storing it again"""
+
+        mission = Mission(self._work_dir, stations=1, files_per_folder=4,
+            size_distribution=('uniform', 1024, 8 * 1024), ack_delay_s=0.1)
+        mission.handler.content_store = True
+        tree = mission.trees['101']
+
+        try:
+            mission.visit('101')
+            first_flight_id = mission.handler.flight_id
+
+            # Next flight, the operator asks for the station's data again
+            mission.handler.flight_id = None
+            conn = sqlite3.connect(mission.db.db_path)
+            conn.execute('UPDATE stations SET redownload=1 WHERE station_id=101')
+            conn.commit()
+            conn.close()
+
+            stats = mission.visit('101')
+        finally:
+            mission.stop()
+
+        self.assertEqual(stats['successful_downloads'], tree.total_files)
+        self.assertEqual(mission.handler.last_trace.get('store_duplicate_bytes'), tree.total_bytes)
+
+        objects = os.path.join(self._work_dir, 'srv', '.store', 'objects')
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(objects)), tree.total_files)
+
+        local = os.path.join(self._work_dir, 'srv', str(mission.handler.flight_id), '101')
+        for path in _local_files(local):
+            # The object plus one link per flight
+            self.assertEqual(os.stat(os.path.join(local, path)).st_nlink, 3)
+
+        digests = mission.db.get_file_digests('101', mission.handler.flight_id)
+        self.assertEqual(len(digests), tree.total_files)
+        locations = mission.db.get_file_locations(list(digests.values())[0])
+        self.assertEqual([l[0] for l in locations], [first_flight_id, mission.handler.flight_id])
+
+    def test_progressive_previews_first(self):
+        """Progressive mode previews every capture, then fills the byte quota with full files"""
+
+        mission = Mission(self._work_dir, stations=1, folders_per_device=2, files_per_folder=5,
+            size_distribution=('fixed', 16 * 1024), ack_delay_s=0.1, exif=True)
+        mission.handler.progressive = True
+        tree = mission.trees['101']
+
+        # The station made its own thumbnail of one file
+        station_thumbnail = b'\xff\xd8station thumbnail\xff\xd9'
+        thumbnails = os.path.join(tree.root, 'media', 'usb0', 'DCIM', '101MEDIA', '.thumbnails')
+        os.makedirs(thumbnails)
+        with open(os.path.join(thumbnails, 'IMG_0002.JPG'), 'wb') as f:
+            f.write(station_thumbnail)
+
+        # Room for three full files
+        mission.db.insert_data_station('101')
+        conn = sqlite3.connect(mission.db.db_path)
+        conn.execute('UPDATE stations SET byte_quota_mb=? WHERE station_id=101', (3.5 * 16 / 1024,))
+        conn.commit()
+        conn.close()
+
+        try:
+            stats = mission.visit('101')
+        finally:
+            mission.stop()
+
+        self.assertEqual(stats['total_files'], 10)
+        self.assertEqual(stats['successful_downloads'], 3)
+        self.assertEqual(stats['previews'], 10)
+
+        flight_id = mission.handler.flight_id
+        local = os.path.join(self._work_dir, 'srv', str(flight_id), '101')
+        previews = os.path.join(self._work_dir, 'srv', '.thumbnails', str(flight_id), '101')
+        self.assertEqual(len(_local_files(local)), 3)
+        self.assertEqual(len(_local_files(previews)), 10)
+
+        with open(os.path.join(previews, 'usb0', 'DCIM', '101MEDIA', 'IMG_0002.JPG'), 'rb') as f:
+            self.assertEqual(f.read(), station_thumbnail)
+
+        # Files only previewed stay on the station for the next visit
+        remaining = [name for name in os.listdir(os.path.join(tree.root, 'media', 'usb0', 'DCIM', '100MEDIA'))
+                     if not name.startswith('.')]
+        self.assertEqual(len(remaining), 2)
+
+        index = mission.db.get_file_index('101', flight_id)
+        self.assertEqual(len(index), 10)
+        self.assertEqual(index[os.path.join('usb0', 'DCIM', '101MEDIA', 'IMG_0005.JPG')]['camera_id'], 'CAM-101-0')
+
+    def _client(self, simulator, clock=None, settings=None):
+        client = SFTPClient('pi', 'raspberry', '101.local', 1, threading.Event(),
+            *simulator.address, _local_root=os.path.join(self._work_dir, 'srv'), _settings=settings, _clock=clock)
+        while not client.is_connected:
+            client.connect()
+            time.sleep(0.05)
+        return client
+
+    def test_prefetch_limit_unsupported(self):
+        """Read limits are left out on paramiko releases without them, and unexpected errors are logged"""
+
+        tree = SyntheticTree(os.path.join(self._work_dir, 'station'), 1, 1, 4)
+        tree.build()
+        simulator = DataStationSimulator('101', tree.root, powered=True).start()
+
+        prefetch_limit = sftp.prefetch_limit
+        sftp.prefetch_limit = False
+        try:
+            client = self._client(simulator, settings=TransferSettings(2, 16, 1.0))
+            downloaded = client.downloadNewFieldData()[0]
+
+            def broken(path, file):
+                raise TypeError('broken')
+            client._downloaded = broken
+            with self.assertLogs(level='ERROR') as logs:
+                redownloaded = client.downloadTmpFieldData()[0]
+            client.close()
+        finally:
+            sftp.prefetch_limit = prefetch_limit
+            simulator.stop()
+
+        self.assertEqual(downloaded, 4)
+        self.assertEqual(redownloaded, 0)
+        self.assertEqual(len(logs.records), 4)
+        self.assertIn('TypeError', logs.output[0])
+
+    def test_delta_listing(self):
+        """Only directories whose mtime changed since the last visit are listed again"""
+
+        tree = SyntheticTree(os.path.join(self._work_dir, 'station'), 2, 3, 5)
+        tree.build()
+        simulator = DataStationSimulator('101', tree.root, powered=True).start()
+
+        def walk(clock=None):
+            client = self._client(simulator, clock)
+            simulator.ops.clear()
+            files = sum(len(f) for _, f in client._walk_attr(client.REMOTE_FIELD_DATA_SOURCE))
+            client.close()
+            return files, simulator.ops['list_folder']
+
+        try:
+            self.assertEqual(walk(), (30, 11))
+            self.assertEqual(walk(), (30, 0))
+
+            # A new file in one folder, with an mtime that can't collide with the cached one
+            folder = os.path.join(tree.root, 'media', 'usb0', 'DCIM', '100MEDIA')
+            open(os.path.join(folder, 'IMG_9999.JPG'), 'w').close()
+            os.utime(folder, (time.time() + 5, time.time() + 5))
+
+            self.assertEqual(walk(), (31, 1))
+
+            # A cache older than a week, by the client's clock, is ignored
+            clock = SimulatedClock()
+            clock.advance(SFTPClient.MANIFEST_MAX_AGE_S + 1)
+            self.assertEqual(walk(clock), (31, 11))
+        finally:
+            simulator.stop()
+
+    def test_station_logs(self):
+        """Station logs are collected after field data, and only when they change"""
+
+        mission = Mission(self._work_dir, stations=1, files_per_folder=2,
+            size_distribution=('fixed', 1024), ack_delay_s=0.1)
+
+        logs = os.path.join(mission.trees['101'].root, 'media', 'logs')
+        os.makedirs(os.path.join(logs, 'system'))
+        for name in ['station.log', os.path.join('system', 'power.log')]:
+            with open(os.path.join(logs, name), 'w') as f:
+                f.write('battery ok\n' * 100)
+
+        try:
+            mission.visit('101')
+            first = mission.handler.last_trace.get('log_bytes_downloaded')
+            mission.visit('101')
+            second = mission.handler.last_trace.get('log_bytes_downloaded')
+        finally:
+            mission.stop()
+
+        local = os.path.join(self._work_dir, 'srv', 'logs', '101')
+        self.assertTrue(os.path.exists(os.path.join(local, 'station.log')))
+        self.assertTrue(os.path.exists(os.path.join(local, 'system', 'power.log')))
+        self.assertEqual(first, 2 * 1100)
+        self.assertEqual(second, 0)
+
+        # Logs aren't field data, the files table only has the captures
+        paths = mission.db.get_local_paths('101', mission.handler.flight_id)
+        self.assertEqual(sorted(paths), ['/media/usb0/DCIM/100MEDIA/IMG_0001.JPG', '/media/usb0/DCIM/100MEDIA/IMG_0002.JPG'])
+
+    def test_compressed_station_logs(self):
+        """Stations that allow commands send changed logs as one compressed archive"""
+
+        logs = os.path.join(self._work_dir, 'station', 'media', 'logs')
+        os.makedirs(logs)
+        with open(os.path.join(logs, 'station.log'), 'w') as f:
+            f.write('battery ok\n' * 1000)
+        os.utime(os.path.join(logs, 'station.log'), (time.time() - 60, time.time() - 60))
+
+        simulator = DataStationSimulator('101', os.path.join(self._work_dir, 'station'),
+            powered=True, allow_exec=True).start()
+
+        try:
+            client = self._client(simulator)
+            files, size = client.downloadLogs(10)
+            again = client.downloadLogs(10)
+            client.close()
+        finally:
+            simulator.stop()
+
+        self.assertEqual(files, 1)
+        self.assertLess(size, 11000)
+        self.assertEqual(again, (0, 0))
+
+        archives = [n for n in os.listdir(client.LOCAL_LOG_DESTINATION) if n.endswith('.tar.gz')]
+        with tarfile.open(os.path.join(client.LOCAL_LOG_DESTINATION, archives[0])) as archive:
+            self.assertEqual(archive.getnames(), ['./station.log'])
+
+    def test_unreadable_station_logs(self):
+        """A bad clock reply or a corrupt log archive skips log collection without raising"""
+
+        simulator = DataStationSimulator('101', os.path.join(self._work_dir, 'station'),
+            powered=True, allow_exec=True).start()
+
+        def date_garbage(command, deadline, out=None):
+            return 'date: not found\n'
+
+        def corrupt_archive(command, deadline, out=None):
+            if out is None:
+                return '1700000000\n'
+            out.write(b'\x1f\x8b truncated')
+            return True
+
+        try:
+            client = self._client(simulator)
+            client._exec = date_garbage
+            bad_clock = client.downloadLogs(10)
+            client._exec = corrupt_archive
+            bad_archive = client.downloadLogs(10)
+            client.close()
+        finally:
+            simulator.stop()
+
+        self.assertEqual(bad_clock, (0, 0))
+        self.assertEqual(bad_archive, (0, 0))
+        self.assertEqual(os.listdir(client.LOCAL_LOG_DESTINATION), [])
@@ -0,0 +1,62 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+AVIONICS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Time-to-first-heartbeat budget in seconds, override for slow machines
+STARTUP_BUDGET_S = float(os.getenv('STARTUP_BUDGET_S', '2.0'))
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+        env = dict(os.environ, TESTING='True', DEVELOPMENT='False', PYTHONUNBUFFERED='1')
+        self._process = subprocess.Popen([sys.executable, AVIONICS], cwd=self._directory, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def tearDown(self):
+        self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        shutil.rmtree(self._directory)
+
+    def _startup_steps(self, until, timeout=30):
+        """Read startup timings from the log until the given step is reached"""
+
+        steps = []
+        deadline = time.time() + timeout
+
+        while time.time() < deadline:
+            line = self._process.stdout.readline()
+            if not line:
+                break
+            match = re.search(r'Startup: (.+) after ([0-9.]+) s', line)
+            if match:
+                steps.append((match.group(1), float(match.group(2))))
+                if match.group(1) == until:
+                    break
+
+        return steps
+
+    def test_time_to_first_heartbeat(self):
+        """First heartbeat is sent within the startup budget"""
+
+        steps = dict(self._startup_steps('first heartbeat'))
+
+        self.assertIn('first heartbeat', steps)
+        self.assertLess(steps['first heartbeat'], STARTUP_BUDGET_S)
+
+    def test_paramiko_loaded_after_heartbeat(self):
+        """Paramiko is only loaded once the heartbeat is up"""
+
+        steps = [step for step, _ in self._startup_steps('paramiko loaded')]
+
+        self.assertIn('paramiko loaded', steps)
+        self.assertLess(steps.index('first heartbeat'), steps.index('paramiko loaded'))
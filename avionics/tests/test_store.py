@@ -0,0 +1,65 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from avionics.services.data_station_handler.store import ContentStore
+
+class TestContentStore(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self.store = ContentStore(self._work_dir)
+
+        self._flight = os.path.join(self._work_dir, '1', '101')
+        os.makedirs(self._flight)
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _add(self, data, name, chunk=1000):
+        spool = self.store.open()
+        for i in range(0, len(data), chunk):
+            spool.write(data[i:i + chunk])
+        return self.store.add(spool, os.path.join(self._flight, name))
+
+    def test_stores_once(self):
+        """Identical content is stored once and linked under every name"""
+
+        data = os.urandom(5000)
+        digest, size, duplicate = self._add(data, 'a.JPG')
+        self.assertEqual((digest, size, duplicate), (hashlib.sha256(data).hexdigest(), 5000, False))
+
+        self.assertTrue(self._add(data, 'b.JPG')[2])
+        self.assertEqual(os.stat(self.store.object_path(digest)).st_nlink, 3)
+
+        with open(os.path.join(self._flight, 'b.JPG'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_large_file_spills_to_disk(self):
+        """Files over the spool size are written through a temporary file"""
+
+        self.store.SPOOL_BYTES = 2048
+        data = os.urandom(10000)
+
+        digest, _, _ = self._add(data, 'big.JPG')
+        self.assertEqual(os.listdir(self.store.tmp_directory), [])
+
+        with open(self.store.object_path(digest), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        # A duplicate spill file is dropped
+        self.assertTrue(self._add(data, 'big2.JPG')[2])
+        self.assertEqual(os.listdir(self.store.tmp_directory), [])
+
+    def test_collect_garbage(self):
+        """Objects without flight links are deleted"""
+
+        kept, _, _ = self._add(b'kept', 'kept.JPG')
+        dropped, _, _ = self._add(b'dropped!', 'dropped.JPG')
+        os.remove(os.path.join(self._flight, 'dropped.JPG'))
+
+        self.assertEqual(self.store.collect_garbage(), 8)
+        self.assertTrue(os.path.exists(self.store.object_path(kept)))
+        self.assertFalse(os.path.exists(self.store.object_path(dropped)))
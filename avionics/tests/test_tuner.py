@@ -0,0 +1,63 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from avionics.services.data_station_handler.database import Database
+from avionics.services.data_station_handler.tuner import CANDIDATES, DEFAULT_SETTINGS, TransferSettings, TransferTuner
+
+class TestTransferTuner(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self._work_dir, 'avionics.db'))
+        self.tuner = TransferTuner(self.db, random.Random(1))
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    @staticmethod
+    def _throughput(settings):
+        """A station whose link is fastest with a 4 MB window, 64 reads in flight and half the boot delay"""
+        return (20 - abs(settings.window_mb - 4) - (0 if settings.prefetch_requests == 64 else 3)
+                - 10 * (settings.boot_delay_share - 0.5))
+
+    def test_untried_values_first(self):
+        """Every candidate value is tried early on, one setting away from the best so far"""
+
+        tried = dict((name, set()) for name in TransferSettings._fields)
+        for flight_id in range(1, 9):
+            best = self.tuner.best('101')
+            settings = self.tuner.choose('101')
+            self.assertLessEqual(sum(a != b for a, b in zip(best, settings)), 1)
+
+            for name in TransferSettings._fields:
+                tried[name].add(getattr(settings, name))
+            self.tuner.record('101', flight_id, settings, self._throughput(settings))
+
+        for name in TransferSettings._fields:
+            self.assertEqual(tried[name], set(getattr(CANDIDATES, name)))
+
+    def test_converges(self):
+        """Over a season of visits a station settles on its fastest settings, other stations are unaffected"""
+
+        for flight_id in range(1, 41):
+            settings = self.tuner.choose('101')
+            self.tuner.record('101', flight_id, settings, self._throughput(settings))
+
+        self.assertEqual(self.tuner.best('101'), TransferSettings(4, 64, 0.5))
+        self.assertEqual(self.tuner.best('102'), DEFAULT_SETTINGS)
+
+        # Without exploration the best settings are chosen
+        self.tuner.EPSILON = 0
+        self.assertEqual(self.tuner.choose('101'), TransferSettings(4, 64, 0.5))
+
+    def test_history_survives_new_candidates(self):
+        """Values no longer among the candidates are ignored, missing settings count as their default"""
+
+        self.db.insert_transfer_result('101', 1, {'window_mb': 3, 'prefetch_requests': 64}, 14.0)
+        self.db.insert_transfer_result('101', 2, {'window_mb': 8}, 12.0)
+
+        self.assertEqual(self.db.get_transfer_results('101')[0], ({'window_mb': 8}, 12.0))
+        self.assertEqual(self.tuner.best('101'), TransferSettings(8, 64, 1.0))
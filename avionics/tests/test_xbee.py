@@ -0,0 +1,102 @@
+import random
+import unittest
+
+from avionics.services.data_station_handler.xbee import RetryPolicy, XBee
+from avionics.simulator import FakeXBeeStation
+
+class TestXBee(unittest.TestCase):
+
+    def setUp(self):
+        self._xbee_station = FakeXBeeStation(ack_delay_s=0.1)
+        self._xbee = XBee()
+        self._xbee.xbee_port = self._xbee_station
+
+    def test_retry_backoff(self):
+        """Retry delays grow exponentially up to the maximum"""
+
+        policy = RetryPolicy(initial_delay_s=1.0, factor=2.0, max_delay_s=5.0, jitter=0)
+
+        self.assertEqual([policy.delay(a) for a in range(1, 5)], [1.0, 2.0, 4.0, 5.0])
+
+    def test_retry_expected_latency(self):
+        """The first resend comes just after the expected reply time"""
+
+        policy = RetryPolicy(initial_delay_s=1.0, jitter=0)
+
+        self.assertAlmostEqual(policy.delay(1, expected_latency_s=0.2), 0.2 * 1.5 + 0.1)
+
+    def test_retry_jitter(self):
+        """Jitter keeps delays within the configured fraction"""
+
+        policy = RetryPolicy(initial_delay_s=1.0, jitter=0.2)
+        rng = random.Random(1)
+
+        for _ in range(100):
+            self.assertTrue(0.8 <= policy.delay(1, rng=rng) <= 1.2)
+
+    def test_command_acknowledged(self):
+        """Acknowledged commands report the send-to-ACK latency"""
+
+        self._xbee_station.add_station('123')
+
+        result = self._xbee.command('123', 'POWER_ON', 5)
+
+        self.assertTrue(result.acknowledged)
+        self.assertEqual(result.attempts, 1)
+        self.assertTrue(0.1 <= result.latency_s < 1.0)
+
+    def test_command_late_ack(self):
+        """An ACK to the first send arriving after a resend counts its latency from the first send"""
+
+        self._xbee_station = FakeXBeeStation(ack_delay_s=0.5)
+        self._xbee.xbee_port = self._xbee_station
+        self._xbee_station.add_station('123')
+
+        result = self._xbee.command('123', 'POWER_ON', 5, policy=RetryPolicy(initial_delay_s=0.2, jitter=0))
+
+        self.assertTrue(result.acknowledged)
+        self.assertEqual(result.attempts, 2)
+        self.assertGreaterEqual(result.latency_s, 0.5)
+
+    def test_command_max_attempts(self):
+        """Unanswered commands stop after the maximum number of attempts"""
+
+        policy = RetryPolicy(initial_delay_s=0.2, factor=1.0, jitter=0, max_attempts=3)
+
+        result = self._xbee.command('123', 'POWER_ON', 5, policy=policy)
+
+        self.assertFalse(result.acknowledged)
+        self.assertEqual(result.attempts, 3)
+        self.assertEqual(self._xbee_station.tx_frames, 3)
+
+    def test_frame_parser_partial_frames(self):
+        """ACKs split across reads and ACKs for other stations are not lost"""
+
+        self._xbee_station = FakeXBeeStation(ack_delay_s=0)
+        self._xbee.xbee_port = self._xbee_station
+
+        self._xbee_station._buffer.extend(b'x~12')
+        self.assertFalse(self._xbee.acknowledge('123', 'POWER_ON'))
+
+        self._xbee_station._buffer.extend(b'31~4561')
+        self.assertTrue(self._xbee.acknowledge('456', 'POWER_ON'))
+        self.assertTrue(self._xbee.acknowledge('123', 'POWER_ON'))
+        self.assertFalse(self._xbee.acknowledge('123', 'POWER_ON'))
+
+    def test_command_group(self):
+        """Group commands go out in one write and collect an ACK per station"""
+
+        for station_id in ['101', '102', '103']:
+            self._xbee_station.add_station(station_id)
+
+        writes = []
+        write = self._xbee_station.write
+        self._xbee_station.write = lambda data: writes.append(data) or write(data)
+
+        results = self._xbee.command_group(['101', '102', '103', '104'], 'POWER_ON', 1,
+            policy=RetryPolicy(initial_delay_s=0.5, jitter=0, max_attempts=2))
+
+        self.assertTrue(all(results[i].acknowledged for i in ['101', '102', '103']))
+        self.assertFalse(results['104'].acknowledged)
+        self.assertEqual(writes[0], b'~1011~1021~1031~1041')
+        self.assertEqual(writes[1], b'~1041')
@@ -1,22 +1,13 @@
-import queue
-import logging
-import sys
-import threading
-
-from avionics.services import DataStationHandler
+"""
+Download data stations from the command line, e.g. `python3 full-download.py 101 102 --sessions 2`
 
-logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s.%(msecs)03d %(levelname)s \t%(message)s',
-                        datefmt="%d %b %Y %H:%M:%S")
+Runs the batch CLI (`avionics.services.data_station_handler.batch`), see
+`--help` for its options.
+"""
 
-rx_lock = threading.Lock()
-is_downloading = threading.Event()
-rx_queue = queue.Queue(maxsize=50)
+import sys
 
-dsh = DataStationHandler(120000, 120000, 900000, rx_queue)
-dsh.connect()
+from avionics.services.data_station_handler.batch import main
 
-while True:
-    s = input("Enter data station ID: ")
-    rx_queue.put(s)
-    dsh._wake_download_and_sleep(rx_lock, is_downloading)
+if __name__ == '__main__':
+    sys.exit(main())